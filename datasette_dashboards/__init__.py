@@ -1,40 +1,58 @@
-import re
+import hashlib
+import json
 import typing as t
 import urllib.parse
 
 from datasette import hookimpl
 from datasette.database import Database
-from datasette.utils.asgi import Forbidden, NotFound, Request, Response
-
-from datasette_dashboards.chart_types import convert_chart_type
+from datasette.utils import CustomJSONEncoder, sqlite3
+from datasette.utils.asgi import BadRequest, Forbidden, NotFound, Request, Response
+
+from datasette_dashboards.assets import (
+    ASSETS_PATH,
+    IMMUTABLE_CACHE_CONTROL,
+    asset_urls,
+    get_assets,
+    negotiate_encoding,
+)
+from datasette_dashboards.conditional import (
+    caching_headers,
+    dashboard_databases,
+    dashboard_etag,
+    dashboard_last_modified,
+    etag_matches,
+    not_modified,
+)
+from datasette_dashboards.data import (
+    DATA_SHAPES,
+    fetch_dashboard_data,
+    fill_dynamic_filters,
+    has_data,
+)
+from datasette_dashboards.maps import parse_viewport, register_functions
+from datasette_dashboards.query import (
+    QueryTemplate,
+    replace_opts_in_query,
+    sql_opt_pattern,
+    sql_var_pattern,
+)
+from datasette_dashboards.registry import (
+    CompiledChart,
+    CompiledDashboard,
+    get_registry,
+)
+from datasette_dashboards.warming import get_filter_usage, start_cache_warming
 
 if t.TYPE_CHECKING:  # pragma: no cover
     from datasette.app import Datasette
 
 
-sql_opt_pattern = re.compile(r"(?P<opt>\[\[.*?\]\])")
-sql_var_pattern = re.compile(r"\:(?P<var>[a-zA-Z0-9_]+)")
-
-
-def replace_opts_in_query(query: str, options: dict[str, str]) -> str:
-    to_replace: list[dict[str, str]] = []
-    for opt_match in re.finditer(sql_opt_pattern, query):
-        opt_group = opt_match.group("opt")
-        var_match = re.search(sql_var_pattern, opt_group)
-        var_group = var_match.group("var") if var_match is not None else ""
-        opt_keep = var_group in options and options[var_group] != ""
-        to_replace.append(
-            {
-                "opt": opt_group,
-                "replacement": opt_group.strip("[[]]") if opt_keep else "",
-            }
-        )
-
-    result = query
-    for r in to_replace:
-        result = result.replace(r["opt"], r["replacement"])
-
-    return result
+__all__ = [
+    "QueryTemplate",
+    "replace_opts_in_query",
+    "sql_opt_pattern",
+    "sql_var_pattern",
+]
 
 
 async def check_permission_instance(request: Request, datasette: "Datasette") -> None:
@@ -62,23 +80,31 @@ async def check_permission_execute_sql(
         raise Forbidden("execute-sql denied")
 
 
-async def fill_dynamic_filters(
-    datasette: "Datasette", dashboard: dict[str, t.Any], options: dict[str, str]
+async def check_permission_databases(
+    request: Request, datasette: "Datasette", dbs: t.Iterable[str]
 ) -> None:
-    for flt in dashboard["filters"].values():
-        if flt["type"] == "select" and {"db", "query"} & flt.keys():
-            query = replace_opts_in_query(flt["query"], options)
-            values = [
-                row[0]
-                for row in await datasette.execute(flt["db"], query, params=options)
-            ]
-            flt["options"] = values
+    for db in dbs:
+        try:
+            database = datasette.get_database(db)
+        except KeyError:
+            raise NotFound(f"Database does not exist: {db}")
+        await datasette.ensure_permissions(
+            request.actor, [("view-database", database.name), "view-instance"]
+        )
+        await check_permission_execute_sql(request, datasette, database.name)
+
+
+def get_dashboard(datasette: "Datasette", slug: str) -> CompiledDashboard:
+    try:
+        return get_registry(datasette).dashboards[slug]
+    except KeyError:
+        raise NotFound(f"Dashboard not found: {slug}")
 
 
 def get_dashboard_filters_keys(
-    request: Request, dashboard: dict[str, t.Any]
+    request: Request, dashboard: CompiledDashboard
 ) -> t.Set[str]:
-    filters_keys = dashboard["filters"].keys()
+    filters_keys = dashboard.filters.keys()
     return set(filters_keys) & set(request.args.keys())
 
 
@@ -90,20 +116,67 @@ def generate_dashboard_filters_qs(request: Request, opts_keys: t.Set[str]) -> st
     return urllib.parse.urlencode({key: request.args[key] for key in opts_keys})
 
 
-def fill_chart_query_options(chart: dict[str, t.Any], options: dict[str, str]) -> None:
-    query: str | None = chart.get("query")
-    if query is None:
-        return
-    chart["query"] = replace_opts_in_query(query, options)
+def dashboard_data_url(request: Request, datasette: "Datasette", slug: str) -> str:
+    url: str = datasette.absolute_url(
+        request,
+        datasette.urls.path(f"-/dashboards/{urllib.parse.quote(slug)}/data.json"),
+    )
+    return url
+
+
+def chart_data_urls(
+    request: Request,
+    datasette: "Datasette",
+    slug: str,
+    charts: t.Iterable[CompiledChart],
+    options: dict[str, str],
+    batched: bool = True,
+) -> dict[str, str]:
+    """Data URLs of charts, only carrying the filters their queries depend on.
+
+    Charts depending on the same filters share a single batched data URL, so
+    that a filter change only affects the URLs of the charts using it. Without
+    batching, every chart gets its own data URL, as lazily rendered charts are
+    fetched independently. Charts are listed by slug, in the same order as
+    the URLs built by the dashboards script.
+    """
+    groups: dict[tuple[str, ...], list[str]] = {}
+    for chart in sorted(charts, key=lambda chart: chart.slug):
+        if has_data(chart):
+            key = chart.filters if batched else (*chart.filters, chart.slug)
+            groups.setdefault(key, []).append(chart.slug)
+
+    base_url = dashboard_data_url(request, datasette, slug)
+    urls = {}
+    for group, chart_slugs in groups.items():
+        filters = group if batched else group[:-1]
+        params = [(key, options[key]) for key in filters if key in options]
+        params += [("_chart", chart_slug) for chart_slug in chart_slugs]
+        for chart_slug in chart_slugs:
+            urls[chart_slug] = f"{base_url}?{urllib.parse.urlencode(params)}"
+    return urls
+
+
+def render_chart(chart: CompiledChart, options: dict[str, str]) -> dict[str, t.Any]:
+    if chart.error is not None:
+        raise NotFound(chart.error)
+    if chart.template is None:
+        return chart.spec
+    return dict(chart.spec, query=chart.template.render(options))
 
 
 async def dashboard_list(request: Request, datasette: "Datasette") -> Response:
     await check_permission_instance(request, datasette)
-    config = datasette.plugin_config("datasette-dashboards") or {}
+    registry = get_registry(datasette)
     return Response.html(
         await datasette.render_template(
             "dashboard_list.html",
-            {"dashboards": config},
+            {
+                "dashboards": {
+                    slug: dashboard.config
+                    for slug, dashboard in registry.dashboards.items()
+                }
+            },
             request=request,
         )
     )
@@ -114,33 +187,16 @@ async def _dashboard_view(
 ) -> Response:
     await check_permission_instance(request, datasette)
 
-    config = datasette.plugin_config("datasette-dashboards") or {}
     slug = urllib.parse.unquote(request.url_vars["slug"])
-    try:
-        dashboard = config[slug]
-    except KeyError:
-        raise NotFound(f"Dashboard not found: {slug}")
-
-    dashboard["filters"] = dashboard.get("filters", {})
-    dashboard["charts"] = dashboard.get("charts", {})
+    dashboard = get_dashboard(datasette, slug)
 
-    settings = dashboard.get("settings", {})
-    dbs = set([chart["db"] for chart in dashboard["charts"].values() if "db" in chart])
-    for db in dbs:
-        try:
-            database = datasette.get_database(db)
-        except KeyError:
-            raise NotFound(f"Database does not exist: {db}")
-        await check_permission_execute_sql(request, datasette, database.name)
+    await check_permission_databases(request, datasette, dashboard.databases)
 
     options_keys = get_dashboard_filters_keys(request, dashboard)
     query_parameters = get_dashboard_filters(request, options_keys)
     query_string = generate_dashboard_filters_qs(request, options_keys)
-    await fill_dynamic_filters(datasette, dashboard, query_parameters)
 
-    default_filters = {
-        k: v["default"] for k, v in dashboard["filters"].items() if v.get("default")
-    }
+    default_filters = dashboard.default_filters
     if len(query_parameters.keys()) == 0 and len(default_filters) > 0:
         qs = urllib.parse.urlencode(default_filters)
         response = Response.redirect(f"{request.path}?{qs}")
@@ -148,36 +204,62 @@ async def _dashboard_view(
             response.set_cookie(k, v)
         return response
 
-    charts = {}
-    for chart_slug, chart in dashboard["charts"].items():
-        try:
-            charts[chart_slug] = convert_chart_type(chart)
-        except KeyError as e:
-            raise NotFound(
-                f"Chart '{chart_slug}' configuration error: missing required field {e}"
-            )
-    for chart in charts.values():
-        fill_chart_query_options(chart, query_parameters)
+    databases = dashboard_databases(dashboard)
+    etag = dashboard_etag(
+        request, datasette, dashboard, databases, query_parameters, "view", embed
+    )
+    last_modified = dashboard_last_modified(datasette, dashboard, databases)
+    headers = caching_headers(request, dashboard.settings, etag, last_modified)
+    if not_modified(request, etag, last_modified):
+        return Response("", status=304, headers=headers)
+
+    usage = get_filter_usage(datasette)
+    for key, template in dashboard.filter_templates.items():
+        usage.record(slug, "filter", key, template.variables, query_parameters)
+    filters = await fill_dynamic_filters(datasette, dashboard, query_parameters)
+
+    charts = {
+        chart_slug: render_chart(chart, query_parameters)
+        for chart_slug, chart in dashboard.charts.items()
+    }
 
-    render_dashboard = dict(dashboard, charts=charts)
+    render_dashboard = dict(dashboard.config, filters=filters, charts=charts)
+    lazy_render = bool(dashboard.settings.get("lazy_render", False))
 
     return Response.html(
         await datasette.render_template(
             "dashboard_view.html",
             {
-                "settings": settings,
-                "absolute_url": datasette.absolute_url(
-                    request, datasette.urls.instance()
-                ),
+                "assets": asset_urls(datasette),
+                "settings": dashboard.settings,
                 "slug": slug,
                 "query_parameters": query_parameters,
                 "query_string": query_string,
+                "data_urls": chart_data_urls(
+                    request,
+                    datasette,
+                    slug,
+                    dashboard.charts.values(),
+                    query_parameters,
+                    batched=not lazy_render,
+                ),
                 "dashboard": render_dashboard,
+                "charts_data": {
+                    "data_url": dashboard_data_url(request, datasette, slug),
+                    "charts": {
+                        chart_slug: chart.filters
+                        for chart_slug, chart in dashboard.charts.items()
+                        if has_data(chart)
+                    },
+                    "reload_filters": sorted(dashboard.filter_dependencies),
+                    "lazy_render": lazy_render,
+                },
                 "embed": embed,
                 "row_limit": datasette.settings_dict().get("max_returned_rows"),
             },
             request=request,
-        )
+        ),
+        headers=headers,
     )
 
 
@@ -189,29 +271,90 @@ async def dashboard_view_embed(request: Request, datasette: "Datasette") -> Resp
     return await _dashboard_view(request, datasette, embed=True)
 
 
+async def dashboard_data(request: Request, datasette: "Datasette") -> Response:
+    await check_permission_instance(request, datasette)
+
+    slug = urllib.parse.unquote(request.url_vars["slug"])
+    dashboard = get_dashboard(datasette, slug)
+
+    charts = dashboard.charts
+    chart_slugs = request.args.getlist("_chart")
+    if chart_slugs:
+        try:
+            # Same charts in the same order whatever their order in the URL
+            charts = {
+                chart_slug: charts[chart_slug] for chart_slug in sorted(chart_slugs)
+            }
+        except KeyError as e:
+            raise NotFound(f"Chart does not exist: {e.args[0]}")
+
+    dbs = set([chart.spec["db"] for chart in charts.values() if "db" in chart.spec])
+    await check_permission_databases(request, datasette, dbs)
+
+    options_keys = get_dashboard_filters_keys(request, dashboard)
+    query_parameters = get_dashboard_filters(request, options_keys)
+    try:
+        viewport = parse_viewport(request.args)
+    except ValueError as e:
+        raise BadRequest(str(e))
+    shape = request.args.get("_shape") or "objects"
+    if shape not in DATA_SHAPES:
+        raise BadRequest(f"Invalid shape: {shape}")
+
+    usage = get_filter_usage(datasette)
+    for chart in charts.values():
+        usage.record(slug, "chart", chart.slug, chart.filters, query_parameters)
+
+    etag = dashboard_etag(
+        request,
+        datasette,
+        dashboard,
+        dbs,
+        query_parameters,
+        "data",
+        sorted(charts),
+        viewport,
+        shape,
+    )
+    last_modified = dashboard_last_modified(datasette, dashboard, dbs)
+    headers = caching_headers(request, dashboard.settings, etag, last_modified)
+    if not_modified(request, etag, last_modified):
+        return Response("", status=304, headers=headers)
+
+    charts_data = await fetch_dashboard_data(
+        datasette, dashboard, charts.values(), query_parameters, viewport, shape
+    )
+    body = json.dumps(
+        {"ok": True, "charts": charts_data},
+        default=CustomJSONEncoder().default,
+    ).encode("utf-8")
+    if etag is None:
+        # Databases without a known version: fingerprint the results instead
+        etag = f'"{hashlib.sha256(body).hexdigest()}"'
+        headers["ETag"] = etag
+        if etag_matches(request, etag):
+            return Response("", status=304, headers=headers)
+
+    return Response(
+        body, headers=headers, content_type="application/json; charset=utf-8"
+    )
+
+
 async def _dashboard_chart(
     request: Request, datasette: "Datasette", embed: bool = False
 ) -> Response:
     await check_permission_instance(request, datasette)
 
-    config = datasette.plugin_config("datasette-dashboards") or {}
     slug = urllib.parse.unquote(request.url_vars["slug"])
     chart_slug = urllib.parse.unquote(request.url_vars["chart_slug"])
+    dashboard = get_dashboard(datasette, slug)
 
     try:
-        dashboard = config[slug]
-    except KeyError:
-        raise NotFound(f"Dashboard not found: {slug}")
-
-    dashboard["filters"] = dashboard.get("filters", {})
-    dashboard["charts"] = dashboard.get("charts", {})
-
-    try:
-        chart = dashboard["charts"][chart_slug]
+        compiled_chart = dashboard.charts[chart_slug]
     except KeyError:
         raise NotFound(f"Chart does not exist: {chart_slug}")
 
-    db = chart.get("db")
+    db = compiled_chart.spec.get("db")
     if db:
         database = datasette.get_database(db)
         await check_permission_execute_sql(request, datasette, database.name)
@@ -220,30 +363,43 @@ async def _dashboard_chart(
     query_parameters = get_dashboard_filters(request, options_keys)
     query_string = generate_dashboard_filters_qs(request, options_keys)
 
-    try:
-        chart = convert_chart_type(chart)
-    except KeyError as e:
-        raise NotFound(
-            f"Chart '{chart_slug}' configuration error: missing required field {e}"
-        )
-    fill_chart_query_options(chart, query_parameters)
+    databases = [db] if db else []
+    etag = dashboard_etag(
+        request,
+        datasette,
+        dashboard,
+        databases,
+        query_parameters,
+        "chart",
+        chart_slug,
+        embed,
+    )
+    last_modified = dashboard_last_modified(datasette, dashboard, databases)
+    headers = caching_headers(request, dashboard.settings, etag, last_modified)
+    if not_modified(request, etag, last_modified):
+        return Response("", status=304, headers=headers)
+
+    chart = render_chart(compiled_chart, query_parameters)
 
     return Response.html(
         await datasette.render_template(
             "dashboard_chart.html",
             {
-                "absolute_url": datasette.absolute_url(
-                    request, datasette.urls.instance()
-                ),
+                "assets": asset_urls(datasette),
                 "slug": slug,
+                "chart_slug": chart_slug,
                 "query_string": query_string,
-                "dashboard": dashboard,
+                "data_urls": chart_data_urls(
+                    request, datasette, slug, [compiled_chart], query_parameters
+                ),
+                "dashboard": dashboard.config,
                 "chart": chart,
                 "embed": embed,
                 "row_limit": datasette.settings_dict().get("max_returned_rows"),
             },
             request=request,
-        )
+        ),
+        headers=headers,
     )
 
 
@@ -255,6 +411,23 @@ async def dashboard_chart_embed(request: Request, datasette: "Datasette") -> Res
     return await _dashboard_chart(request, datasette, embed=True)
 
 
+async def dashboard_asset(request: Request, datasette: "Datasette") -> Response:
+    filename = request.url_vars["filename"]
+    asset = get_assets().get(filename)
+    if asset is None:
+        raise NotFound(f"Asset not found: {filename}")
+
+    encoding = negotiate_encoding(
+        request.headers.get("accept-encoding", ""), asset.encodings
+    )
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        asset.encodings[encoding], headers=headers, content_type=asset.content_type
+    )
+
+
 @hookimpl
 def register_routes() -> t.Iterable[
     tuple[str, t.Callable[..., t.Coroutine[t.Any, t.Any, Response]]]
@@ -263,14 +436,31 @@ def register_routes() -> t.Iterable[
         ("^/-/dashboards$", dashboard_list),
         ("^/-/dashboards/(?P<slug>[^/]+)$", dashboard_view),
         ("^/-/dashboards/(?P<slug>[^/]+)/embed$", dashboard_view_embed),
+        ("^/-/dashboards/(?P<slug>[^/]+)/data\\.json$", dashboard_data),
         ("^/-/dashboards/(?P<slug>[^/]+)/(?P<chart_slug>[^/]+)$", dashboard_chart),
         (
             "^/-/dashboards/(?P<slug>[^/]+)/(?P<chart_slug>[^/]+)/embed$",
             dashboard_chart_embed,
         ),
+        (f"^/{ASSETS_PATH}/(?P<filename>[^/]+)$", dashboard_asset),
     )
 
 
+@hookimpl
+def prepare_connection(conn: sqlite3.Connection) -> None:
+    register_functions(conn)
+
+
+@hookimpl
+def startup(datasette: "Datasette") -> t.Callable[[], t.Awaitable[None]]:
+    get_registry(datasette)
+
+    async def inner() -> None:
+        start_cache_warming(datasette)
+
+    return inner
+
+
 @hookimpl
 def menu_links(
     datasette: "Datasette", actor: dict[str, t.Any] | None
@@ -0,0 +1,269 @@
+import math
+import typing as t
+
+from dataclasses import dataclass
+from datasette.utils import escape_sqlite
+
+from datasette_dashboards.cache import QueryResults
+from datasette_dashboards.chart_types import field_name, field_type
+from datasette_dashboards.query import BoundQuery, QueryTemplate, subquery
+
+OTHER_LABEL = "Other"
+
+
+def _series_count(color: str | None) -> str:
+    """SQL expression counting the series of a chart split by `color`."""
+    if color is None:
+        return "1"
+    return (
+        f"(SELECT count(*) FROM (SELECT DISTINCT {escape_sqlite(color)} "
+        "FROM _dashboards_data))"
+    )
+
+
+def bucket_sql(
+    sql: str, x: str, y: str, color: str | None, temporal: bool, limit: int
+) -> str:
+    """Group series into intervals of the x axis of equal width, with the
+    average of y per interval.
+
+    The interval size is chosen for all the series to fit within `limit`
+    rows. Intervals are placed at their first x value. Temporal x values
+    stored as text are positioned by their Julian day, and the ones stored as
+    numbers, such as epoch timestamps, by their value.
+    """
+    x, y = escape_sqlite(x), escape_sqlite(y)
+    position = (
+        f"(CASE typeof({x}) WHEN 'text' THEN julianday({x}) ELSE {x} END)"
+        if temporal
+        else x
+    )
+    group = f", {escape_sqlite(color)}" if color is not None else ""
+    return f"""WITH _dashboards_data AS (
+{subquery(sql)}
+),
+_dashboards_bounds AS (
+  SELECT
+    min({position}) AS _low,
+    max({position}) AS _high,
+    max(1, {limit} / {_series_count(color)}) AS _buckets
+  FROM _dashboards_data
+)
+SELECT min({x}) AS {x}{group}, avg({y}) AS {y}
+FROM _dashboards_data, _dashboards_bounds
+WHERE {position} IS NOT NULL
+GROUP BY coalesce(
+  min(CAST(({position} - _low) * _buckets / (_high - _low) AS INTEGER), _buckets - 1),
+  0
+){group}
+ORDER BY 1"""
+
+
+def top_sql(
+    sql: str,
+    category: str,
+    value: str,
+    color: str | None = None,
+    top: int | None = None,
+    limit: int | None = None,
+    other: str = OTHER_LABEL,
+) -> str:
+    """Keep the `top` categories with the largest sum of values, summing the
+    values of the others into a single `other` category, in a single pass
+    over the rows.
+
+    Without `top`, as many categories as fit within `limit` rows are kept,
+    counting `other` and one row per color of each category.
+    """
+    category, value = escape_sqlite(category), escape_sqlite(value)
+    group = f", {escape_sqlite(color)}" if color is not None else ""
+    if top is not None:
+        kept = str(top)
+    elif color is None:
+        kept = str(max(1, (limit or 0) - 1))
+    else:
+        kept = (
+            f"(SELECT max(1, {limit} / count(*) - 1) FROM "
+            f"(SELECT DISTINCT {escape_sqlite(color)} FROM _dashboards_totals))"
+        )
+    other = other.replace("'", "''")
+    return f"""WITH _dashboards_data AS (
+{subquery(sql)}
+),
+_dashboards_totals AS (
+  SELECT
+    {category} AS _category{group},
+    sum({value}) AS _value,
+    sum(sum({value})) OVER (PARTITION BY {category}) AS _total
+  FROM _dashboards_data
+  GROUP BY {category}{group}
+),
+_dashboards_ranks AS (
+  SELECT *, dense_rank() OVER (ORDER BY _total DESC, _category) AS _rank
+  FROM _dashboards_totals
+)
+SELECT
+  CASE WHEN _rank <= {kept} THEN _category ELSE '{other}' END AS {category}{group},
+  sum(_value) AS {value}
+FROM _dashboards_ranks
+GROUP BY 1{group}
+ORDER BY max(_rank){group}"""
+
+
+def grid_sql(
+    sql: str, x: str, y: str, color: str | None, size: str | None, limit: int
+) -> str:
+    """Group points into the cells of a grid, placed at the average position
+    of their points.
+
+    The grid has about `sqrt(limit)` rows, and as many columns as can fit
+    within `limit` cells per color.
+    """
+    x, y = escape_sqlite(x), escape_sqlite(y)
+    group = f", {escape_sqlite(color)}" if color is not None else ""
+    sized = f", avg({escape_sqlite(size)}) AS {escape_sqlite(size)}" if size else ""
+    rows = max(1, math.isqrt(limit))
+    return f"""WITH _dashboards_data AS (
+{subquery(sql)}
+),
+_dashboards_bounds AS (
+  SELECT
+    min({x}) AS _x_low,
+    max({x}) AS _x_high,
+    min({y}) AS _y_low,
+    max({y}) AS _y_high,
+    max(1, {limit} / {_series_count(color)} / {rows}) AS _columns
+  FROM _dashboards_data
+)
+SELECT avg({x}) AS {x}, avg({y}) AS {y}{group}{sized}
+FROM _dashboards_data, _dashboards_bounds
+WHERE {x} IS NOT NULL AND {y} IS NOT NULL
+GROUP BY
+  coalesce(
+    min(CAST(({x} - _x_low) * _columns / (_x_high - _x_low) AS INTEGER), _columns - 1),
+    0
+  ),
+  coalesce(
+    min(CAST(({y} - _y_low) * {rows} / (_y_high - _y_low) AS INTEGER), {rows - 1}),
+    0
+  ){group}"""
+
+
+@dataclass(frozen=True)
+class Aggregation:
+    """Aggregate the results of a chart query to fit within a number of rows.
+
+    - `bucket`: line and area series grouped into x intervals
+    - `top`: bar and pie categories beyond the largest grouped as "Other"
+    - `grid`: scatter points grouped into grid cells
+    """
+
+    kind: str
+    x: str
+    y: str
+    color: str | None = None
+    size: str | None = None
+    temporal: bool = False
+
+    def sql(self, sql: str, limit: int) -> str:
+        if self.kind == "bucket":
+            return bucket_sql(sql, self.x, self.y, self.color, self.temporal, limit)
+        if self.kind == "top":
+            return top_sql(sql, self.x, self.y, self.color, limit=limit)
+        return grid_sql(sql, self.x, self.y, self.color, self.size, limit)
+
+    def query(self, query: BoundQuery, limit: int) -> BoundQuery:
+        """The aggregation of a bound query, with the same parameters."""
+        return QueryTemplate.parse(self.sql(query.sql, limit)).bind(query.params)
+
+
+@dataclass(frozen=True)
+class TopCategories:
+    """Keep the `top` categories of a bar or pie chart, grouping the others
+    as "Other"."""
+
+    category: str
+    value: str
+    top: int
+    color: str | None = None
+
+    def stats_query(self, query: BoundQuery) -> BoundQuery | None:
+        return None
+
+    def query(self, query: BoundQuery, stats: QueryResults | None = None) -> BoundQuery:
+        sql = top_sql(query.sql, self.category, self.value, self.color, self.top)
+        return QueryTemplate.parse(sql).bind(query.params)
+
+
+def chart_top_categories(chart: dict[str, t.Any]) -> TopCategories | None:
+    """Top categories configured by the `display.top_n` option of a bar or pie
+    chart."""
+    library = chart.get("library")
+    display: dict[str, t.Any] = chart.get("display", {})
+    if library not in ("bar", "pie") or display.get("top_n") is None:
+        return None
+    top = int(display["top_n"])
+    if top < 1:
+        raise ValueError("top_n must be at least 1")
+    if library == "pie":
+        return TopCategories(
+            category=field_name(display["label"]),
+            value=field_name(display["value"]),
+            top=top,
+        )
+    return TopCategories(
+        category=field_name(display["x"]),
+        value=field_name(display["y"]),
+        top=top,
+        color=field_name(display["color"]) if "color" in display else None,
+    )
+
+
+def chart_aggregation(chart: dict[str, t.Any]) -> Aggregation | None:
+    """Aggregation of a shorthand chart, when its fields can be aggregated."""
+    library = chart.get("library")
+    display: dict[str, t.Any] = chart.get("display", {})
+    color = field_name(display["color"]) if "color" in display else None
+
+    if library in ("line", "area"):
+        x_type = field_type(library, display, "x")
+        if x_type not in ("temporal", "quantitative"):
+            return None
+        return Aggregation(
+            kind="bucket",
+            x=field_name(display["x"]),
+            y=field_name(display["y"]),
+            color=color,
+            temporal=x_type == "temporal",
+        )
+
+    if library == "bar":
+        return Aggregation(
+            kind="top",
+            x=field_name(display["x"]),
+            y=field_name(display["y"]),
+            color=color,
+        )
+
+    if library == "pie":
+        return Aggregation(
+            kind="top",
+            x=field_name(display["label"]),
+            y=field_name(display["value"]),
+        )
+
+    if library == "scatter":
+        if any(
+            field_type(library, display, channel) != "quantitative"
+            for channel in ("x", "y")
+        ):
+            return None
+        return Aggregation(
+            kind="grid",
+            x=field_name(display["x"]),
+            y=field_name(display["y"]),
+            color=color,
+            size=field_name(display["size"]) if "size" in display else None,
+        )
+
+    return None
@@ -0,0 +1,148 @@
+import functools
+import gzip
+import hashlib
+import typing as t
+
+from dataclasses import dataclass
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from datasette.app import Datasette
+
+STATIC_DIR = Path(__file__).parent / "static"
+# Directory of the content-hashed and precompressed assets written at build
+DIST_DIR = STATIC_DIR / "dist"
+ASSETS = (
+    "dashboards.css",
+    "vega.min.js",
+    "vega-lite.min.js",
+    "vega-embed.min.js",
+    "dashboards.js",
+)
+CONTENT_TYPES = {
+    ".css": "text/css; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+}
+# Hexadecimal digits of the SHA-256 digest of the content in asset filenames
+HASH_LENGTH = 12
+# Precompressed variants of the assets, by order of preference
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+ASSETS_PATH = "-/dashboards-assets"
+
+
+def hashed_filename(name: str, content: bytes) -> str:
+    """Filename of an asset with the hash of its content before its
+    extension, e.g. `dashboards.0123456789ab.js`."""
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    stem, _, extension = name.rpartition(".")
+    return f"{stem}.{digest}.{extension}"
+
+
+@dataclass(frozen=True)
+class Asset:
+    """Static asset served under its content-hashed `filename`, with its
+    content in each available encoding."""
+
+    name: str
+    filename: str
+    content_type: str
+    encodings: dict[str, bytes]
+
+
+def compress(content: bytes, encoding: str) -> bytes | None:
+    """Content compressed with an encoding, or None when not available."""
+    if encoding == "gzip":
+        return gzip.compress(content, compresslevel=9, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return t.cast(bytes, brotli.compress(content))
+    return None
+
+
+def load_asset(
+    name: str, static_dir: Path = STATIC_DIR, dist_dir: Path = DIST_DIR
+) -> Asset:
+    """Load an asset with its precompressed variants from `dist_dir`, or
+    compressed in memory when they have not been built.
+
+    Variants are looked up by the content-hashed filename, so that they are
+    never stale.
+    """
+    content = (static_dir / name).read_bytes()
+    filename = hashed_filename(name, content)
+    encodings = {"identity": content}
+    for encoding, suffix in ENCODINGS.items():
+        path = dist_dir / f"{filename}{suffix}"
+        compressed = path.read_bytes() if path.exists() else compress(content, encoding)
+        if compressed is not None:
+            encodings[encoding] = compressed
+    return Asset(
+        name=name,
+        filename=filename,
+        content_type=CONTENT_TYPES[Path(name).suffix],
+        encodings=encodings,
+    )
+
+
+@functools.cache
+def get_assets() -> dict[str, Asset]:
+    """Assets of the plugin by content-hashed filename, loaded once."""
+    assets = (load_asset(name) for name in ASSETS)
+    return {asset.filename: asset for asset in assets}
+
+
+def asset_urls(datasette: "Datasette") -> dict[str, str]:
+    """URLs of the content-hashed assets of the plugin, by asset name."""
+    return {
+        asset.name: datasette.urls.path(f"{ASSETS_PATH}/{filename}")
+        for filename, asset in get_assets().items()
+    }
+
+
+def build_assets(
+    static_dir: Path = STATIC_DIR, dist_dir: Path = DIST_DIR
+) -> list[Path]:
+    """Write the content-hashed assets along with their gzip and, when the
+    `brotli` package is installed, brotli compressed variants to `dist_dir`,
+    removing the ones of previous builds."""
+    dist_dir.mkdir(parents=True, exist_ok=True)
+    written = []
+    for name in ASSETS:
+        asset = load_asset(name, static_dir, dist_dir)
+        written.append(dist_dir / asset.filename)
+        written[-1].write_bytes(asset.encodings["identity"])
+        for encoding, suffix in ENCODINGS.items():
+            if encoding in asset.encodings:
+                written.append(dist_dir / f"{asset.filename}{suffix}")
+                written[-1].write_bytes(asset.encodings[encoding])
+    for path in dist_dir.iterdir():
+        if path not in written:
+            path.unlink()
+    return written
+
+
+def negotiate_encoding(accept_encoding: str, encodings: t.Collection[str]) -> str:
+    """Preferred available encoding accepted by an `Accept-Encoding` header,
+    or `identity`."""
+    qualities: dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        coding, *params = (value.strip() for value in part.split(";"))
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding.lower()] = quality
+    for encoding in ENCODINGS:
+        if encoding in encodings and qualities.get(encoding, qualities.get("*", 0)) > 0:
+            return encoding
+    return "identity"
@@ -0,0 +1,243 @@
+import math
+import typing as t
+
+from dataclasses import dataclass
+from datasette.utils import escape_sqlite
+
+from datasette_dashboards.cache import QueryResults
+from datasette_dashboards.chart_types import BIN_COUNT_FIELD, field_name
+from datasette_dashboards.query import (
+    BoundQuery,
+    QueryRewrite,
+    QueryTemplate,
+    subquery,
+)
+
+DEFAULT_HEATMAP_BINS = 30
+DEFAULT_HISTOGRAM_BINS = 20
+# Maximum number of histogram bins chosen with the Freedman-Diaconis rule
+MAX_AUTO_BINS = 200
+
+
+def _bin_index(column: str, bins: int, low: str, width: str) -> str:
+    index = f"CAST(({column} - {low}) * {bins} / {width} AS INTEGER)"
+    return f"coalesce(min({index}, {bins - 1}), 0)"
+
+
+def heatmap_sql(sql: str, x: str, y: str, x_bins: int, y_bins: int) -> str:
+    """Count the rows of a query in the cells of a `x_bins` by `y_bins` grid
+    spanning the x and y values, returning only non-empty cells.
+
+    Each cell has its x and y bounds in the `x`, `<x>_end`, `y` and `<y>_end`
+    columns, and its number of rows in the `count` column.
+    """
+    x_end, y_end = escape_sqlite(f"{x}_end"), escape_sqlite(f"{y}_end")
+    x, y = escape_sqlite(x), escape_sqlite(y)
+    count = escape_sqlite(BIN_COUNT_FIELD)
+    return f"""WITH _dashboards_data AS (
+{subquery(sql)}
+),
+_dashboards_bounds AS (
+  SELECT
+    min({x}) AS _x_low,
+    coalesce(nullif(max({x}) - min({x}), 0), 1) * 1.0 AS _x_width,
+    min({y}) AS _y_low,
+    coalesce(nullif(max({y}) - min({y}), 0), 1) * 1.0 AS _y_width
+  FROM _dashboards_data
+),
+_dashboards_bins AS (
+  SELECT
+    {_bin_index(x, x_bins, "_x_low", "_x_width")} AS _x_bin,
+    {_bin_index(y, y_bins, "_y_low", "_y_width")} AS _y_bin,
+    count(*) AS _count
+  FROM _dashboards_data, _dashboards_bounds
+  WHERE {x} IS NOT NULL AND {y} IS NOT NULL
+  GROUP BY _x_bin, _y_bin
+)
+SELECT
+  _x_low + _x_bin * _x_width / {x_bins} AS {x},
+  _x_low + (_x_bin + 1) * _x_width / {x_bins} AS {x_end},
+  _y_low + _y_bin * _y_width / {y_bins} AS {y},
+  _y_low + (_y_bin + 1) * _y_width / {y_bins} AS {y_end},
+  _count AS {count}
+FROM _dashboards_bins, _dashboards_bounds
+ORDER BY _x_bin, _y_bin"""
+
+
+def _floor(value: str) -> str:
+    return f"(CAST({value} AS INTEGER) - ({value} < CAST({value} AS INTEGER)))"
+
+
+def histogram_sql(
+    sql: str, x: str, bins: int | None = None, width: float | None = None
+) -> str:
+    """Count the rows of a query in bins of their x values, returning only
+    non-empty bins.
+
+    The bins either split the range of the x values in `bins` bins, or are
+    `width` wide and start at multiples of `width`. Each bin has its bounds
+    in the `x` and `<x>_end` columns, and its number of rows in the `count`
+    column.
+    """
+    x_end = escape_sqlite(f"{x}_end")
+    x = escape_sqlite(x)
+    count = escape_sqlite(BIN_COUNT_FIELD)
+    if width is not None:
+        return f"""WITH _dashboards_data AS (
+{subquery(sql)}
+),
+_dashboards_bins AS (
+  SELECT {_floor(f"({x} * 1.0 / {width!r})")} AS _bin, count(*) AS _count
+  FROM _dashboards_data
+  WHERE {x} IS NOT NULL
+  GROUP BY _bin
+)
+SELECT
+  _bin * {width!r} AS {x},
+  (_bin + 1) * {width!r} AS {x_end},
+  _count AS {count}
+FROM _dashboards_bins
+ORDER BY _bin"""
+
+    bins = bins or DEFAULT_HISTOGRAM_BINS
+    return f"""WITH _dashboards_data AS (
+{subquery(sql)}
+),
+_dashboards_bounds AS (
+  SELECT
+    min({x}) AS _low,
+    coalesce(nullif(max({x}) - min({x}), 0), 1) * 1.0 AS _width
+  FROM _dashboards_data
+),
+_dashboards_bins AS (
+  SELECT {_bin_index(x, bins, "_low", "_width")} AS _bin, count(*) AS _count
+  FROM _dashboards_data, _dashboards_bounds
+  WHERE {x} IS NOT NULL
+  GROUP BY _bin
+)
+SELECT
+  _low + _bin * _width / {bins} AS {x},
+  _low + (_bin + 1) * _width / {bins} AS {x_end},
+  _count AS {count}
+FROM _dashboards_bins, _dashboards_bounds
+ORDER BY _bin"""
+
+
+def histogram_stats_sql(sql: str, x: str) -> str:
+    """Count, minimum, maximum, first and third quartiles of the x values."""
+    x = escape_sqlite(x)
+    values = f"SELECT {x} FROM _dashboards_data WHERE {x} IS NOT NULL ORDER BY {x}"
+    return f"""WITH _dashboards_data AS (
+{subquery(sql)}
+),
+_dashboards_count AS (
+  SELECT count({x}) AS _count, min({x}) AS _low, max({x}) AS _high
+  FROM _dashboards_data
+)
+SELECT
+  _count,
+  _low,
+  _high,
+  ({values} LIMIT 1 OFFSET (SELECT _count FROM _dashboards_count) / 4) AS _q1,
+  ({values} LIMIT 1 OFFSET (SELECT _count FROM _dashboards_count) * 3 / 4) AS _q3
+FROM _dashboards_count"""
+
+
+def freedman_diaconis_bins(
+    count: int, low: float | None, high: float | None, q1: float, q3: float
+) -> int:
+    """Number of bins of width `2 * IQR / count^(1/3)` spanning the values.
+
+    Falls back to Sturges' rule when the interquartile range is empty.
+    """
+    if not count or low is None or high is None or high <= low:
+        return 1
+    iqr = q3 - q1
+    if iqr <= 0:
+        return min(MAX_AUTO_BINS, math.ceil(math.log2(count)) + 1)
+    width = 2 * iqr / math.pow(count, 1 / 3)
+    return max(1, min(MAX_AUTO_BINS, math.ceil((high - low) / width)))
+
+
+@dataclass(frozen=True)
+class HeatmapBinning:
+    x: str
+    y: str
+    x_bins: int = DEFAULT_HEATMAP_BINS
+    y_bins: int = DEFAULT_HEATMAP_BINS
+
+    def stats_query(self, query: BoundQuery) -> BoundQuery | None:
+        return None
+
+    def query(self, query: BoundQuery, stats: QueryResults | None = None) -> BoundQuery:
+        sql = heatmap_sql(query.sql, self.x, self.y, self.x_bins, self.y_bins)
+        return QueryTemplate.parse(sql).bind(query.params)
+
+
+@dataclass(frozen=True)
+class HistogramBinning:
+    """Bins of a fixed `width`, a fixed number of `bins`, or chosen with the
+    Freedman-Diaconis rule when neither are set."""
+
+    x: str
+    bins: int | None = DEFAULT_HISTOGRAM_BINS
+    width: float | None = None
+
+    def stats_query(self, query: BoundQuery) -> BoundQuery | None:
+        if self.bins is not None or self.width is not None:
+            return None
+        sql = histogram_stats_sql(query.sql, self.x)
+        return QueryTemplate.parse(sql).bind(query.params)
+
+    def query(self, query: BoundQuery, stats: QueryResults | None = None) -> BoundQuery:
+        bins = self.bins
+        if bins is None and self.width is None:
+            assert stats is not None
+            bins = freedman_diaconis_bins(*stats.rows[0])
+        sql = histogram_sql(query.sql, self.x, bins, self.width)
+        return QueryTemplate.parse(sql).bind(query.params)
+
+
+def _bins(value: t.Any) -> int:
+    bins = int(value)
+    if bins < 1:
+        raise ValueError("bins must be at least 1")
+    return bins
+
+
+def _histogram_binning(display: dict[str, t.Any]) -> HistogramBinning:
+    x = field_name(display["x"])
+    if "bin_width" in display:
+        width = float(display["bin_width"])
+        if width <= 0:
+            raise ValueError("bin_width must be positive")
+        return HistogramBinning(x=x, bins=None, width=width)
+    bins = display.get("bins", DEFAULT_HISTOGRAM_BINS)
+    if bins == "auto":
+        return HistogramBinning(x=x, bins=None)
+    return HistogramBinning(x=x, bins=_bins(bins))
+
+
+def chart_binning(chart: dict[str, t.Any]) -> QueryRewrite | None:
+    """Binning of the rows of a heatmap or histogram chart query.
+
+    Heatmaps are configured by `display.bins`, a number of bins for both axes
+    or a mapping with `x` and `y` numbers of bins. Histograms are configured
+    by either `display.bin_width`, or `display.bins`: a number of bins or
+    `auto` for the Freedman-Diaconis rule.
+    """
+    library = chart.get("library")
+    display: dict[str, t.Any] = chart.get("display", {})
+    if library == "histogram":
+        return _histogram_binning(display)
+    if library != "heatmap":
+        return None
+    bins = display.get("bins", DEFAULT_HEATMAP_BINS)
+    if not isinstance(bins, dict):
+        bins = {"x": bins, "y": bins}
+    return HeatmapBinning(
+        x=field_name(display["x"]),
+        y=field_name(display["y"]),
+        x_bins=_bins(bins.get("x", DEFAULT_HEATMAP_BINS)),
+        y_bins=_bins(bins.get("y", DEFAULT_HEATMAP_BINS)),
+    )
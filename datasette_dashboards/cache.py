@@ -0,0 +1,520 @@
+import asyncio
+import hashlib
+import json
+import marshal
+import os
+import sqlite3
+import threading
+import time
+import typing as t
+import weakref
+import zlib
+
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from datasette_dashboards.query import BoundQuery
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from datasette.app import Datasette
+    from datasette.database import Database
+
+
+# Maximum number of query results kept in memory per Datasette instance
+DEFAULT_CACHE_SIZE = 512
+# Maximum size in bytes of the compressed query results kept in a cache file
+DEFAULT_DISK_CACHE_BYTES = 64 * 1024 * 1024
+
+CacheKey = tuple[
+    str, str, tuple[bool, ...], tuple[tuple[str, str], ...], bool, tuple[t.Any, ...]
+]
+DataVersion = t.Hashable
+
+_caches: "weakref.WeakKeyDictionary[Datasette, ResultCache]" = (
+    weakref.WeakKeyDictionary()
+)
+_inflights: "weakref.WeakKeyDictionary[Datasette, InflightQueries]" = (
+    weakref.WeakKeyDictionary()
+)
+_disk_caches: dict[str, "DiskResultCache"] = {}
+
+
+@dataclass(frozen=True)
+class QueryResults:
+    columns: tuple[str, ...]
+    rows: list[tuple[t.Any, ...]]
+    truncated: bool
+
+
+class ResultsTransform(t.Protocol):
+    """Post-processing of query results, such as downsampling, applied in a
+    thread before they are cached.
+
+    `key` identifies the transform and its parameters in cache keys.
+    """
+
+    def key(self) -> tuple[t.Any, ...]: ...
+
+    def apply(self, results: QueryResults) -> QueryResults: ...
+
+
+def cache_key(
+    db: str,
+    query: BoundQuery,
+    truncate: bool,
+    transform: ResultsTransform | None = None,
+) -> CacheKey:
+    return (db, *query.key(), truncate, transform.key() if transform else ())
+
+
+def database_version(database: "Database") -> DataVersion | None:
+    """Token changing whenever the content of a database changes.
+
+    For file databases, the modification time and size of the database file
+    and its WAL file are used: unlike `PRAGMA data_version`, which is only
+    meaningful for a single connection, they can be compared across the
+    Datasette read connections pool and cost no query. Immutable databases
+    use their content hash when already known from an inspect file, so that
+    a database replaced on redeploy gets a new version either way. In-memory
+    databases have no known version.
+    """
+    if database.is_memory or database.path is None:
+        return None
+    if not database.is_mutable and (
+        database.cached_hash is not None
+        or database.name in (database.ds.inspect_data or {})
+    ):
+        return t.cast(str, database.hash)
+
+    version: list[tuple[int, int] | None] = []
+    for path in (database.path, f"{database.path}-wal"):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            version.append(None)
+        else:
+            version.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+
+class ResultCache:
+    """In-process LRU cache of query results, with a time-to-live per entry.
+
+    Entries are also tagged with the version of their database, and are
+    invalidated as soon as the database content changes. Expired entries can
+    still be looked up as stale results for `max_stale` seconds, so that they
+    are served while being refreshed.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: OrderedDict[
+            CacheKey, tuple[float, DataVersion | None, QueryResults]
+        ] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(
+        self, key: CacheKey, version: DataVersion | None = None
+    ) -> QueryResults | None:
+        found = self.lookup(key, version)
+        return found[0] if found is not None else None
+
+    def lookup(
+        self, key: CacheKey, version: DataVersion | None = None, max_stale: float = 0
+    ) -> tuple[QueryResults, bool] | None:
+        """Cached results and whether they are stale.
+
+        Expired results are still returned as stale for `max_stale` seconds.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires, entry_version, results = entry
+        if entry_version != version:
+            del self._entries[key]
+            self.invalidations += 1
+            self.misses += 1
+            return None
+        now = time.monotonic()
+        if expires + max_stale <= now:
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        stale = expires <= now
+        if stale:
+            self.stale_hits += 1
+        else:
+            self.hits += 1
+        return results, stale
+
+    async def alookup(
+        self, key: CacheKey, version: DataVersion | None = None, max_stale: float = 0
+    ) -> tuple[QueryResults, bool] | None:
+        return self.lookup(key, version, max_stale)
+
+    async def aset(
+        self,
+        key: CacheKey,
+        results: QueryResults,
+        ttl: float,
+        version: DataVersion | None = None,
+    ) -> None:
+        self.set(key, results, ttl, version)
+
+    def set(
+        self,
+        key: CacheKey,
+        results: QueryResults,
+        ttl: float,
+        version: DataVersion | None = None,
+    ) -> None:
+        self._entries[key] = (time.monotonic() + ttl, version, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class DiskResultCache:
+    """Query results cache stored in a SQLite file, shared between processes.
+
+    It behaves like `ResultCache`, with expiry times based on the wall clock
+    so that they hold across processes and restarts. The least recently used
+    results are evicted once the total size of their payloads, zlib compressed
+    `marshal` dumps, exceeds `max_bytes`. The total size is kept up to date by
+    triggers in the file, so that it is never computed by scanning the cache.
+    As the cache is only an optimization, failing to read or write the file
+    (e.g. while locked by another process) is handled like a miss.
+
+    The file is only opened on first use. Its blocking I/O should be run in a
+    thread, with `alookup` and `aset` from the event loop.
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_DISK_CACHE_BYTES) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.errors = 0
+        self._conn: sqlite3.Connection | None = None
+        # The connection is shared by the threads running the cache I/O
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+        conn = sqlite3.connect(
+            self.path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(
+                """
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS results (
+                  key TEXT PRIMARY KEY, expires REAL NOT NULL,
+                  version TEXT NOT NULL, accessed REAL NOT NULL,
+                  size INTEGER NOT NULL, payload BLOB NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+                CREATE TABLE IF NOT EXISTS totals (bytes INTEGER NOT NULL);
+                INSERT INTO totals
+                  SELECT coalesce(sum(size), 0) FROM results
+                  WHERE NOT EXISTS (SELECT 1 FROM totals);
+                CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results
+                BEGIN UPDATE totals SET bytes = bytes + new.size; END;
+                CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results
+                BEGIN UPDATE totals SET bytes = bytes - old.size; END;
+                COMMIT;
+                """
+            )
+        except BaseException:
+            conn.close()
+            raise
+        # Do not hold a thread for long on a locked cache file
+        conn.execute("PRAGMA busy_timeout = 100")
+        self._conn = conn
+        return conn
+
+    @staticmethod
+    def _digest(key: CacheKey) -> str:
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _version(version: DataVersion | None) -> str:
+        return json.dumps(version, default=str)
+
+    @staticmethod
+    def _try_write(
+        conn: sqlite3.Connection, sql: str, params: t.Sequence[t.Any]
+    ) -> None:
+        """Write made while looking up results, skipped when another process
+        holds the write lock, so that the results read are still served."""
+        try:
+            conn.execute(sql, params)
+        except sqlite3.OperationalError:
+            pass
+
+    def __len__(self) -> int:
+        with self._lock:
+            row = self._connection().execute("SELECT count(*) FROM results")
+            count: int = row.fetchone()[0]
+        return count
+
+    def get(
+        self, key: CacheKey, version: DataVersion | None = None
+    ) -> QueryResults | None:
+        found = self.lookup(key, version)
+        return found[0] if found is not None else None
+
+    async def alookup(
+        self, key: CacheKey, version: DataVersion | None = None, max_stale: float = 0
+    ) -> tuple[QueryResults, bool] | None:
+        return await asyncio.to_thread(self.lookup, key, version, max_stale)
+
+    def lookup(
+        self, key: CacheKey, version: DataVersion | None = None, max_stale: float = 0
+    ) -> tuple[QueryResults, bool] | None:
+        """Cached results and whether they are stale.
+
+        Expired results are still returned as stale for `max_stale` seconds.
+        """
+        digest = self._digest(key)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute(
+                    "SELECT expires, version, payload FROM results WHERE key = ?",
+                    [digest],
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+
+                expires, entry_version, payload = row
+                if entry_version != self._version(version):
+                    self._try_write(conn, "DELETE FROM results WHERE key = ?", [digest])
+                    self.invalidations += 1
+                    self.misses += 1
+                    return None
+                if expires + max_stale <= now:
+                    self._try_write(conn, "DELETE FROM results WHERE key = ?", [digest])
+                    self.misses += 1
+                    return None
+
+                self._try_write(
+                    conn, "UPDATE results SET accessed = ? WHERE key = ?", [now, digest]
+                )
+            columns, rows, truncated = marshal.loads(zlib.decompress(payload))
+        except (sqlite3.Error, zlib.error, EOFError, ValueError, TypeError):
+            self.errors += 1
+            self.misses += 1
+            return None
+
+        stale = expires <= now
+        if stale:
+            self.stale_hits += 1
+        else:
+            self.hits += 1
+        return QueryResults(columns=columns, rows=rows, truncated=truncated), stale
+
+    async def aset(
+        self,
+        key: CacheKey,
+        results: QueryResults,
+        ttl: float,
+        version: DataVersion | None = None,
+    ) -> None:
+        await asyncio.to_thread(self.set, key, results, ttl, version)
+
+    def set(
+        self,
+        key: CacheKey,
+        results: QueryResults,
+        ttl: float,
+        version: DataVersion | None = None,
+    ) -> None:
+        payload = zlib.compress(
+            marshal.dumps((results.columns, results.rows, results.truncated))
+        )
+        digest = self._digest(key)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # Not INSERT OR REPLACE, which skips the delete trigger
+                    conn.execute("DELETE FROM results WHERE key = ?", [digest])
+                    conn.execute(
+                        "INSERT INTO results "
+                        "(key, expires, version, accessed, size, payload) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            digest,
+                            now + ttl,
+                            self._version(version),
+                            now,
+                            len(payload),
+                            payload,
+                        ],
+                    )
+                    self._evict(conn)
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error:
+            self.errors += 1
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        total = conn.execute("SELECT bytes FROM totals").fetchone()[0]
+        excess = total - self.max_bytes
+        if excess <= 0:
+            return
+
+        # Only the least recently used entries are read, following the index
+        evicted = []
+        for digest, size in conn.execute(
+            "SELECT key, size FROM results ORDER BY accessed"
+        ):
+            if excess <= 0:
+                break
+            evicted.append((digest,))
+            excess -= size
+        conn.executemany("DELETE FROM results WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM results")
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            size, total = (
+                self._connection()
+                .execute("SELECT (SELECT count(*) FROM results), bytes FROM totals")
+                .fetchone()
+            )
+        return {
+            "size": size,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "errors": self.errors,
+        }
+
+
+def get_cache(
+    datasette: "Datasette",
+    path: str | None = None,
+    max_bytes: int = DEFAULT_DISK_CACHE_BYTES,
+) -> "ResultCache | DiskResultCache":
+    """Results cache of a Datasette instance, or the cache file at `path`.
+
+    A cache file is opened once per process and shared by all instances.
+    """
+    if path is not None:
+        path = os.path.abspath(path)
+        disk_cache = _disk_caches.get(path)
+        if disk_cache is None:
+            disk_cache = DiskResultCache(path, max_bytes)
+            _disk_caches[path] = disk_cache
+        disk_cache.max_bytes = max_bytes
+        return disk_cache
+
+    cache = _caches.get(datasette)
+    if cache is None:
+        cache = ResultCache()
+        _caches[datasette] = cache
+    return cache
+
+
+class InflightQueries:
+    """Single-flight execution of identical concurrent queries.
+
+    A query requested while the same query (same database, SQL, parameters
+    and truncation) is already running waits for the running execution
+    instead of starting another one, all waiters getting the same results
+    or the same error.
+    """
+
+    def __init__(self) -> None:
+        self.executions = 0
+        self.coalesced = 0
+        self._futures: dict[CacheKey, asyncio.Future[QueryResults]] = {}
+
+    def __len__(self) -> int:
+        return len(self._futures)
+
+    def __contains__(self, key: CacheKey) -> bool:
+        return key in self._futures
+
+    async def run(
+        self, key: CacheKey, execute: t.Callable[[], t.Awaitable[QueryResults]]
+    ) -> QueryResults:
+        future = self._futures.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.executions += 1
+            future = asyncio.ensure_future(execute())
+            self._futures[key] = future
+            future.add_done_callback(lambda done: self._done(key, done))
+        # Cancelling a waiter must not cancel the execution shared with others
+        return await asyncio.shield(future)
+
+    def _done(self, key: CacheKey, future: "asyncio.Future[QueryResults]") -> None:
+        if self._futures.get(key) is future:
+            del self._futures[key]
+        if not future.cancelled():
+            # Mark the error as retrieved when all waiters were cancelled
+            future.exception()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "inflight": len(self._futures),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+        }
+
+
+def get_inflight(datasette: "Datasette") -> InflightQueries:
+    inflight = _inflights.get(datasette)
+    if inflight is None:
+        inflight = InflightQueries()
+        _inflights[datasette] = inflight
+    return inflight
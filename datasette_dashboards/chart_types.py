@@ -1,7 +1,20 @@
 import copy
 import typing as t
 
-CHART_TYPES = {"line", "bar", "area", "scatter", "pie", "choropleth", "wordcloud"}
+CHART_TYPES = {
+    "line",
+    "bar",
+    "area",
+    "scatter",
+    "heatmap",
+    "histogram",
+    "pie",
+    "choropleth",
+    "wordcloud",
+}
+
+# Column of the number of rows per bin in heatmap and histogram query results
+BIN_COUNT_FIELD = "count"
 
 # Default field types per chart type for x and y axes
 _DEFAULT_TYPES: dict[str, dict[str, str]] = {
@@ -36,6 +49,19 @@ def _normalize_field(
     return result
 
 
+def field_name(value: t.Union[str, dict[str, t.Any]]) -> str:
+    """Name of the query column used by a field spec."""
+    return value if isinstance(value, str) else str(value["field"])
+
+
+def field_type(library: str, display: dict[str, t.Any], channel: str) -> str:
+    """Vega-Lite type of the x or y field of a line, area, bar or scatter chart."""
+    value = display[channel]
+    if isinstance(value, dict) and "type" in value:
+        return str(value["type"])
+    return str(display.get(f"{channel}type", _DEFAULT_TYPES[library][channel]))
+
+
 def _apply_color_highlight(
     display: dict[str, t.Any],
     encoding: dict[str, t.Any],
@@ -149,6 +175,60 @@ def _convert_scatter(display: dict[str, t.Any]) -> dict[str, t.Any]:
     return result
 
 
+def _convert_heatmap(display: dict[str, t.Any]) -> dict[str, t.Any]:
+    """Convert a high-level heatmap spec to Vega-Lite.
+
+    The chart query rows are counted in bins on the server, returning the
+    bounds of each non-empty cell (`<x>`, `<x>_end`, `<y>`, `<y>_end`) and its
+    number of rows (`count`), drawn as rectangles.
+
+    Optional:
+      - bins: number of bins per axis, or {"x": ..., "y": ...} (default: 30)
+      - color_scheme: Vega color scheme name (default "blues")
+    """
+    x = _normalize_field(display["x"], "quantitative")
+    y = _normalize_field(display["y"], "quantitative")
+    color_scheme = display.get("color_scheme", "blues")
+
+    return {
+        "mark": {"type": "rect", "tooltip": True},
+        "encoding": {
+            "x": {**x, "bin": {"binned": True}},
+            "x2": {"field": f"{x['field']}_end"},
+            "y": {**y, "bin": {"binned": True}},
+            "y2": {"field": f"{y['field']}_end"},
+            "color": {
+                "field": BIN_COUNT_FIELD,
+                "type": "quantitative",
+                "scale": {"scheme": color_scheme},
+            },
+        },
+    }
+
+
+def _convert_histogram(display: dict[str, t.Any]) -> dict[str, t.Any]:
+    """Convert a high-level histogram spec to Vega-Lite.
+
+    The chart query rows are counted in bins on the server, returning the
+    bounds of each non-empty bin (`<x>`, `<x>_end`) and its number of rows
+    (`count`), drawn as bars.
+
+    Optional:
+      - bins: number of bins, or "auto" for the Freedman-Diaconis rule (default: 20)
+      - bin_width: width of the bins, starting at multiples of it
+    """
+    x = _normalize_field(display["x"], "quantitative")
+
+    return {
+        "mark": {"type": "bar", "tooltip": True},
+        "encoding": {
+            "x": {**x, "bin": {"binned": True}},
+            "x2": {"field": f"{x['field']}_end"},
+            "y": {"field": BIN_COUNT_FIELD, "type": "quantitative"},
+        },
+    }
+
+
 def _convert_pie(display: dict[str, t.Any]) -> dict[str, t.Any]:
     """Convert a high-level pie chart spec to Vega-Lite.
 
@@ -302,6 +382,8 @@ _CONVERTERS: dict[str, t.Callable[[dict[str, t.Any]], dict[str, t.Any]]] = {
     "area": _convert_area,
     "bar": _convert_bar,
     "scatter": _convert_scatter,
+    "heatmap": _convert_heatmap,
+    "histogram": _convert_histogram,
     "pie": _convert_pie,
     "choropleth": _convert_choropleth,
     "wordcloud": _convert_wordcloud,
@@ -0,0 +1,147 @@
+import email.utils
+import hashlib
+import json
+import os
+import typing as t
+
+from importlib.metadata import PackageNotFoundError, version
+from datasette.utils.asgi import Request
+from datasette.version import __version__ as datasette_version
+
+from datasette_dashboards.cache import database_version
+from datasette_dashboards.registry import PLUGIN_NAME, CompiledDashboard
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from datasette.app import Datasette
+
+
+try:
+    PLUGIN_VERSION = version(PLUGIN_NAME)
+except PackageNotFoundError:  # pragma: no cover
+    PLUGIN_VERSION = ""
+
+
+def dashboard_databases(dashboard: CompiledDashboard) -> frozenset[str]:
+    """Databases queried by the charts and dynamic filters of a dashboard."""
+    return dashboard.databases | {
+        dashboard.filters[key]["db"] for key in dashboard.filter_templates
+    }
+
+
+def dashboard_etag(
+    request: Request,
+    datasette: "Datasette",
+    dashboard: CompiledDashboard,
+    databases: t.Iterable[str],
+    options: dict[str, str],
+    *extra: t.Any,
+) -> str | None:
+    """Strong ETag of a dashboard response, computed without running queries.
+
+    It changes with the dashboard configuration, the filter values, the actor
+    (for permissions and menus), the plugin and Datasette versions, and the
+    content of the databases. No ETag is available when one of the databases
+    has no known version (in-memory databases).
+    """
+    versions = {}
+    for db in sorted(databases):
+        version = database_version(datasette.get_database(db))
+        if version is None:
+            return None
+        versions[db] = version
+
+    fingerprint = json.dumps(
+        [
+            PLUGIN_VERSION,
+            datasette_version,
+            dashboard.config_hash,
+            request.actor,
+            sorted(options.items()),
+            versions,
+            extra,
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return f'"{hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()}"'
+
+
+def dashboard_last_modified(
+    datasette: "Datasette", dashboard: CompiledDashboard, databases: t.Iterable[str]
+) -> float | None:
+    """Latest modification time of the dashboard databases.
+
+    The dashboard configuration is not taken into account, as it has no
+    modification time shared by all the Datasette processes: its changes
+    are caught by the `ETag`.
+    """
+    modified = []
+    for db in databases:
+        database = datasette.get_database(db)
+        if database.is_memory or database.path is None:
+            return None
+        for path in (database.path, f"{database.path}-wal"):
+            try:
+                modified.append(os.stat(path).st_mtime)
+            except FileNotFoundError:
+                pass
+    return max(modified, default=None)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def not_modified(
+    request: Request, etag: str | None, last_modified: float | None
+) -> bool:
+    """Whether the conditional request validators match the current response.
+
+    `If-None-Match` takes precedence over `If-Modified-Since`, which is only
+    compared with a one second precision.
+    """
+    if "if-none-match" in request.headers:
+        return etag is not None and etag_matches(request, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return int(last_modified) <= since
+
+
+def cache_control(request: Request, settings: dict[str, t.Any]) -> str:
+    max_age = int(settings.get("max_age", 0))
+    stale_while_revalidate = int(settings.get("stale_while_revalidate", 0))
+
+    directives = ["private"] if request.actor else []
+    if max_age > 0:
+        directives.append(f"max-age={max_age}")
+    else:
+        directives.append("no-cache")
+    if stale_while_revalidate > 0:
+        directives.append(f"stale-while-revalidate={stale_while_revalidate}")
+    return ", ".join(directives)
+
+
+def caching_headers(
+    request: Request,
+    settings: dict[str, t.Any],
+    etag: str | None,
+    last_modified: float | None,
+) -> dict[str, str]:
+    # Responses differ by actor, so that shared caches must not serve the
+    # anonymous ones to logged in users
+    headers = {"Cache-Control": cache_control(request, settings), "Vary": "Cookie"}
+    if etag is not None:
+        headers["ETag"] = etag
+    if last_modified is not None:
+        headers["Last-Modified"] = email.utils.formatdate(last_modified, usegmt=True)
+    return headers
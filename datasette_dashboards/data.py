@@ -0,0 +1,316 @@
+import asyncio
+import math
+import typing as t
+
+from datasette.utils import sqlite3
+from datasette.database import QueryInterrupted
+
+from datasette_dashboards.cache import (
+    DEFAULT_DISK_CACHE_BYTES,
+    CacheKey,
+    DataVersion,
+    DiskResultCache,
+    InflightQueries,
+    QueryResults,
+    ResultCache,
+    ResultsTransform,
+    cache_key,
+    database_version,
+    get_cache,
+    get_inflight,
+)
+from datasette_dashboards.encoding import encode_columns
+from datasette_dashboards.maps import Viewport, rtree_columns
+from datasette_dashboards.query import BoundQuery, QueryTemplate
+from datasette_dashboards.registry import CompiledChart, CompiledDashboard
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from datasette.app import Datasette
+
+
+T = t.TypeVar("T")
+
+# Shapes of the chart results: one object per row, or one array per column
+DATA_SHAPES = ("objects", "columns")
+
+_refresh_tasks: "set[asyncio.Future[None]]" = set()
+
+
+def query_concurrency(datasette: "Datasette", dashboard: CompiledDashboard) -> int:
+    """Maximum number of queries of a dashboard running at once per database.
+
+    Defaults to the number of Datasette SQL threads, as more concurrent
+    queries would only wait for a free thread.
+    """
+    concurrency = dashboard.settings.get("query_concurrency")
+    if concurrency is None:
+        concurrency = datasette.setting("num_sql_threads")
+    return max(1, int(concurrency))
+
+
+async def gather_by_database(
+    jobs: t.Sequence[tuple[str, t.Awaitable[T]]], concurrency: int
+) -> list[T]:
+    """Await all jobs concurrently, with at most `concurrency` per database."""
+    semaphores = {db: asyncio.Semaphore(concurrency) for db, _ in jobs}
+
+    async def run(db: str, job: t.Awaitable[T]) -> T:
+        async with semaphores[db]:
+            return await job
+
+    return list(await asyncio.gather(*(run(db, job) for db, job in jobs)))
+
+
+async def execute_query(
+    datasette: "Datasette",
+    db: str,
+    query: BoundQuery,
+    truncate: bool = False,
+    cache_ttl: float = 0,
+    cache_max_stale: float = 0,
+    cache_path: str | None = None,
+    cache_max_bytes: int = DEFAULT_DISK_CACHE_BYTES,
+    refresh: bool = False,
+    transform: ResultsTransform | None = None,
+) -> QueryResults:
+    """Execute a query, serving it from the results cache when `cache_ttl` is set.
+
+    Cached results are only served while their database has not changed.
+    Expired results are still served for `cache_max_stale` seconds while
+    they are refreshed in the background. Results are cached in the file at
+    `cache_path` when set, shared with other processes. With `refresh`, the
+    query is executed and cached again even if cached results are available.
+    Identical queries running at the same time share a single execution.
+    The results are passed through `transform` in a thread before being
+    cached.
+    """
+    cache = None
+    version = None
+    if cache_ttl > 0:
+        cache = get_cache(datasette, cache_path, cache_max_bytes)
+        version = database_version(datasette.get_database(db))
+        if version is None and (math.isinf(cache_ttl) or cache_path is not None):
+            # Nothing would ever invalidate the cached results, or they would
+            # be shared with processes having their own in-memory databases
+            cache = None
+
+    async def execute() -> QueryResults:
+        results = await datasette.execute(
+            db, query.sql, params=query.params, truncate=truncate
+        )
+        query_results = QueryResults(
+            columns=tuple(col[0] for col in results.description or ()),
+            rows=[tuple(row) for row in results.rows],
+            truncated=results.truncated,
+        )
+        if transform is not None:
+            # Transforms go through all the rows, off the event loop
+            query_results = await asyncio.to_thread(transform.apply, query_results)
+        return query_results
+
+    key = cache_key(db, query, truncate, transform)
+    inflight = get_inflight(datasette)
+    if cache is not None and not refresh:
+        found = await cache.alookup(key, version, cache_max_stale)
+        if found is not None:
+            cached, stale = found
+            if stale and key not in inflight:
+                refresh_in_background(
+                    refresh_query(inflight, cache, key, execute, cache_ttl, version)
+                )
+            return cached
+
+    query_results = await inflight.run(key, execute)
+    if cache is not None:
+        await cache.aset(key, query_results, cache_ttl, version)
+    return query_results
+
+
+async def refresh_query(
+    inflight: InflightQueries,
+    cache: ResultCache | DiskResultCache,
+    key: CacheKey,
+    execute: t.Callable[[], t.Awaitable[QueryResults]],
+    cache_ttl: float,
+    version: DataVersion | None,
+) -> None:
+    try:
+        results = await inflight.run(key, execute)
+    except (sqlite3.DatabaseError, QueryInterrupted):
+        # Stale results keep being served until they are too old
+        return
+    await cache.aset(key, results, cache_ttl, version)
+
+
+def refresh_in_background(refresh: t.Coroutine[t.Any, t.Any, None]) -> None:
+    # Keep a reference to the running tasks, the event loop only has weak ones
+    task = asyncio.ensure_future(refresh)
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+def has_data(chart: CompiledChart) -> bool:
+    return chart.error is None and chart.template is not None and "db" in chart.spec
+
+
+async def fetch_chart_data(
+    datasette: "Datasette",
+    chart: CompiledChart,
+    options: dict[str, str],
+    refresh: bool = False,
+    viewport: Viewport | None = None,
+    shape: str = "objects",
+) -> dict[str, t.Any]:
+    """Run a chart query and shape its results like the Datasette JSON API.
+
+    Results of charts having a transform, such as downsampling, are not
+    truncated: the transform is applied to all the rows instead. Truncated
+    results of charts having an aggregation are replaced by the results of
+    the aggregated query, fitting within `max_returned_rows`. Charts having
+    a query rewrite, such as binning, run their rewritten query instead,
+    after its statistics query if any. Map charts only get the points within
+    the bounding box of the `viewport`, clustered for its zoom level if set
+    up, using an R*Tree index when available. With the `columns` shape, rows
+    are replaced by the encoded `values` of each column.
+    """
+    assert chart.template is not None
+    query = chart.template.bind(options)
+    viewport = viewport or Viewport()
+    map_query = chart.map_query
+    if map_query is not None:
+        rtree = None
+        if viewport.bbox is not None and map_query.rtree_table is not None:
+            rtree = await rtree_columns(
+                datasette, chart.spec["db"], map_query.rtree_table
+            )
+        query = map_query.query(query, viewport, rtree)
+
+    async def run(
+        query: BoundQuery, transform: ResultsTransform | None
+    ) -> QueryResults:
+        return await execute_query(
+            datasette,
+            chart.spec["db"],
+            query,
+            truncate=transform is None,
+            cache_ttl=chart.cache_ttl,
+            cache_max_stale=chart.cache_max_stale,
+            cache_path=chart.cache_path,
+            cache_max_bytes=chart.cache_max_bytes,
+            refresh=refresh,
+            transform=transform,
+        )
+
+    try:
+        if chart.rewrite is not None:
+            stats_query = chart.rewrite.stats_query(query)
+            stats = await run(stats_query, None) if stats_query else None
+            query = chart.rewrite.query(query, stats)
+        results = await run(query, chart.transform)
+    except (sqlite3.DatabaseError, QueryInterrupted) as e:
+        return {"ok": False, "error": str(e)}
+
+    aggregated = False
+    if results.truncated and chart.aggregation is not None:
+        limit = datasette.setting("max_returned_rows")
+        try:
+            results = await run(chart.aggregation.query(query, limit), None)
+            aggregated = True
+        except (sqlite3.DatabaseError, QueryInterrupted):
+            # Fall back to the truncated results
+            pass
+
+    columns = list(results.columns)
+    payload: dict[str, t.Any] = {"ok": True, "columns": columns}
+    if shape == "columns":
+        payload["values"] = encode_columns(results)
+    else:
+        payload["rows"] = [dict(zip(columns, row)) for row in results.rows]
+    payload["truncated"] = results.truncated
+    if aggregated:
+        payload["aggregated"] = True
+    if map_query is not None:
+        payload["zoom"] = viewport.zoom
+        if map_query.clusters(viewport):
+            payload["clustered"] = True
+    return payload
+
+
+async def fetch_filter_options(
+    datasette: "Datasette",
+    flt: dict[str, t.Any],
+    template: QueryTemplate,
+    options: dict[str, str],
+    cache_ttl: float = 0,
+    cache_max_stale: float = 0,
+    cache_path: str | None = None,
+    cache_max_bytes: int = DEFAULT_DISK_CACHE_BYTES,
+    refresh: bool = False,
+) -> list[t.Any]:
+    results = await execute_query(
+        datasette,
+        flt["db"],
+        template.bind(options),
+        cache_ttl=cache_ttl,
+        cache_max_stale=cache_max_stale,
+        cache_path=cache_path,
+        cache_max_bytes=cache_max_bytes,
+        refresh=refresh,
+    )
+    return [row[0] for row in results.rows]
+
+
+async def fill_dynamic_filters(
+    datasette: "Datasette", dashboard: CompiledDashboard, options: dict[str, str]
+) -> dict[str, dict[str, t.Any]]:
+    dynamic = [
+        (key, dashboard.filters[key], template)
+        for key, template in dashboard.filter_templates.items()
+    ]
+    values = await gather_by_database(
+        [
+            (
+                flt["db"],
+                fetch_filter_options(
+                    datasette,
+                    flt,
+                    template,
+                    options,
+                    dashboard.cache_ttl,
+                    dashboard.cache_max_stale,
+                    dashboard.cache_path,
+                    dashboard.cache_max_bytes,
+                ),
+            )
+            for _, flt, template in dynamic
+        ],
+        query_concurrency(datasette, dashboard),
+    )
+    filters = dict(dashboard.filters)
+    for (key, flt, _), options_values in zip(dynamic, values):
+        filters[key] = dict(flt, options=options_values)
+    return filters
+
+
+async def fetch_dashboard_data(
+    datasette: "Datasette",
+    dashboard: CompiledDashboard,
+    charts: t.Iterable[CompiledChart],
+    options: dict[str, str],
+    viewport: Viewport | None = None,
+    shape: str = "objects",
+) -> dict[str, dict[str, t.Any]]:
+    charts = [chart for chart in charts if has_data(chart)]
+    payloads = await gather_by_database(
+        [
+            (
+                chart.spec["db"],
+                fetch_chart_data(
+                    datasette, chart, options, viewport=viewport, shape=shape
+                ),
+            )
+            for chart in charts
+        ],
+        query_concurrency(datasette, dashboard),
+    )
+    return {chart.slug: payload for chart, payload in zip(charts, payloads)}
@@ -0,0 +1,220 @@
+import datetime
+import math
+import typing as t
+
+from dataclasses import dataclass, replace
+
+from datasette_dashboards.cache import QueryResults
+from datasette_dashboards.chart_types import field_name
+
+# Chart types whose series can be downsampled
+DOWNSAMPLE_CHART_TYPES = {"line", "area"}
+DOWNSAMPLE_METHODS = ("lttb", "m4")
+DEFAULT_DOWNSAMPLE_POINTS = 1000
+# Fewest points keeping the first, last, lowest and highest points of a series
+MIN_DOWNSAMPLE_POINTS = 4
+
+
+def _to_number(value: t.Any) -> float | None:
+    """Numeric position of an x or y value, parsing ISO 8601 dates and times.
+
+    A trailing `Z` designates UTC, which `datetime.fromisoformat` only parses
+    since Python 3.11.
+    """
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        if value[-1:] in ("Z", "z"):
+            value = value[:-1] + "+00:00"
+        try:
+            return datetime.datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def lttb(xs: t.Sequence[float], ys: t.Sequence[float], points: int) -> list[int]:
+    """Indexes of the points kept by the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and last points are always kept. Points in between are split in
+    `points - 2` buckets, keeping from each bucket the point forming the
+    largest triangle with the previously kept point and the average of the
+    next bucket, which preserves the visual shape of the series.
+    """
+    n = len(xs)
+    if points >= n or points < 3:
+        return list(range(n))
+
+    every = (n - 2) / (points - 2)
+    kept = [0]
+    a = 0
+    for i in range(points - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_start = end
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = math.fsum(xs[next_start:next_end]) / (next_end - next_start)
+        avg_y = math.fsum(ys[next_start:next_end]) / (next_end - next_start)
+
+        largest = -1.0
+        selected = start
+        for j in range(start, end):
+            area = abs(
+                (xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a])
+            )
+            if area > largest:
+                largest = area
+                selected = j
+        kept.append(selected)
+        a = selected
+    kept.append(n - 1)
+    return kept
+
+
+def m4(xs: t.Sequence[float], ys: t.Sequence[float], points: int) -> list[int]:
+    """Indexes of the points kept by the M4 algorithm.
+
+    The x range is split in `points // 4` buckets of equal width, keeping from
+    each bucket its first, last, lowest and highest points, so that the
+    extremes of the series are always drawn.
+    """
+    n = len(xs)
+    if points >= n or points < MIN_DOWNSAMPLE_POINTS:
+        return list(range(n))
+
+    buckets = points // 4
+    low, high = xs[0], xs[-1]
+    width = (high - low) / buckets or 1.0
+
+    kept: set[int] = set()
+    bucket_indexes: list[int] = []
+    current = None
+    for i, x in enumerate(xs):
+        bucket = min(int((x - low) / width), buckets - 1)
+        if bucket != current and bucket_indexes:
+            kept.update(_m4_bucket(ys, bucket_indexes))
+            bucket_indexes = []
+        current = bucket
+        bucket_indexes.append(i)
+    if bucket_indexes:
+        kept.update(_m4_bucket(ys, bucket_indexes))
+    return sorted(kept)
+
+
+def _m4_bucket(ys: t.Sequence[float], indexes: list[int]) -> tuple[int, ...]:
+    lowest = min(indexes, key=lambda i: ys[i])
+    highest = max(indexes, key=lambda i: ys[i])
+    return (indexes[0], indexes[-1], lowest, highest)
+
+
+_METHODS: dict[
+    str, t.Callable[[t.Sequence[float], t.Sequence[float], int], list[int]]
+] = {
+    "lttb": lttb,
+    "m4": m4,
+}
+
+
+def downsample_series(
+    xs: t.Sequence[t.Any], ys: t.Sequence[t.Any], points: int, method: str = "lttb"
+) -> list[int]:
+    """Indexes of the points to keep from a series, in x order.
+
+    Dates and times x values are compared as timestamps. Series with x values
+    which are not numbers, dates or times are downsampled in their original
+    order. Points without a numeric y value are never kept.
+    """
+    order = [i for i, y in enumerate(ys) if _to_number(y) is not None]
+    numeric_xs = [_to_number(xs[i]) for i in order]
+    if all(x is not None for x in numeric_xs):
+        positions = sorted(
+            range(len(order)), key=lambda p: t.cast(float, numeric_xs[p])
+        )
+        order = [order[p] for p in positions]
+        sorted_xs = [t.cast(float, numeric_xs[p]) for p in positions]
+    else:
+        sorted_xs = [float(p) for p in range(len(order))]
+    sorted_ys = [t.cast(float, _to_number(ys[i])) for i in order]
+    return [order[p] for p in _METHODS[method](sorted_xs, sorted_ys, points)]
+
+
+@dataclass(frozen=True)
+class Downsampling:
+    """Reduce each series of a line or area chart to about `points` points.
+
+    Rows are split in series by the values of the `color` field, if any.
+    """
+
+    method: str
+    points: int
+    x: str
+    y: str
+    color: str | None = None
+
+    def key(self) -> tuple[t.Any, ...]:
+        return ("downsample", self.method, self.points, self.x, self.y, self.color)
+
+    def apply(self, results: QueryResults) -> QueryResults:
+        columns = results.columns
+        if self.x not in columns or self.y not in columns:
+            return results
+        if self.color is not None and self.color not in columns:
+            return results
+        x = columns.index(self.x)
+        y = columns.index(self.y)
+        color = columns.index(self.color) if self.color is not None else None
+
+        series: dict[t.Any, list[int]] = {}
+        for i, row in enumerate(results.rows):
+            group = row[color] if color is not None else None
+            series.setdefault(group, []).append(i)
+
+        kept: list[int] = []
+        for indexes in series.values():
+            rows = [results.rows[i] for i in indexes]
+            selected = downsample_series(
+                [row[x] for row in rows],
+                [row[y] for row in rows],
+                self.points,
+                self.method,
+            )
+            kept += [indexes[i] for i in selected]
+
+        return replace(results, rows=[results.rows[i] for i in sorted(kept)])
+
+
+def chart_downsampling(chart: dict[str, t.Any]) -> Downsampling | None:
+    """Downsampling configured by the `display.downsample` option of a line or
+    area chart, either a number of points per series or a mapping with
+    `points` and `method` keys."""
+    if chart.get("library") not in DOWNSAMPLE_CHART_TYPES:
+        return None
+    display: dict[str, t.Any] = chart.get("display", {})
+    config = display.get("downsample")
+    if config is None or config is False:
+        return None
+    if not isinstance(config, dict):
+        config = {"points": config}
+
+    method = config.get("method", "lttb")
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(
+            "downsample method must be one of: " + ", ".join(DOWNSAMPLE_METHODS)
+        )
+    points = int(config.get("points", DEFAULT_DOWNSAMPLE_POINTS))
+    if points < MIN_DOWNSAMPLE_POINTS:
+        raise ValueError(f"downsample points must be at least {MIN_DOWNSAMPLE_POINTS}")
+
+    return Downsampling(
+        method=method,
+        points=points,
+        x=field_name(display["x"]),
+        y=field_name(display["y"]),
+        color=field_name(display["color"]) if "color" in display else None,
+    )
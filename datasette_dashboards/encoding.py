@@ -0,0 +1,34 @@
+import typing as t
+
+from datasette_dashboards.cache import QueryResults
+
+# Fewest rows for which string columns are dictionary encoded
+DICTIONARY_MIN_ROWS = 16
+
+
+def low_cardinality(values: t.Sequence[t.Any], distinct: int) -> bool:
+    """Whether a column has at most half as many `distinct` values as rows,
+    and is worth dictionary encoding."""
+    return len(values) >= DICTIONARY_MIN_ROWS and distinct * 2 <= len(values)
+
+
+def encode_column(values: list[t.Any]) -> list[t.Any] | dict[str, list[t.Any]]:
+    """Values of a column, dictionary encoded when they are strings of low
+    cardinality: each distinct value is only listed once in `dictionary`, and
+    rows have its position in `indexes`."""
+    if len(values) < DICTIONARY_MIN_ROWS:
+        return values
+    if not all(value is None or isinstance(value, str) for value in values):
+        return values
+    positions: dict[str | None, int] = {}
+    indexes = [positions.setdefault(value, len(positions)) for value in values]
+    if not low_cardinality(values, len(positions)):
+        return values
+    return {"dictionary": list(positions), "indexes": indexes}
+
+
+def encode_columns(results: QueryResults) -> list[t.Any]:
+    """Values of each column of query results."""
+    if not results.rows:
+        return [[] for _ in results.columns]
+    return [encode_column(list(values)) for values in zip(*results.rows)]
@@ -0,0 +1,289 @@
+import math
+import typing as t
+
+from dataclasses import dataclass
+from datasette.utils import escape_sqlite, sqlite3
+
+from datasette_dashboards.query import BoundQuery, QueryTemplate, subquery
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from datasette.app import Datasette
+
+DEFAULT_LATITUDE_COLUMN = "latitude"
+DEFAULT_LONGITUDE_COLUMN = "longitude"
+# Radius in pixels of the area grouped into a cluster, as Leaflet.markercluster
+DEFAULT_CLUSTER_RADIUS = 80
+# Zoom levels beyond which markers are no longer clustered
+DEFAULT_CLUSTER_MAX_ZOOM = 16
+DEFAULT_RTREE_ID_COLUMN = "id"
+MAX_ZOOM = 22
+# Size in pixels of the web map tiles
+TILE_SIZE = 256
+# Latitudes beyond which the Web Mercator projection is not defined
+MAX_LATITUDE = 85.0511287798
+
+MERCATOR_Y_FUNCTION = "dashboards_mercator_y"
+# Columns of the clustered rows, besides the columns of the chart query
+CLUSTER_COLUMNS = (
+    "_count",
+    "_latitude",
+    "_longitude",
+    "_south",
+    "_west",
+    "_north",
+    "_east",
+)
+
+
+def mercator_y(latitude: t.Any) -> float | None:
+    """Web Mercator y position of a latitude, from 0 at the north edge of
+    the map to 1 at its south edge."""
+    if isinstance(latitude, str):
+        try:
+            latitude = float(latitude)
+        except ValueError:
+            return None
+    if not isinstance(latitude, (int, float)):
+        return None
+    lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude)))
+    return (1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2
+
+
+def register_functions(conn: sqlite3.Connection) -> None:
+    """Register the SQL functions used by the map queries on a connection."""
+    conn.create_function(MERCATOR_Y_FUNCTION, 1, mercator_y, deterministic=True)
+
+
+def cluster_sql(sql: str, latitude: str, longitude: str, zoom: int, radius: int) -> str:
+    """Group the points of a query into the cells of a grid of `radius` pixels
+    wide squares of the Web Mercator map at `zoom`, largest clusters first.
+
+    Each cluster has the columns of one of its rows, along with its number of
+    points in `_count`, their average position in `_latitude` and
+    `_longitude`, and their bounds in `_south`, `_west`, `_north` and
+    `_east`. Clusters of a single point have the columns of that point.
+    """
+    lat, lng = escape_sqlite(latitude), escape_sqlite(longitude)
+    scale = TILE_SIZE * 2**zoom / radius
+    return f"""WITH _dashboards_data AS (
+{subquery(sql)}
+)
+SELECT
+  *,
+  count(*) AS _count,
+  avg({lat}) AS _latitude,
+  avg({lng}) AS _longitude,
+  min({lat}) AS _south,
+  min({lng}) AS _west,
+  max({lat}) AS _north,
+  max({lng}) AS _east
+FROM _dashboards_data
+WHERE {lat} IS NOT NULL AND {lng} IS NOT NULL
+GROUP BY
+  CAST(({lng} + 180) / 360.0 * {scale!r} AS INTEGER),
+  CAST({MERCATOR_Y_FUNCTION}({lat}) * {scale!r} AS INTEGER)
+ORDER BY _count DESC"""
+
+
+def _longitude_ranges(west: float, east: float) -> list[tuple[float, float]]:
+    """Longitude ranges between `west` and `east`, split in two when they
+    cross the antimeridian."""
+    if east - west >= 360:
+        return [(-180.0, 180.0)]
+    width = east - west
+    west = (west + 180) % 360 - 180
+    east = west + width
+    if east <= 180:
+        return [(west, east)]
+    return [(west, 180.0), (-180.0, east - 360)]
+
+
+def window_sql(
+    sql: str,
+    latitude: str,
+    longitude: str,
+    bbox: tuple[float, float, float, float],
+    rtree: tuple[str, str, t.Sequence[str]] | None = None,
+) -> str:
+    """Keep the points of a query within a `(west, south, east, north)`
+    bounding box.
+
+    With `rtree`, a `(table, id_column, rtree_columns)` tuple, points are
+    looked up in the R*Tree index table of their bounding boxes, whose id
+    matches the `id_column` of the query.
+    """
+    west, south, east, north = bbox
+    ranges = _longitude_ranges(west, east)
+    if rtree is not None:
+        table, id_column, columns = rtree
+        rtree_id, min_x, max_x, min_y, max_y = map(escape_sqlite, columns)
+        boxes = " OR ".join(
+            f"({min_x} <= {high!r} AND {max_x} >= {low!r})" for low, high in ranges
+        )
+        predicate = f"""{escape_sqlite(id_column)} IN (
+  SELECT {rtree_id} FROM {escape_sqlite(table)}
+  WHERE {min_y} <= {north!r} AND {max_y} >= {south!r} AND ({boxes})
+)"""
+    else:
+        lat, lng = escape_sqlite(latitude), escape_sqlite(longitude)
+        boxes = " OR ".join(
+            f"{lng} BETWEEN {low!r} AND {high!r}" for low, high in ranges
+        )
+        predicate = f"{lat} BETWEEN {south!r} AND {north!r} AND ({boxes})"
+    return f"""WITH _dashboards_data AS (
+{subquery(sql)}
+)
+SELECT * FROM _dashboards_data
+WHERE {predicate}"""
+
+
+@dataclass(frozen=True)
+class Viewport:
+    """Visible area of a map chart in the browser, with its bounding box as
+    `(west, south, east, north)` when known."""
+
+    zoom: int = 0
+    bbox: tuple[float, float, float, float] | None = None
+
+
+def snap_bbox(
+    bbox: tuple[float, float, float, float], zoom: int
+) -> tuple[float, float, float, float]:
+    """Grow a bounding box to a grid of about the size of the map tiles at
+    `zoom`, so that close viewports share the same queries."""
+    step_x, step_y = 360 / 2**zoom, 180 / 2**zoom
+    west, south, east, north = bbox
+    return (
+        math.floor(west / step_x) * step_x,
+        max(-90.0, math.floor(south / step_y) * step_y),
+        math.ceil(east / step_x) * step_x,
+        min(90.0, math.ceil(north / step_y) * step_y),
+    )
+
+
+def parse_viewport(args: t.Mapping[str, str]) -> Viewport:
+    """Viewport of the `_zoom` and `_bbox` request arguments, the bounding box
+    being given as `west,south,east,north` like Leaflet `toBBoxString()`."""
+    zoom = args.get("_zoom")
+    bbox = args.get("_bbox")
+    viewport = Viewport()
+    if zoom is not None and zoom != "":
+        try:
+            value = int(float(zoom))
+        except ValueError:
+            raise ValueError(f"Invalid zoom level: {zoom}")
+        viewport = Viewport(zoom=max(0, min(MAX_ZOOM, value)))
+    if bbox is None or bbox == "":
+        return viewport
+    try:
+        west, south, east, north = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise ValueError(f"Invalid bounding box: {bbox}")
+    if not all(map(math.isfinite, (west, south, east, north))):
+        raise ValueError(f"Invalid bounding box: {bbox}")
+    if south > north or west > east:
+        raise ValueError(f"Invalid bounding box: {bbox}")
+    return Viewport(
+        zoom=viewport.zoom,
+        bbox=snap_bbox((west, south, east, north), viewport.zoom),
+    )
+
+
+@dataclass(frozen=True)
+class MapQuery:
+    """Map chart query rewritten for the viewport of the map, keeping the
+    points within its bounding box and grouping them into clusters of
+    `cluster_radius` pixels until `cluster_max_zoom`.
+
+    Points are looked up in the `rtree_table` R*Tree index when set, by the
+    `rtree_id_column` of the query.
+    """
+
+    latitude: str
+    longitude: str
+    cluster_radius: int | None = None
+    cluster_max_zoom: int = DEFAULT_CLUSTER_MAX_ZOOM
+    rtree_table: str | None = None
+    rtree_id_column: str = DEFAULT_RTREE_ID_COLUMN
+
+    def clusters(self, viewport: Viewport) -> bool:
+        """Whether the points are grouped into clusters at the viewport zoom."""
+        return self.cluster_radius is not None and (
+            viewport.zoom <= self.cluster_max_zoom
+        )
+
+    def query(
+        self,
+        query: BoundQuery,
+        viewport: Viewport,
+        rtree_columns: t.Sequence[str] | None = None,
+    ) -> BoundQuery:
+        """The query of the points of the viewport, using the R*Tree index
+        having `rtree_columns` when available."""
+        sql = query.sql
+        if viewport.bbox is not None:
+            rtree = None
+            if self.rtree_table is not None and rtree_columns is not None:
+                rtree = (self.rtree_table, self.rtree_id_column, rtree_columns)
+            sql = window_sql(sql, self.latitude, self.longitude, viewport.bbox, rtree)
+        if self.cluster_radius is not None and viewport.zoom <= self.cluster_max_zoom:
+            sql = cluster_sql(
+                sql,
+                self.latitude,
+                self.longitude,
+                viewport.zoom,
+                self.cluster_radius,
+            )
+        if sql == query.sql:
+            return query
+        return QueryTemplate.parse(sql).bind(query.params)
+
+
+def _cluster_options(display: dict[str, t.Any]) -> tuple[int | None, int]:
+    config = display.get("cluster")
+    if config is None or config is False:
+        return None, DEFAULT_CLUSTER_MAX_ZOOM
+    if config is True:
+        config = {}
+    elif not isinstance(config, dict):
+        config = {"radius": config}
+
+    radius = int(config.get("radius", DEFAULT_CLUSTER_RADIUS))
+    if radius < 1:
+        raise ValueError("cluster radius must be at least 1")
+    max_zoom = int(config.get("max_zoom", DEFAULT_CLUSTER_MAX_ZOOM))
+    if not 0 <= max_zoom <= MAX_ZOOM:
+        raise ValueError(f"cluster max_zoom must be between 0 and {MAX_ZOOM}")
+    return radius, max_zoom
+
+
+def chart_map_query(chart: dict[str, t.Any]) -> MapQuery | None:
+    """Map query of a map chart, configured by its `display` options.
+
+    `cluster` is either `true`, a cluster radius in pixels, or a mapping with
+    `radius` and `max_zoom` keys. `rtree_table` is the name of an R*Tree
+    index of the points, by the `rtree_id_column` of the query.
+    """
+    if chart.get("library") != "map":
+        return None
+    display: dict[str, t.Any] = chart.get("display") or {}
+    radius, max_zoom = _cluster_options(display)
+    return MapQuery(
+        latitude=display.get("latitude_column", DEFAULT_LATITUDE_COLUMN),
+        longitude=display.get("longitude_column", DEFAULT_LONGITUDE_COLUMN),
+        cluster_radius=radius,
+        cluster_max_zoom=max_zoom,
+        rtree_table=display.get("rtree_table"),
+        rtree_id_column=display.get("rtree_id_column", DEFAULT_RTREE_ID_COLUMN),
+    )
+
+
+async def rtree_columns(
+    datasette: "Datasette", db: str, table: str
+) -> tuple[str, ...] | None:
+    """Columns of a 2-dimensional R*Tree table of a database, or None when it
+    does not exist."""
+    columns = await datasette.get_database(db).table_columns(table)
+    if len(columns) != 5:
+        return None
+    return tuple(columns)
@@ -0,0 +1,117 @@
+import re
+import typing as t
+
+from dataclasses import dataclass
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from datasette_dashboards.cache import QueryResults
+
+sql_opt_pattern = re.compile(r"(?P<opt>\[\[.*?\]\])")
+sql_var_pattern = re.compile(r"\:(?P<var>[a-zA-Z0-9_]+)")
+
+
+@dataclass(frozen=True)
+class QueryTemplate:
+    """SQL query with `[[ ... ]]` optional clauses parsed once.
+
+    The query is split into literal segments interleaved with optional
+    segments, each optional segment knowing the first `:var` it references:
+    `literals[0] optionals[0] literals[1] ... optionals[n-1] literals[n]`.
+    Rendering is then a single join over the segments.
+    """
+
+    query: str
+    literals: tuple[str, ...]
+    optionals: tuple[tuple[str, str], ...]
+    variables: tuple[str, ...]
+
+    @classmethod
+    def parse(cls, query: str) -> "QueryTemplate":
+        literals: list[str] = []
+        optionals: list[tuple[str, str]] = []
+        position = 0
+        for opt_match in re.finditer(sql_opt_pattern, query):
+            opt_group = opt_match.group("opt")
+            var_match = re.search(sql_var_pattern, opt_group)
+            var_group = var_match.group("var") if var_match is not None else ""
+            literals.append(query[position : opt_match.start()])
+            optionals.append((opt_group.strip("[[]]"), var_group))
+            position = opt_match.end()
+        literals.append(query[position:])
+        variables = dict.fromkeys(re.findall(sql_var_pattern, query))
+        return cls(
+            query=query,
+            literals=tuple(literals),
+            optionals=tuple(optionals),
+            variables=tuple(variables),
+        )
+
+    def active(self, options: t.Mapping[str, str]) -> tuple[bool, ...]:
+        """Which optional segments are kept for the given filter values."""
+        return tuple(var in options and options[var] != "" for _, var in self.optionals)
+
+    def join(self, active: t.Sequence[bool]) -> str:
+        parts = [self.literals[0]]
+        for (segment, _), keep, literal in zip(
+            self.optionals, active, self.literals[1:]
+        ):
+            if keep:
+                parts.append(segment)
+            parts.append(literal)
+        return "".join(parts)
+
+    def render(self, options: t.Mapping[str, str]) -> str:
+        return self.join(self.active(options))
+
+    def params(self, options: t.Mapping[str, str]) -> dict[str, str]:
+        """Bound parameters for the query, missing filters being empty strings."""
+        return {var: options.get(var, "") for var in self.variables}
+
+    def bind(self, options: t.Mapping[str, str]) -> "BoundQuery":
+        return BoundQuery(
+            template=self, active=self.active(options), params=self.params(options)
+        )
+
+
+@dataclass(frozen=True)
+class BoundQuery:
+    """Query template bound to filter values, rendered on demand.
+
+    Identified by the template, its kept optional segments and its
+    parameters, so that it can be looked up without rendering the SQL.
+    """
+
+    template: QueryTemplate
+    active: tuple[bool, ...]
+    params: dict[str, str]
+
+    @property
+    def sql(self) -> str:
+        return self.template.join(self.active)
+
+    def key(self) -> tuple[str, tuple[bool, ...], tuple[tuple[str, str], ...]]:
+        return (self.template.query, self.active, tuple(sorted(self.params.items())))
+
+
+class QueryRewrite(t.Protocol):
+    """Rewrite of a chart query, such as returning bins of its rows instead of
+    the rows.
+
+    Rewrites needing statistics of the rows provide a `stats_query`, whose
+    results are passed to `query`.
+    """
+
+    def stats_query(self, query: BoundQuery) -> BoundQuery | None: ...
+
+    def query(
+        self, query: BoundQuery, stats: "QueryResults | None" = None
+    ) -> BoundQuery: ...
+
+
+def subquery(sql: str) -> str:
+    """Rendered query usable as a subquery, without its trailing semicolon."""
+    return sql.strip().rstrip(";")
+
+
+def replace_opts_in_query(query: str, options: t.Mapping[str, str]) -> str:
+    return QueryTemplate.parse(query).render(options)
@@ -0,0 +1,241 @@
+import hashlib
+import json
+import math
+import typing as t
+import weakref
+
+from dataclasses import dataclass
+
+from datasette_dashboards.aggregate import (
+    Aggregation,
+    chart_aggregation,
+    chart_top_categories,
+)
+from datasette_dashboards.binning import chart_binning
+from datasette_dashboards.cache import DEFAULT_DISK_CACHE_BYTES, ResultsTransform
+from datasette_dashboards.chart_types import convert_chart_type
+from datasette_dashboards.downsample import chart_downsampling
+from datasette_dashboards.maps import MapQuery, chart_map_query
+from datasette_dashboards.query import QueryRewrite, QueryTemplate
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from datasette.app import Datasette
+
+
+PLUGIN_NAME = "datasette-dashboards"
+
+# Compiled registry of each Datasette instance, along with the plugin
+# configuration object it was compiled from
+_registries: "weakref.WeakKeyDictionary[Datasette, tuple[t.Any, Registry]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+@dataclass(frozen=True)
+class CompiledChart:
+    """Chart converted to its final library spec, with its query template.
+
+    `error` holds the configuration error message when the conversion failed,
+    so that it can be reported when the chart is requested. `filters` lists
+    the dashboard filters actually referenced by the chart query.
+    `cache_max_stale` is how long expired cached results can still be served
+    while they are refreshed in the background. Results are cached in the
+    file at `cache_path` when set, instead of in memory. `transform` is
+    applied to the full query results, such as downsampling, in place of
+    their truncation. Truncated results are replaced by the results of the
+    `aggregation` query when set. The chart query is replaced by its
+    `rewrite` when set, such as binning. Map charts have a `map_query`
+    keeping the points within the map viewport, and clustering them.
+    """
+
+    slug: str
+    spec: dict[str, t.Any]
+    template: QueryTemplate | None
+    error: str | None = None
+    cache_ttl: float = 0
+    filters: tuple[str, ...] = ()
+    cache_max_stale: float = 0
+    cache_path: str | None = None
+    cache_max_bytes: int = DEFAULT_DISK_CACHE_BYTES
+    transform: ResultsTransform | None = None
+    aggregation: Aggregation | None = None
+    rewrite: QueryRewrite | None = None
+    map_query: MapQuery | None = None
+
+
+@dataclass(frozen=True)
+class CompiledDashboard:
+    slug: str
+    config: dict[str, t.Any]
+    settings: dict[str, t.Any]
+    filters: dict[str, dict[str, t.Any]]
+    filter_templates: dict[str, QueryTemplate]
+    default_filters: dict[str, t.Any]
+    charts: dict[str, CompiledChart]
+    databases: frozenset[str]
+    cache_ttl: float = 0
+    cache_max_stale: float = 0
+    cache_path: str | None = None
+    cache_max_bytes: int = DEFAULT_DISK_CACHE_BYTES
+    # Filters referenced by dynamic select filter queries
+    filter_dependencies: frozenset[str] = frozenset()
+    config_hash: str = ""
+
+
+@dataclass(frozen=True)
+class Registry:
+    config_hash: str
+    dashboards: dict[str, CompiledDashboard]
+
+
+def config_hash(config: dict[str, t.Any]) -> str:
+    serialized = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def resolve_cache_ttl(cache_ttl: float, cache_invalidation: str) -> float:
+    """Results cached until their database changes do not expire by default."""
+    if cache_invalidation == "data_version" and cache_ttl <= 0:
+        return math.inf
+    return cache_ttl
+
+
+def compile_chart(
+    chart_slug: str,
+    chart: dict[str, t.Any],
+    cache_ttl: float = 0,
+    cache_invalidation: str = "ttl",
+    filter_keys: t.Collection[str] = (),
+    cache_max_stale: float = 0,
+    cache_path: str | None = None,
+    cache_max_bytes: int = DEFAULT_DISK_CACHE_BYTES,
+    auto_aggregate: bool = False,
+) -> CompiledChart:
+    query: str | None = chart.get("query")
+    template = QueryTemplate.parse(query) if query is not None else None
+    filters = tuple(
+        sorted(set(template.variables) & set(filter_keys)) if template else ()
+    )
+    cache_ttl = resolve_cache_ttl(
+        float(chart.get("cache_ttl", cache_ttl)),
+        chart.get("cache_invalidation", cache_invalidation),
+    )
+    cache_max_stale = float(chart.get("cache_max_stale", cache_max_stale))
+    spec = chart
+    transform = None
+    aggregation = None
+    rewrite = None
+    map_query = None
+    error = None
+    try:
+        spec = convert_chart_type(chart)
+        transform = chart_downsampling(chart)
+        rewrite = chart_binning(chart) or chart_top_categories(chart)
+        map_query = chart_map_query(chart)
+        if chart.get("auto_aggregate", auto_aggregate):
+            aggregation = chart_aggregation(chart)
+    except KeyError as e:
+        error = f"Chart '{chart_slug}' configuration error: missing required field {e}"
+    except ValueError as e:
+        error = f"Chart '{chart_slug}' configuration error: {e}"
+    return CompiledChart(
+        slug=chart_slug,
+        spec=spec,
+        template=template,
+        error=error,
+        cache_ttl=cache_ttl,
+        filters=filters,
+        cache_max_stale=cache_max_stale,
+        cache_path=cache_path,
+        cache_max_bytes=cache_max_bytes,
+        transform=transform,
+        aggregation=aggregation,
+        rewrite=rewrite,
+        map_query=map_query,
+    )
+
+
+def compile_dashboard(slug: str, dashboard: dict[str, t.Any]) -> CompiledDashboard:
+    settings: dict[str, t.Any] = dashboard.get("settings", {})
+    filters: dict[str, dict[str, t.Any]] = dashboard.get("filters", {})
+    charts: dict[str, dict[str, t.Any]] = dashboard.get("charts", {})
+    cache_ttl = float(settings.get("cache_ttl", 0))
+    cache_invalidation = settings.get("cache_invalidation", "ttl")
+    cache_max_stale = float(settings.get("cache_max_stale", 0))
+    cache_path: str | None = settings.get("cache_path")
+    cache_max_bytes = int(settings.get("cache_max_bytes", DEFAULT_DISK_CACHE_BYTES))
+    auto_aggregate = bool(settings.get("auto_aggregate", False))
+
+    filter_templates = {
+        key: QueryTemplate.parse(flt["query"])
+        for key, flt in filters.items()
+        if flt.get("type") == "select" and {"db", "query"} <= flt.keys()
+    }
+    default_filters = {k: v["default"] for k, v in filters.items() if v.get("default")}
+
+    return CompiledDashboard(
+        slug=slug,
+        config=dict(dashboard, filters=filters, charts=charts),
+        settings=settings,
+        filters=filters,
+        filter_templates=filter_templates,
+        default_filters=default_filters,
+        charts={
+            chart_slug: compile_chart(
+                chart_slug,
+                chart,
+                cache_ttl,
+                cache_invalidation,
+                filters.keys(),
+                cache_max_stale,
+                cache_path,
+                cache_max_bytes,
+                auto_aggregate,
+            )
+            for chart_slug, chart in charts.items()
+        },
+        databases=frozenset(chart["db"] for chart in charts.values() if "db" in chart),
+        cache_ttl=resolve_cache_ttl(cache_ttl, cache_invalidation),
+        cache_max_stale=cache_max_stale,
+        cache_path=cache_path,
+        cache_max_bytes=cache_max_bytes,
+        filter_dependencies=frozenset(
+            var
+            for template in filter_templates.values()
+            for var in template.variables
+            if var in filters
+        ),
+        config_hash=config_hash(dashboard),
+    )
+
+
+def compile_registry(config: dict[str, t.Any]) -> Registry:
+    return Registry(
+        config_hash=config_hash(config),
+        dashboards={
+            slug: compile_dashboard(slug, dashboard)
+            for slug, dashboard in config.items()
+        },
+    )
+
+
+def get_registry(datasette: "Datasette") -> Registry:
+    """Return the compiled registry for the current plugin configuration.
+
+    The registry is compiled at startup and kept on the Datasette instance.
+    The configuration is only hashed again when Datasette returns a different
+    configuration object, and the dashboards are only compiled again when
+    its hash changes.
+    """
+    plugins = datasette.metadata("plugins") or {}
+    source = plugins.get(PLUGIN_NAME)
+    cached = _registries.get(datasette)
+    if cached is not None and cached[0] is source:
+        return cached[1]
+
+    config = datasette.plugin_config(PLUGIN_NAME) or {}
+    registry = cached[1] if cached is not None else None
+    if registry is None or registry.config_hash != config_hash(config):
+        registry = compile_registry(config)
+    _registries[datasette] = (source, registry)
+    return registry
@@ -1,6 +1,75 @@
-function getDataUrl(chart, query_string, absolute_url) {
-  const query = encodeURIComponent(chart.query)
-  return `${absolute_url}${chart.db}.json?sql=${query}&${query_string}&_shape=objects`
+const documentLoaded = document.readyState === 'loading'
+  ? new Promise(resolve => document.addEventListener('DOMContentLoaded', resolve))
+  : Promise.resolve()
+
+const dashboardDataRequests = new Map()
+const dashboardDataEtags = new Map()
+const dashboardCharts = new Map()
+const chartsData = new Map()
+const chartsViews = new Map()
+const chartsDataUrls = new Map()
+const lazyCharts = new Map()
+const lazyRenderMargin = '200px 0px'
+let lazyRenderObserver = null
+const mapMoveDebounce = 250
+const mapClusterColumns = ['_count', '_latitude', '_longitude', '_south', '_west', '_north', '_east']
+
+function fetchChartsData(data_url, init) {
+  // Charts data in columns, without repeating column names on every row
+  const url = new URL(data_url, window.location.href)
+  url.searchParams.set('_shape', 'columns')
+  return fetch(url, init)
+}
+
+function decodeChartData(data) {
+  if (!data || !data.ok || !data.values) {
+    return data
+  }
+  const values = data.values.map(column => Array.isArray(column)
+    ? column
+    : column.indexes.map(index => column.dictionary[index]))
+  const decoded = { ...data, values, length: values.length ? values[0].length : 0 }
+
+  // Row objects are only built when needed, as for Vega data
+  let rows = null
+  Object.defineProperty(decoded, 'rows', {
+    get() {
+      if (rows === null) {
+        rows = Array.from({ length: decoded.length }, (_, i) => Object.fromEntries(
+          decoded.columns.map((column, j) => [column, values[j][i]])))
+      }
+      return rows
+    }
+  })
+  return decoded
+}
+
+function decodeChartsData(charts) {
+  return Object.fromEntries(Object.entries(charts).map(([chart_slug, data]) => [chart_slug, decodeChartData(data)]))
+}
+
+function getChartColumn(data, column) {
+  const index = data.columns.indexOf(column)
+  return index === -1 ? [] : data.values[index]
+}
+
+async function requestDashboardData(data_url) {
+  const results = await fetchChartsData(data_url)
+  dashboardDataEtags.set(data_url, results.headers.get('ETag'))
+  const data = await results.json()
+  return decodeChartsData(data.charts)
+}
+
+function fetchDashboardData(data_url) {
+  if (!data_url) {
+    return Promise.resolve({})
+  }
+  new URL(data_url, window.location.href).searchParams.getAll('_chart')
+    .forEach(chart_slug => chartsDataUrls.set(chart_slug, data_url))
+  if (!dashboardDataRequests.has(data_url)) {
+    dashboardDataRequests.set(data_url, requestDashboardData(data_url))
+  }
+  return dashboardDataRequests.get(data_url)
 }
 
 function enableChartTooltip(chart_slug) {
@@ -8,11 +77,7 @@ function enableChartTooltip(chart_slug) {
   tooltip.style.visibility = 'visible'
 }
 
-async function renderVegaChart(chart_slug, chart, query_string, absolute_url, full_height) {
-  const dataUrl = getDataUrl(chart, query_string, absolute_url)
-  const results = await fetch(dataUrl)
-  const data = await results.json()
-
+async function renderVegaChart(chart_slug, chart, data, full_height) {
   let defaultSignals = [
     {
       'name': 'width',
@@ -54,18 +119,15 @@ async function renderVegaChart(chart_slug, chart, query_string, absolute_url, fu
   };
 
   const el = document.querySelector(`#chart-${chart_slug}`)
-  vegaEmbed(el, spec)
+  const result = await vegaEmbed(el, spec)
+  chartsViews.set(chart_slug, result)
 
   if (data.truncated) {
     enableChartTooltip(chart_slug)
   }
 }
 
-async function renderVegaLiteChart(chart_slug, chart, query_string, absolute_url, full_height) {
-  const dataUrl = getDataUrl(chart, query_string, absolute_url)
-  const results = await fetch(dataUrl)
-  const data = await results.json()
-
+async function renderVegaLiteChart(chart_slug, chart, data, full_height) {
   const spec = {
     $schema: 'https://vega.github.io/schema/vega-lite/v6.json',
     description: chart.title,
@@ -82,6 +144,7 @@ async function renderVegaLiteChart(chart_slug, chart, query_string, absolute_url
       }
     },
     data: {
+      name: 'table',
       values: data.rows,
       format: { 'type': 'json' }
     },
@@ -89,18 +152,16 @@ async function renderVegaLiteChart(chart_slug, chart, query_string, absolute_url
   };
 
   const el = document.querySelector(`#chart-${chart_slug}`)
-  vegaEmbed(el, spec)
+  const result = await vegaEmbed(el, spec)
+  chartsViews.set(chart_slug, result)
 
   if (data.truncated) {
     enableChartTooltip(chart_slug)
   }
 }
 
-async function renderMetricChart(chart_slug, chart, query_string, absolute_url, full_height) {
-  const dataUrl = getDataUrl(chart, query_string, absolute_url)
-  const results = await fetch(dataUrl)
-  const data = await results.json()
-  const metric = data.rows[0][chart.display.field]
+async function renderMetricChart(chart_slug, chart, data, full_height) {
+  const metric = getChartColumn(data, chart.display.field)[0]
 
   const prefix = chart.display.prefix || ''
   const suffix = chart.display.suffix || ''
@@ -131,14 +192,10 @@ async function renderMetricChart(chart_slug, chart, query_string, absolute_url,
   }
 }
 
-async function renderTableChart(chart_slug, chart, query_string, absolute_url, full_height) {
-  const dataUrl = getDataUrl(chart, query_string, absolute_url)
-  const results = await fetch(dataUrl)
-  const data = await results.json()
-
+async function renderTableChart(chart_slug, chart, data, full_height) {
   const thead = document.createElement('thead')
   const thead_tr = document.createElement('tr')
-  Object.keys(data.rows[0]).forEach(col => {
+  data.columns.forEach(col => {
     const thead_th = document.createElement('th')
     thead_th.innerHTML = col
     thead_tr.appendChild(thead_th)
@@ -146,15 +203,15 @@ async function renderTableChart(chart_slug, chart, query_string, absolute_url, f
   thead.appendChild(thead_tr)
 
   const tbody = document.createElement('tbody')
-  data.rows.forEach(row => {
+  for (let i = 0; i < data.length; i++) {
     const tbody_tr = document.createElement('tr')
-    Object.values(row).forEach(col => {
+    data.values.forEach(values => {
       const tbody_td = document.createElement('td')
-      tbody_td.innerHTML = col
+      tbody_td.innerHTML = values[i]
       tbody_tr.appendChild(tbody_td)
     })
     tbody.appendChild(tbody_tr)
-  })
+  }
 
   const table = document.createElement('table')
   table.appendChild(thead)
@@ -174,67 +231,315 @@ async function renderTableChart(chart_slug, chart, query_string, absolute_url, f
   }
 }
 
-async function renderMapChart(chart_slug, chart, query_string, absolute_url, full_height) {
-  document.addEventListener("DOMContentLoaded", async () => {
-    const dataUrl = getDataUrl(chart, query_string, absolute_url)
-    const results = await fetch(dataUrl)
-    const data = await results.json()
+function getMapDataUrl(chart_slug, zoom, bounds) {
+  const url = new URL(chartsDataUrls.get(chart_slug), window.location.href)
+  url.searchParams.delete('_chart')
+  url.searchParams.append('_chart', chart_slug)
+  url.searchParams.set('_zoom', zoom)
+  url.searchParams.set('_bbox', bounds.toBBoxString())
+  return url.toString()
+}
 
-    const wrapper = document.createElement('div')
-    wrapper.style.width = '100%'
-    wrapper.style.height = '100%'
-    wrapper.style.minHeight = '200px'
+function addMapMarkers(map, layer, data, options) {
+  const latitude_column = options.latitude_column || 'latitude'
+  const longitude_column = options.longitude_column || 'longitude'
+  const show_latlng_popup = options.show_latlng_popup || false
+  const clustered = data.clustered || false
+
+  const [latitudes, longitudes] = [latitude_column, longitude_column].map(column => getChartColumn(data, column))
+  const [counts, south, west, north, east] = ['_count', '_south', '_west', '_north', '_east']
+    .map(column => clustered ? getChartColumn(data, column) : [])
+  const popup_columns = data.columns
+    .map((column, j) => [column, data.values[j]])
+    .filter(e => !(clustered && mapClusterColumns.includes(e[0])))
+    .filter(e => (e[0] === latitude_column || e[0] === longitude_column) ? show_latlng_popup : true)
+
+  const bounds = new L.LatLngBounds([])
+  for (let i = 0; i < data.length; i++) {
+    if (counts[i] > 1) {
+      // Cluster of markers, zooming to its markers when clicked
+      const cluster_bounds = new L.LatLngBounds([south[i], west[i]], [north[i], east[i]])
+      const size = 30 + 10 * Math.min(3, Math.floor(Math.log10(counts[i])))
+      const icon = L.divIcon({
+        html: `<span>${counts[i]}</span>`,
+        className: 'dashboard-map-cluster',
+        iconSize: [size, size]
+      })
+      const position = [getChartColumn(data, '_latitude')[i], getChartColumn(data, '_longitude')[i]]
+      const marker = L.marker(position, { icon })
+      marker.on('click', () => map.fitBounds(cluster_bounds))
+      layer.addLayer(marker)
+      bounds.extend(cluster_bounds)
+      continue
+    }
 
-    const el = document.querySelector(`#chart-${chart_slug}`)
-    el.appendChild(wrapper)
+    const marker = L.marker([latitudes[i], longitudes[i]])
+    const popup = popup_columns
+      .reduce((acc, [column, values]) => `${acc}<span style="font-weight:bold;">${column}:</span> ${values[i]}<br>`, '')
+    marker.bindPopup(popup)
+    layer.addLayer(marker)
+    bounds.extend(marker.getLatLng())
+  }
+  return bounds
+}
 
-    const map = L.map(wrapper, { zoom: 12 })
+async function renderMapChart(chart_slug, chart, data, full_height) {
+  await documentLoaded
 
-    const tiles = L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
-      maxZoom: 19,
-      detectRetina: true,
-      attribution: '&copy; <a href="https://openstreetmap.org/copyright">OpenStreetMap contributors</a>'
-    })
-    map.addLayer(tiles)
-
-    const options = chart.display || {}
-    const latitude_column = options.latitude_column || 'latitude'
-    const longitude_column = options.longitude_column || 'longitude'
-    const show_latlng_popup = options.show_latlng_popup || false
-
-    data.rows.forEach(row => {
-      const marker = L.marker([row[latitude_column], row[longitude_column]])
-      const popup = Object.entries(row)
-        .filter(e => (e[0] === latitude_column || e[0] === longitude_column) ? show_latlng_popup : true)
-        .reduce((acc, e) => `${acc}<span style="font-weight:bold;">${e[0]}:</span> ${e[1]}<br>`, '')
-      marker.bindPopup(popup)
-      map.addLayer(marker)
-    })
+  const wrapper = document.createElement('div')
+  wrapper.style.width = '100%'
+  wrapper.style.height = '100%'
+  wrapper.style.minHeight = '200px'
+
+  const el = document.querySelector(`#chart-${chart_slug}`)
+  el.appendChild(wrapper)
+
+  const map = L.map(wrapper, { zoom: 12 })
+
+  const tiles = L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
+    maxZoom: 19,
+    detectRetina: true,
+    attribution: '&copy; <a href="https://openstreetmap.org/copyright">OpenStreetMap contributors</a>'
+  })
+  map.addLayer(tiles)
+
+  const options = chart.display || {}
+  const markers = L.layerGroup()
+  map.addLayer(markers)
 
-    const coords = data.rows.map(row => [row[latitude_column], row[longitude_column]])
-    const bounds = new L.LatLngBounds(coords)
-    map.fitBounds(bounds)
+  const bounds = addMapMarkers(map, markers, data, options)
+  map.fitBounds(bounds)
 
-    if (data.truncated) {
-      enableChartTooltip(chart_slug)
+  if (data.truncated) {
+    enableChartTooltip(chart_slug)
+  }
+
+  if (data.zoom === undefined || !chartsDataUrls.has(chart_slug)) {
+    return
+  }
+  if (!data.truncated && !data.clustered) {
+    // All the markers are already displayed
+    return
+  }
+
+  // Fetch the markers of the visible area whenever the map moves
+  let request = 0
+  let timeout = null
+  async function updateMarkers() {
+    const current = ++request
+    const results = await fetchChartsData(getMapDataUrl(chart_slug, map.getZoom(), map.getBounds()))
+    const charts = results.ok ? decodeChartsData((await results.json()).charts) : {}
+    const visible = charts[chart_slug]
+    if (current !== request || !visible || !visible.ok) {
+      return
+    }
+    markers.clearLayers()
+    addMapMarkers(map, markers, visible, options)
+    const tooltip = document.querySelector(`#chart-tooltip-${chart_slug}`)
+    if (tooltip) {
+      tooltip.style.visibility = visible.truncated ? 'visible' : ''
     }
+  }
+  map.on('moveend', () => {
+    window.clearTimeout(timeout)
+    timeout = window.setTimeout(updateMarkers, mapMoveDebounce)
   })
+  await updateMarkers()
 }
 
-async function renderChart(chart_slug, chart, query_string, absolute_url, full_height = false) {
-  renderers = new Map()
+async function renderChart(chart_slug, chart, dashboard_data, full_height = false) {
+  dashboardCharts.set(chart_slug, { chart, full_height })
+
+  const renderers = new Map()
   renderers.set('vega', renderVegaChart)
   renderers.set('vega-lite', renderVegaLiteChart)
   renderers.set('metric', renderMetricChart)
   renderers.set('table', renderTableChart)
   renderers.set('map', renderMapChart)
 
-  render = renderers.get(chart.library)
+  const render = renderers.get(chart.library)
   if (render) {
-    await render(chart_slug, chart, query_string, absolute_url, full_height)
+    const charts = await dashboard_data
+    const data = charts[chart_slug]
+    chartsData.set(chart_slug, JSON.stringify(data))
+    if (!data || !data.ok) {
+      console.error(`Chart '${chart_slug}' data error: ${data ? data.error : 'missing'}`)
+      return
+    }
+    await render(chart_slug, chart, data, full_height)
   }
 }
 
+function resetChart(chart_slug) {
+  const result = chartsViews.get(chart_slug)
+  if (result) {
+    result.finalize()
+    chartsViews.delete(chart_slug)
+  }
+  const el = document.querySelector(`#chart-${chart_slug}`)
+  el.replaceChildren()
+  const tooltip = document.querySelector(`#chart-tooltip-${chart_slug}`)
+  if (tooltip) {
+    tooltip.style.visibility = ''
+  }
+}
+
+function showChartSkeleton(chart_slug) {
+  const skeleton = document.createElement('div')
+  skeleton.className = 'dashboard-card-skeleton'
+  const el = document.querySelector(`#chart-${chart_slug}`)
+  el.replaceChildren(skeleton)
+}
+
+function getLazyRenderObserver() {
+  if (!lazyRenderObserver) {
+    lazyRenderObserver = new IntersectionObserver(entries => {
+      entries.filter(entry => entry.isIntersecting).forEach(entry => {
+        const chart_slug = entry.target.dataset.chartSlug
+        lazyRenderObserver.unobserve(entry.target)
+        const { chart, data_url, full_height } = lazyCharts.get(chart_slug)
+        lazyCharts.delete(chart_slug)
+        resetChart(chart_slug)
+        renderChart(chart_slug, chart, fetchDashboardData(data_url), full_height)
+      })
+    }, { rootMargin: lazyRenderMargin })
+  }
+  return lazyRenderObserver
+}
+
+function renderChartLazily(chart_slug, chart, data_url, full_height = false) {
+  if (!('IntersectionObserver' in window)) {
+    renderChart(chart_slug, chart, fetchDashboardData(data_url), full_height)
+    return
+  }
+
+  dashboardCharts.set(chart_slug, { chart, full_height })
+  const pending = lazyCharts.has(chart_slug)
+  lazyCharts.set(chart_slug, { chart, data_url, full_height })
+  if (pending) {
+    return
+  }
+
+  showChartSkeleton(chart_slug)
+  const card = document.querySelector(`#card-${chart_slug}`)
+  card.dataset.chartSlug = chart_slug
+  getLazyRenderObserver().observe(card)
+}
+
+async function updateChartData(chart_slug, data) {
+  const result = chartsViews.get(chart_slug)
+  const source = result && data.ok ? (result.vgSpec.data || []).find(d => d.name === 'table') : undefined
+  if (source) {
+    // Replace the chart rows in the existing Vega view, keeping its state
+    const values = vega.read(data.rows, source.format || { type: 'json' })
+    await result.view.change('table', vega.changeset().remove(vega.truthy).insert(values)).runAsync()
+    chartsData.set(chart_slug, JSON.stringify(data))
+    const tooltip = document.querySelector(`#chart-tooltip-${chart_slug}`)
+    if (tooltip) {
+      tooltip.style.visibility = data.truncated ? 'visible' : ''
+    }
+    return
+  }
+
+  const { chart, full_height } = dashboardCharts.get(chart_slug)
+  resetChart(chart_slug)
+  await renderChart(chart_slug, chart, Promise.resolve({ [chart_slug]: data }), full_height)
+}
+
+async function refreshChartsData(data_url, chart_slugs) {
+  const headers = {}
+  if (dashboardDataEtags.get(data_url)) {
+    headers['If-None-Match'] = dashboardDataEtags.get(data_url)
+  }
+  const results = await fetchChartsData(data_url, { headers })
+  if (results.status === 304 || !results.ok) {
+    return
+  }
+  dashboardDataEtags.set(data_url, results.headers.get('ETag'))
+  const charts = decodeChartsData((await results.json()).charts)
+  dashboardDataRequests.set(data_url, Promise.resolve(charts))
+
+  await Promise.all(chart_slugs
+    .filter(chart_slug => chart_slug in charts && !lazyCharts.has(chart_slug))
+    .filter(chart_slug => JSON.stringify(charts[chart_slug]) !== chartsData.get(chart_slug))
+    .map(chart_slug => updateChartData(chart_slug, charts[chart_slug])))
+}
+
+function getChartsDataUrls(data_url, charts_filters, params, batched = true) {
+  // Charts sorted by slug, in the same order as the URLs built by the server
+  const groups = new Map()
+  Object.keys(charts_filters).sort().forEach(chart_slug => {
+    const filters = charts_filters[chart_slug]
+    const key = batched ? filters.join('&') : chart_slug
+    if (!groups.has(key)) {
+      groups.set(key, { filters, chart_slugs: [] })
+    }
+    groups.get(key).chart_slugs.push(chart_slug)
+  })
+
+  const urls = {}
+  groups.forEach(({ filters, chart_slugs }) => {
+    const search = new URLSearchParams()
+    filters.filter(key => params.has(key)).forEach(key => search.append(key, params.get(key)))
+    chart_slugs.forEach(chart_slug => search.append('_chart', chart_slug))
+    chart_slugs.forEach(chart_slug => { urls[chart_slug] = `${data_url}?${search}` })
+  })
+  return urls
+}
+
+function enableInplaceFilters(options) {
+  const form = document.querySelector('.dashboard-filters form')
+  if (!form) {
+    return
+  }
+  let currentParams = new URLSearchParams(window.location.search)
+
+  function applyFilters(params, push) {
+    const keys = new Set([...currentParams.keys(), ...params.keys()])
+    const changed = [...keys].filter(key => currentParams.get(key) !== params.get(key))
+    if (changed.some(key => options.reload_filters.includes(key))) {
+      // Dynamic select filters options depend on the changed filters
+      if (push) {
+        window.location.assign(`${window.location.pathname}?${params}`)
+      } else {
+        window.location.reload()
+      }
+      return
+    }
+
+    currentParams = params
+    if (push) {
+      window.history.pushState(null, '', `${window.location.pathname}?${params}`)
+    }
+    document.querySelectorAll('.dashboard-card-title a').forEach(a => { a.search = params.toString() })
+
+    const urls = getChartsDataUrls(options.data_url, options.charts, params, !options.lazy_render)
+    Object.entries(options.charts).forEach(([chart_slug, filters]) => {
+      if (!filters.some(key => changed.includes(key))) {
+        return
+      }
+      const { chart, full_height } = dashboardCharts.get(chart_slug)
+      if (options.lazy_render) {
+        renderChartLazily(chart_slug, chart, urls[chart_slug], full_height)
+        return
+      }
+      resetChart(chart_slug)
+      renderChart(chart_slug, chart, fetchDashboardData(urls[chart_slug]), full_height)
+    })
+  }
+
+  form.addEventListener('submit', event => {
+    event.preventDefault()
+    applyFilters(new URLSearchParams(new FormData(form)), true)
+  })
+
+  window.addEventListener('popstate', () => {
+    const params = new URLSearchParams(window.location.search)
+    Array.from(form.elements).filter(el => el.name).forEach(el => { el.value = params.get(el.name) ?? '' })
+    applyFilters(params, false)
+  })
+}
+
 function toggleFullscreen() {
   const el = document.querySelector("section.content")
   if (document.fullscreenElement) {
@@ -244,9 +549,28 @@ function toggleFullscreen() {
   }
 }
 
-function autorefresh(minutes) {
+function autorefresh(minutes, options) {
   const timeout = Math.round(minutes * 60 * 1000)
-  window.setTimeout(function () { window.location.reload() }, timeout)
+
+  async function refresh() {
+    if (!document.hidden) {
+      const params = new URLSearchParams(window.location.search)
+      const urls = getChartsDataUrls(options.data_url, options.charts, params, !options.lazy_render)
+      const groups = new Map()
+      Object.entries(urls).filter(([chart_slug]) => dashboardCharts.has(chart_slug)).forEach(([chart_slug, data_url]) => {
+        if (!groups.has(data_url)) {
+          groups.set(data_url, [])
+        }
+        groups.get(data_url).push(chart_slug)
+      })
+      const refreshes = [...groups].map(([data_url, chart_slugs]) => refreshChartsData(data_url, chart_slugs))
+      const results = await Promise.allSettled(refreshes)
+      results.filter(r => r.status === 'rejected').forEach(r => console.error(`Dashboard refresh error: ${r.reason}`))
+    }
+    window.setTimeout(refresh, timeout)
+  }
+
+  window.setTimeout(refresh, timeout)
 }
 
 vega.setRandom(vega.randomLCG(0))
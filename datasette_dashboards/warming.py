@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import math
+import typing as t
+import weakref
+
+from collections import Counter
+from datasette.utils import sqlite3
+from datasette.database import QueryInterrupted
+
+from datasette_dashboards.data import (
+    fetch_chart_data,
+    fetch_filter_options,
+    gather_by_database,
+    has_data,
+)
+from datasette_dashboards.registry import CompiledDashboard, get_registry
+
+if t.TYPE_CHECKING:  # pragma: no cover
+    from datasette.app import Datasette
+
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of distinct filter values counted per chart or dynamic filter
+DEFAULT_USAGE_SIZE = 256
+DEFAULT_WARM_POPULAR = 5
+
+WARM_FILTERS = ("default", "popular", "both")
+
+FilterValues = tuple[tuple[str, str], ...]
+UsageKey = tuple[str, str, str]
+
+_usages: "weakref.WeakKeyDictionary[Datasette, FilterUsage]" = (
+    weakref.WeakKeyDictionary()
+)
+_warming_tasks: "weakref.WeakKeyDictionary[Datasette, list[asyncio.Task[None]]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class FilterUsage:
+    """Counts of the filter values requested for charts and dynamic filters.
+
+    Only the filters referenced by each query are counted, so that requests
+    differing on other filters are counted as the same query. The counts of
+    each query are halved down to their most common values when more than
+    `max_size` distinct values were requested.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_USAGE_SIZE) -> None:
+        self.max_size = max_size
+        self._counts: dict[UsageKey, Counter[FilterValues]] = {}
+
+    def record(
+        self,
+        slug: str,
+        kind: str,
+        name: str,
+        filters: t.Iterable[str],
+        options: dict[str, str],
+    ) -> None:
+        counts = self._counts.setdefault((slug, kind, name), Counter())
+        values = tuple((key, options[key]) for key in sorted(filters) if key in options)
+        counts[values] += 1
+        if len(counts) > self.max_size:
+            kept = counts.most_common(self.max_size // 2)
+            counts.clear()
+            counts.update(dict(kept))
+
+    def most_common(
+        self, slug: str, kind: str, name: str, n: int
+    ) -> list[dict[str, str]]:
+        counts = self._counts.get((slug, kind, name), Counter())
+        return [dict(values) for values, _ in counts.most_common(n)]
+
+
+def get_filter_usage(datasette: "Datasette") -> FilterUsage:
+    usage = _usages.get(datasette)
+    if usage is None:
+        usage = FilterUsage()
+        _usages[datasette] = usage
+    return usage
+
+
+def warm_interval(dashboard: CompiledDashboard) -> float:
+    return float(dashboard.settings.get("warm_interval", 0))
+
+
+def warm_filters(dashboard: CompiledDashboard) -> str:
+    mode: str = dashboard.settings.get("warm_filters", "default")
+    if mode not in WARM_FILTERS:
+        raise ValueError(
+            f"Dashboard '{dashboard.slug}' warm_filters must be one of: "
+            + ", ".join(WARM_FILTERS)
+        )
+    return mode
+
+
+def warm_options(
+    datasette: "Datasette", dashboard: CompiledDashboard, kind: str, name: str
+) -> list[dict[str, str]]:
+    """Filter values to warm a chart or dynamic filter query with."""
+    settings = dashboard.settings
+    mode = warm_filters(dashboard)
+
+    options = []
+    if mode in ("default", "both"):
+        options.append({k: str(v) for k, v in dashboard.default_filters.items()})
+    if mode in ("popular", "both"):
+        popular = int(settings.get("warm_popular", DEFAULT_WARM_POPULAR))
+        usage = get_filter_usage(datasette)
+        options += usage.most_common(dashboard.slug, kind, name, popular)
+    return options
+
+
+async def warm_query(job: t.Awaitable[t.Any]) -> None:
+    try:
+        await job
+    except (sqlite3.DatabaseError, QueryInterrupted):
+        # Failing queries are reported when the dashboard is viewed
+        pass
+    except Exception:
+        # Other queries of the dashboard are still warmed
+        logger.exception("Failed to warm a dashboard query")
+
+
+async def warm_dashboard(datasette: "Datasette", dashboard: CompiledDashboard) -> int:
+    """Run the cached chart and dynamic filter queries of a dashboard ahead of
+    viewers, returning the number of queries run.
+
+    Results expiring after a time-to-live are refreshed even if still cached,
+    so that they do not expire before the next warming.
+    """
+    jobs: list[tuple[str, t.Awaitable[t.Any]]] = []
+    warmed: set[tuple[str, t.Hashable]] = set()
+
+    if dashboard.cache_ttl > 0:
+        for key, template in dashboard.filter_templates.items():
+            flt = dashboard.filters[key]
+            if flt["db"] not in datasette.databases:
+                continue
+            for options in warm_options(datasette, dashboard, "filter", key):
+                query_key = template.bind(options).key()
+                if (key, query_key) in warmed:
+                    continue
+                warmed.add((key, query_key))
+                jobs.append(
+                    (
+                        flt["db"],
+                        warm_query(
+                            fetch_filter_options(
+                                datasette,
+                                flt,
+                                template,
+                                options,
+                                dashboard.cache_ttl,
+                                dashboard.cache_max_stale,
+                                dashboard.cache_path,
+                                dashboard.cache_max_bytes,
+                                refresh=math.isfinite(dashboard.cache_ttl),
+                            )
+                        ),
+                    )
+                )
+
+    for chart in dashboard.charts.values():
+        if not has_data(chart) or chart.cache_ttl <= 0:
+            continue
+        if chart.spec["db"] not in datasette.databases:
+            continue
+        assert chart.template is not None
+        for options in warm_options(datasette, dashboard, "chart", chart.slug):
+            query_key = chart.template.bind(options).key()
+            if (chart.slug, query_key) in warmed:
+                continue
+            warmed.add((chart.slug, query_key))
+            jobs.append(
+                (
+                    chart.spec["db"],
+                    warm_query(
+                        fetch_chart_data(
+                            datasette,
+                            chart,
+                            options,
+                            refresh=math.isfinite(chart.cache_ttl),
+                        )
+                    ),
+                )
+            )
+
+    concurrency = max(1, int(dashboard.settings.get("warm_concurrency", 1)))
+    await gather_by_database(jobs, concurrency)
+    return len(jobs)
+
+
+async def warm_dashboard_periodically(datasette: "Datasette", slug: str) -> None:
+    """Warm a dashboard every `warm_interval` seconds, for as long as it is
+    configured to. A failing round is logged, and warming goes on."""
+    while True:
+        dashboard = get_registry(datasette).dashboards.get(slug)
+        if dashboard is None or warm_interval(dashboard) <= 0:
+            return
+        try:
+            await warm_dashboard(datasette, dashboard)
+        except Exception:
+            logger.exception("Failed to warm dashboard %r", slug)
+        await asyncio.sleep(warm_interval(dashboard))
+
+
+def start_cache_warming(datasette: "Datasette") -> list["asyncio.Task[None]"]:
+    """Start warming the dashboards having a `warm_interval` setting."""
+    tasks = _warming_tasks.setdefault(datasette, [])
+    if not tasks:
+        for slug, dashboard in get_registry(datasette).dashboards.items():
+            if warm_interval(dashboard) > 0:
+                warm_filters(dashboard)
+                tasks.append(
+                    asyncio.ensure_future(warm_dashboard_periodically(datasette, slug))
+                )
+    return tasks
@@ -42,6 +42,16 @@ def test(ctx: Context) -> None:
     )
 
 
+@task
+def assets(ctx: Context) -> None:
+    ctx.run(
+        "uv run python -c"
+        " 'from datasette_dashboards.assets import build_assets; build_assets()'",
+        echo=True,
+        pty=True,
+    )
+
+
 @task(lint, typing, test)
 def qa(ctx: Context) -> None:
     pass
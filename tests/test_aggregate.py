@@ -0,0 +1,200 @@
+import sqlite3
+import typing as t
+import pytest
+
+from datasette_dashboards.aggregate import (
+    Aggregation,
+    TopCategories,
+    bucket_sql,
+    chart_aggregation,
+    chart_top_categories,
+    grid_sql,
+    top_sql,
+)
+from datasette_dashboards.query import QueryTemplate
+
+
+@pytest.fixture
+def conn() -> t.Iterator[sqlite3.Connection]:
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE points (day TEXT, x REAL, y REAL, source TEXT)")
+    conn.executemany(
+        "INSERT INTO points VALUES (date('2021-01-01', ?), ?, ?, ?)",
+        [
+            (f"+{i // 2} days", i % 97, (i * 31) % 89, "a" if i % 2 else "b")
+            for i in range(2000)
+        ],
+    )
+    yield conn
+    conn.close()
+
+
+def test_bucket_sql(conn: sqlite3.Connection) -> None:
+    sql = "SELECT day, y, source FROM points ORDER BY day;"
+    rows = conn.execute(bucket_sql(sql, "day", "y", "source", True, 100)).fetchall()
+    assert 0 < len(rows) <= 100
+    assert {row[1] for row in rows} == {"a", "b"}
+    assert rows[0][0] == "2021-01-01"
+    assert [row[0] for row in rows] == sorted(row[0] for row in rows)
+
+    total = conn.execute("SELECT avg(y) FROM points").fetchone()[0]
+    one = conn.execute(bucket_sql(sql, "day", "y", None, True, 1)).fetchall()
+    assert one == [("2021-01-01", pytest.approx(total))]
+
+
+def test_bucket_sql_epoch(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        "CREATE TABLE events AS SELECT CAST(unixepoch(day) AS INTEGER) AS ts, y "
+        "FROM points"
+    )
+    sql = "SELECT ts, y FROM events"
+    rows = conn.execute(bucket_sql(sql, "ts", "y", None, True, 100)).fetchall()
+    assert 0 < len(rows) <= 100
+    assert rows[0][0] == conn.execute("SELECT min(ts) FROM events").fetchone()[0]
+
+
+def test_top_sql(conn: sqlite3.Connection) -> None:
+    sql = "SELECT x, count(*) AS count FROM points GROUP BY x"
+    rows = conn.execute(top_sql(sql, "x", "count", top=3)).fetchall()
+    assert rows[:3] == [(0, 21), (1, 21), (2, 21)]
+    assert rows[3] == ("Other", 2000 - 3 * 21)
+
+    rows = conn.execute(top_sql(sql, "x", "count", limit=10)).fetchall()
+    assert len(rows) == 10
+    assert sum(row[1] for row in rows) == 2000
+    assert rows[-1][0] == "Other"
+
+
+def test_top_sql_color(conn: sqlite3.Connection) -> None:
+    sql = "SELECT x, source, y FROM points"
+    rows = conn.execute(top_sql(sql, "x", "y", "source", limit=10)).fetchall()
+    assert len(rows) == 10
+    assert {row[1] for row in rows} == {"a", "b"}
+    assert [row[0] for row in rows[-2:]] == ["Other", "Other"]
+    assert sum(row[2] for row in rows) == pytest.approx(
+        conn.execute("SELECT sum(y) FROM points").fetchone()[0]
+    )
+
+    rows = conn.execute(top_sql(sql, "x", "y", "source", top=2)).fetchall()
+    assert len({row[0] for row in rows}) == 3
+    assert len(rows) == 6
+
+
+def test_top_sql_other_label(conn: sqlite3.Connection) -> None:
+    sql = "SELECT x, count(*) AS count FROM points GROUP BY x"
+    rows = conn.execute(top_sql(sql, "x", "count", top=1, other="It's")).fetchall()
+    assert rows[-1] == ("It's", 2000 - rows[0][1])
+
+
+def test_grid_sql(conn: sqlite3.Connection) -> None:
+    sql = "SELECT x, y, source FROM points"
+    rows = conn.execute(grid_sql(sql, "x", "y", "source", None, 100)).fetchall()
+    assert 0 < len(rows) <= 100
+
+    rows = conn.execute(grid_sql(sql, "x", "y", None, "x", 16)).fetchall()
+    assert 0 < len(rows) <= 16
+    assert all(len(row) == 3 for row in rows)
+
+
+def test_aggregation_query() -> None:
+    template = QueryTemplate.parse(
+        "SELECT day, y FROM points WHERE TRUE [[ AND source = :source ]]"
+    )
+    query = template.bind({"source": "a", "other": "1"})
+    aggregated = Aggregation(kind="bucket", x="day", y="y", temporal=True).query(
+        query, 10
+    )
+    assert "AND source = :source" in aggregated.sql
+    assert aggregated.params == {"source": "a"}
+    assert aggregated.key() != query.key()
+
+
+@pytest.mark.parametrize(
+    "chart,expected",
+    [
+        (
+            {"library": "line", "display": {"x": "day", "y": "count"}},
+            Aggregation(kind="bucket", x="day", y="count", temporal=True),
+        ),
+        (
+            {
+                "library": "area",
+                "display": {"x": "n", "y": "count", "xtype": "quantitative"},
+            },
+            Aggregation(kind="bucket", x="n", y="count"),
+        ),
+        (
+            {
+                "library": "line",
+                "display": {"x": "day", "y": "count", "xtype": "ordinal"},
+            },
+            None,
+        ),
+        (
+            {
+                "library": "bar",
+                "display": {"x": "source", "y": "count", "color": "job"},
+            },
+            Aggregation(kind="top", x="source", y="count", color="job"),
+        ),
+        (
+            {"library": "pie", "display": {"label": "source", "value": "count"}},
+            Aggregation(kind="top", x="source", y="count"),
+        ),
+        (
+            {
+                "library": "scatter",
+                "display": {"x": "a", "y": {"field": "b"}, "size": "c"},
+            },
+            Aggregation(kind="grid", x="a", y="b", size="c"),
+        ),
+        (
+            {
+                "library": "scatter",
+                "display": {"x": {"field": "a", "type": "nominal"}, "y": "b"},
+            },
+            None,
+        ),
+        ({"library": "table"}, None),
+    ],
+)
+def test_chart_aggregation(
+    chart: dict[str, t.Any], expected: Aggregation | None
+) -> None:
+    assert chart_aggregation(chart) == expected
+
+
+def test_top_categories_query() -> None:
+    query = QueryTemplate.parse("SELECT x, y FROM points WHERE y > :min_y").bind(
+        {"min_y": "2"}
+    )
+    top = TopCategories(category="x", value="y", top=5)
+    assert top.stats_query(query) is None
+    rewritten = top.query(query)
+    assert rewritten.sql == top_sql(query.sql, "x", "y", top=5)
+    assert rewritten.params == {"min_y": "2"}
+
+
+def test_chart_top_categories() -> None:
+    bar: dict[str, t.Any] = {
+        "library": "bar",
+        "display": {"x": "source", "y": "count", "color": "job", "top_n": 10},
+    }
+    assert chart_top_categories(bar) == TopCategories(
+        category="source", value="count", top=10, color="job"
+    )
+
+    pie: dict[str, t.Any] = {
+        "library": "pie",
+        "display": {"label": "browser", "value": "share", "top_n": 5},
+    }
+    assert chart_top_categories(pie) == TopCategories(
+        category="browser", value="share", top=5
+    )
+
+    assert chart_top_categories({"library": "pie", "display": {}}) is None
+    assert chart_top_categories({"library": "line", "display": {"top_n": 5}}) is None
+
+    pie["display"]["top_n"] = 0
+    with pytest.raises(ValueError, match="top_n must be at least 1"):
+        chart_top_categories(pie)
@@ -0,0 +1,121 @@
+import brotli
+import gzip
+import pytest
+
+from pathlib import Path
+from datasette.app import Datasette
+
+from datasette_dashboards.assets import (
+    ASSETS,
+    STATIC_DIR,
+    build_assets,
+    get_assets,
+    hashed_filename,
+    load_asset,
+    negotiate_encoding,
+)
+
+
+def test_hashed_filename() -> None:
+    name = hashed_filename("vega.min.js", b"content")
+    assert name.startswith("vega.min.") and name.endswith(".js")
+    assert name == hashed_filename("vega.min.js", b"content")
+    assert name != hashed_filename("vega.min.js", b"changed")
+
+
+def test_load_asset(tmp_path: Path) -> None:
+    asset = load_asset("dashboards.css", dist_dir=tmp_path)
+    content = (STATIC_DIR / "dashboards.css").read_bytes()
+    assert asset.filename == hashed_filename("dashboards.css", content)
+    assert asset.content_type == "text/css; charset=utf-8"
+    assert asset.encodings["identity"] == content
+    assert gzip.decompress(asset.encodings["gzip"]) == content
+
+
+def test_build_assets(tmp_path: Path) -> None:
+    dist_dir = tmp_path / "dist"
+    dist_dir.mkdir()
+    (dist_dir / "dashboards.000000000000.js.gz").write_bytes(b"stale")
+
+    written = build_assets(dist_dir=dist_dir)
+    assert sorted(dist_dir.iterdir()) == sorted(written)
+    for name in ASSETS:
+        filename = load_asset(name, dist_dir=dist_dir).filename
+        assert (dist_dir / filename).read_bytes() == (STATIC_DIR / name).read_bytes()
+        assert (dist_dir / f"{filename}.gz") in written
+
+    filename = load_asset("dashboards.js").filename
+    (dist_dir / f"{filename}.br").write_bytes(b"prebuilt")
+    assert load_asset("dashboards.js", dist_dir=dist_dir).encodings["br"] == (
+        b"prebuilt"
+    )
+
+
+def test_build_assets_brotli(tmp_path: Path) -> None:
+    written = build_assets(dist_dir=tmp_path)
+    for name in ASSETS:
+        content = (STATIC_DIR / name).read_bytes()
+        path = tmp_path / f"{hashed_filename(name, content)}.br"
+        assert path in written
+        assert brotli.decompress(path.read_bytes()) == content
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    [
+        ("", "identity"),
+        ("gzip, deflate", "gzip"),
+        ("gzip, deflate, br", "br"),
+        ("br;q=0, gzip;q=0.5", "gzip"),
+        ("*", "br"),
+        ("identity", "identity"),
+        ("gzip;q=invalid", "identity"),
+    ],
+)
+def test_negotiate_encoding(accept_encoding: str, expected: str) -> None:
+    assert negotiate_encoding(accept_encoding, ["identity", "gzip", "br"]) == expected
+
+
+@pytest.mark.asyncio
+async def test_dashboard_asset(datasette: Datasette) -> None:
+    asset = next(
+        asset for asset in get_assets().values() if asset.name == "dashboards.js"
+    )
+    url = f"/-/dashboards-assets/{asset.filename}"
+
+    response = await datasette.client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["content-type"] == "text/javascript; charset=utf-8"
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert "Accept-Encoding" in response.headers["vary"].split(", ")
+    assert response.content == asset.encodings["identity"]
+
+    response = await datasette.client.get(url, headers={"Accept-Encoding": "gzip, br"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "br"
+    assert brotli.decompress(asset.encodings["br"]) == asset.encodings["identity"]
+
+    response = await datasette.client.get(url, headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert response.content == asset.encodings["identity"]
+
+
+@pytest.mark.asyncio
+async def test_dashboard_asset_not_found(datasette: Datasette) -> None:
+    response = await datasette.client.get(
+        "/-/dashboards-assets/dashboards.000000000000.js"
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_dashboard_assets_urls(datasette: Datasette) -> None:
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard", follow_redirects=True
+    )
+    assert response.status_code == 200
+    assert "/-/static-plugins/datasette_dashboards/" not in response.text
+    for filename in get_assets():
+        assert f'"/-/dashboards-assets/{filename}"' in response.text
@@ -0,0 +1,149 @@
+import sqlite3
+import typing as t
+import pytest
+
+from datasette_dashboards.binning import (
+    HeatmapBinning,
+    HistogramBinning,
+    chart_binning,
+    freedman_diaconis_bins,
+    heatmap_sql,
+    histogram_sql,
+    histogram_stats_sql,
+)
+from datasette_dashboards.cache import QueryResults
+from datasette_dashboards.query import QueryTemplate
+
+
+@pytest.fixture
+def conn() -> t.Iterator[sqlite3.Connection]:
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE points (x INTEGER, y REAL)")
+    conn.executemany(
+        "INSERT INTO points VALUES (?, ?)",
+        [(i % 100, (i * 7) % 50 / 10) for i in range(10000)] + [(None, 1.0)],
+    )
+    yield conn
+    conn.close()
+
+
+def test_heatmap_sql(conn: sqlite3.Connection) -> None:
+    sql = heatmap_sql("SELECT x, y FROM points;", "x", "y", 10, 5)
+    cursor = conn.execute(sql)
+    assert [col[0] for col in cursor.description] == [
+        "x",
+        "x_end",
+        "y",
+        "y_end",
+        "count",
+    ]
+    rows = cursor.fetchall()
+    assert 0 < len(rows) <= 50
+    assert sum(row[4] for row in rows) == 10000
+    assert all(row[4] > 0 for row in rows)
+    assert min(row[0] for row in rows) == 0
+    assert max(row[1] for row in rows) == pytest.approx(99)
+    assert min(row[2] for row in rows) == 0
+    assert max(row[3] for row in rows) == pytest.approx(4.9)
+    assert rows[0][1] - rows[0][0] == pytest.approx(9.9)
+
+
+def test_heatmap_sql_single_value(conn: sqlite3.Connection) -> None:
+    sql = heatmap_sql("SELECT 1 AS x, 2 AS y FROM points", "x", "y", 10, 10)
+    assert conn.execute(sql).fetchall() == [(1, 1.1, 2, 2.1, 10001)]
+
+
+def test_heatmap_binning_query() -> None:
+    template = QueryTemplate.parse(
+        "SELECT x, y FROM points WHERE TRUE [[ AND x > :min_x ]]"
+    )
+    query = template.bind({"min_x": "3"})
+    binned = HeatmapBinning(x="x", y="y").query(query)
+    assert "AND x > :min_x" in binned.sql
+    assert binned.params == {"min_x": "3"}
+
+
+def test_chart_binning() -> None:
+    chart: dict[str, t.Any] = {
+        "library": "heatmap",
+        "display": {"x": {"field": "a"}, "y": "b"},
+    }
+    assert chart_binning(chart) == HeatmapBinning(x="a", y="b", x_bins=30, y_bins=30)
+
+    chart["display"]["bins"] = 20
+    assert chart_binning(chart) == HeatmapBinning(x="a", y="b", x_bins=20, y_bins=20)
+
+    chart["display"]["bins"] = {"x": 40}
+    assert chart_binning(chart) == HeatmapBinning(x="a", y="b", x_bins=40, y_bins=30)
+
+    chart["display"]["bins"] = 0
+    with pytest.raises(ValueError, match="bins must be at least 1"):
+        chart_binning(chart)
+
+    assert chart_binning({"library": "scatter", "display": {}}) is None
+
+
+def test_histogram_sql_bins(conn: sqlite3.Connection) -> None:
+    cursor = conn.execute(histogram_sql("SELECT x FROM points", "x", bins=10))
+    assert [col[0] for col in cursor.description] == ["x", "x_end", "count"]
+    rows = cursor.fetchall()
+    assert len(rows) == 10
+    assert rows[0][:2] == (0, pytest.approx(9.9))
+    assert rows[-1][1] == pytest.approx(99)
+    assert sum(row[2] for row in rows) == 10000
+
+
+def test_histogram_sql_width(conn: sqlite3.Connection) -> None:
+    sql = "SELECT x - 50 AS x FROM points"
+    rows = conn.execute(histogram_sql(sql, "x", width=25)).fetchall()
+    assert [row[:2] for row in rows] == [(-50, -25), (-25, 0), (0, 25), (25, 50)]
+    assert [row[2] for row in rows] == [2500, 2500, 2500, 2500]
+
+    cursor = conn.execute(histogram_sql("SELECT y AS x FROM points", "x", width=0.5))
+    assert [row[0] for row in cursor] == [0, 0.5, 1, 1.5, 2, 2.5, 3, 3.5, 4, 4.5]
+
+
+def test_histogram_stats_sql(conn: sqlite3.Connection) -> None:
+    sql = histogram_stats_sql("SELECT x FROM points", "x")
+    assert conn.execute(sql).fetchall() == [(10000, 0, 99, 25, 75)]
+
+
+def test_freedman_diaconis_bins() -> None:
+    assert freedman_diaconis_bins(1000, 0, 100, 25, 75) == 10
+    assert freedman_diaconis_bins(1000, 0, 100, 50, 50) == 11
+    assert freedman_diaconis_bins(10**9, 0, 1e6, 0, 1) == 200
+    assert freedman_diaconis_bins(0, None, None, 0, 0) == 1
+    assert freedman_diaconis_bins(10, 3, 3, 3, 3) == 1
+
+
+def test_histogram_binning_auto() -> None:
+    query = QueryTemplate.parse("SELECT x FROM points WHERE x > :min_x").bind(
+        {"min_x": "1"}
+    )
+    binning = HistogramBinning(x="x", bins=None)
+    stats_query = binning.stats_query(query)
+    assert stats_query is not None
+    assert stats_query.params == {"min_x": "1"}
+
+    stats = QueryResults(
+        columns=("_count", "_low", "_high", "_q1", "_q3"),
+        rows=[(1000, 0, 100, 25, 75)],
+        truncated=False,
+    )
+    assert binning.query(query, stats).sql == histogram_sql(query.sql, "x", bins=10)
+    assert HistogramBinning(x="x").stats_query(query) is None
+
+
+def test_chart_binning_histogram() -> None:
+    chart: dict[str, t.Any] = {"library": "histogram", "display": {"x": "a"}}
+    assert chart_binning(chart) == HistogramBinning(x="a", bins=20)
+
+    chart["display"]["bins"] = "auto"
+    assert chart_binning(chart) == HistogramBinning(x="a", bins=None)
+
+    chart["display"]["bin_width"] = 2.5
+    assert chart_binning(chart) == HistogramBinning(x="a", bins=None, width=2.5)
+
+    chart["display"]["bin_width"] = 0
+    with pytest.raises(ValueError, match="bin_width must be positive"):
+        chart_binning(chart)
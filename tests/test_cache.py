@@ -0,0 +1,510 @@
+import asyncio
+import copy
+import math
+import sqlite3
+import time
+import typing as t
+import pytest
+import sqlite_utils
+
+from pathlib import Path
+from datasette.app import Datasette
+
+from datasette_dashboards.cache import (
+    CacheKey,
+    DiskResultCache,
+    InflightQueries,
+    QueryResults,
+    ResultCache,
+    cache_key,
+    database_version,
+    get_cache,
+    get_inflight,
+)
+from datasette_dashboards.data import _refresh_tasks, execute_query
+from datasette_dashboards.query import QueryTemplate
+
+
+def _results(value: int) -> QueryResults:
+    return QueryResults(columns=("value",), rows=[(value,)], truncated=False)
+
+
+def _key(sql: str) -> CacheKey:
+    return cache_key("db", QueryTemplate.parse(sql).bind({}), False)
+
+
+def test_cache_key_ignores_params_order() -> None:
+    template = QueryTemplate.parse("SELECT :a, :b")
+    assert cache_key("db", template.bind({"a": "1", "b": "2"}), True) == cache_key(
+        "db", template.bind({"b": "2", "a": "1"}), True
+    )
+    assert cache_key("db", template.bind({}), True) != cache_key(
+        "db", template.bind({}), False
+    )
+
+
+def test_cache_key_optional_segments() -> None:
+    template = QueryTemplate.parse("SELECT * FROM t WHERE TRUE [[ AND a = :a ]]")
+    assert cache_key("db", template.bind({"a": ""}), True) == cache_key(
+        "db", template.bind({}), True
+    )
+    assert cache_key("db", template.bind({"a": "1"}), True) != cache_key(
+        "db", template.bind({}), True
+    )
+    assert cache_key("db", template.bind({"b": "1"}), True) == cache_key(
+        "db", template.bind({}), True
+    )
+
+
+def test_result_cache_hit_and_miss() -> None:
+    cache = ResultCache()
+    key = _key("SELECT 1")
+    assert cache.get(key) is None
+    cache.set(key, _results(1), 60)
+    assert cache.get(key) == _results(1)
+    assert cache.stats() == {
+        "size": 1,
+        "max_size": cache.max_size,
+        "hits": 1,
+        "stale_hits": 0,
+        "misses": 1,
+        "evictions": 0,
+        "invalidations": 0,
+    }
+
+
+def test_result_cache_lru_eviction() -> None:
+    cache = ResultCache(max_size=2)
+    keys = [_key(f"SELECT {i}") for i in range(3)]
+    cache.set(keys[0], _results(0), 60)
+    cache.set(keys[1], _results(1), 60)
+    assert cache.get(keys[0]) is not None
+    cache.set(keys[2], _results(2), 60)
+
+    assert len(cache) == 2
+    assert cache.evictions == 1
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == _results(0)
+    assert cache.get(keys[2]) == _results(2)
+
+
+def test_result_cache_ttl_expiry(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+
+    cache = ResultCache()
+    key = _key("SELECT 1")
+    cache.set(key, _results(1), 10)
+    assert cache.get(key) is not None
+
+    now += 10
+    assert cache.get(key) is None
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_cache(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    metadata = copy.deepcopy(datasette_metadata)
+    dashboard = metadata["plugins"]["datasette-dashboards"]["job-dashboard"]
+    dashboard["settings"]["cache_ttl"] = 60
+    dashboard["charts"]["offers-bar"]["cache_ttl"] = 0
+    datasette = Datasette([str(datasette_db)], metadata=metadata)
+    cache = get_cache(datasette)
+
+    url = "/-/dashboards/job-dashboard/data.json?_chart=offers-pie&_chart=offers-bar"
+    first = await datasette.client.get(url)
+    assert first.status_code == 200
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    second = await datasette.client.get(url)
+    assert second.status_code == 200
+    assert second.json() == first.json()
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard?date_start=2021-01-01"
+    )
+    assert response.status_code == 200
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard?date_start=2021-01-01"
+    )
+    assert response.status_code == 200
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_cache_disabled(datasette: Datasette) -> None:
+    cache = get_cache(datasette)
+    response = await datasette.client.get("/-/dashboards/job-dashboard/data.json")
+    assert response.status_code == 200
+    assert len(cache) == 0
+
+
+def test_result_cache_version_invalidation() -> None:
+    cache = ResultCache()
+    key = _key("SELECT 1")
+    cache.set(key, _results(1), 60, version=(1, 2))
+    assert cache.get(key, (1, 2)) == _results(1)
+    assert cache.get(key, (1, 3)) is None
+    assert cache.invalidations == 1
+    assert len(cache) == 0
+
+
+def test_database_version(tmp_path: Path) -> None:
+    db_path = tmp_path / "version.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("items").insert({"id": 1}, pk="id")
+
+    datasette = Datasette([str(db_path)])
+    database = datasette.get_database("version")
+    version = database_version(database)
+    assert version is not None
+    assert database_version(database) == version
+
+    db.table("items").insert({"id": 2}, pk="id")
+    assert database_version(database) != version
+
+    immutable = Datasette(immutables=[str(db_path)]).get_database("version")
+    version = database_version(immutable)
+    assert version is not None
+    assert database_version(immutable) == version
+    db.table("items").insert({"id": 3}, pk="id")
+    replaced = Datasette(immutables=[str(db_path)]).get_database("version")
+    assert database_version(replaced) != version
+
+    inspected = Datasette(
+        immutables=[str(db_path)],
+        inspect_data={"version": {"hash": "abc", "file": str(db_path)}},
+    ).get_database("version")
+    assert database_version(inspected) == "abc"
+
+    memory = Datasette(memory=True).get_database("_memory")
+    assert database_version(memory) is None
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_cache_data_version(tmp_path: Path) -> None:
+    db_path = tmp_path / "events.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("events").insert_all([{"id": i} for i in range(3)], pk="id")
+
+    metadata = {
+        "plugins": {
+            "datasette-dashboards": {
+                "events": {
+                    "title": "Events",
+                    "settings": {"cache_invalidation": "data_version"},
+                    "charts": {
+                        "events-count": {
+                            "db": "events",
+                            "query": "SELECT count(*) as count FROM events",
+                            "library": "metric",
+                            "display": {"field": "count"},
+                        }
+                    },
+                }
+            }
+        }
+    }
+    datasette = Datasette([str(db_path)], metadata=metadata)
+    cache = get_cache(datasette)
+    url = "/-/dashboards/events/data.json"
+
+    response = await datasette.client.get(url)
+    assert response.json()["charts"]["events-count"]["rows"] == [{"count": 3}]
+    response = await datasette.client.get(url)
+    assert response.json()["charts"]["events-count"]["rows"] == [{"count": 3}]
+    assert (cache.hits, cache.misses, cache.invalidations) == (1, 1, 0)
+
+    db.table("events").insert({"id": 3}, pk="id")
+
+    response = await datasette.client.get(url)
+    assert response.json()["charts"]["events-count"]["rows"] == [{"count": 4}]
+    assert (cache.hits, cache.misses, cache.invalidations) == (1, 2, 1)
+
+
+@pytest.mark.asyncio
+async def test_inflight_queries_coalesced() -> None:
+    inflight = InflightQueries()
+    release = asyncio.Event()
+    calls = []
+
+    async def execute() -> QueryResults:
+        calls.append(1)
+        await release.wait()
+        return _results(len(calls))
+
+    key = _key("SELECT 1")
+    waiters = [asyncio.ensure_future(inflight.run(key, execute)) for _ in range(3)]
+    other = asyncio.ensure_future(inflight.run(_key("SELECT 2"), execute))
+    await asyncio.sleep(0)
+    assert len(inflight) == 2
+
+    release.set()
+    results = await asyncio.gather(*waiters)
+    assert all(r is results[0] for r in results)
+    assert (await other) is not results[0]
+    assert len(calls) == 2
+    assert inflight.stats() == {"inflight": 0, "executions": 2, "coalesced": 2}
+
+
+@pytest.mark.asyncio
+async def test_inflight_queries_error() -> None:
+    inflight = InflightQueries()
+
+    async def execute() -> QueryResults:
+        await asyncio.sleep(0)
+        raise ValueError("boom")
+
+    key = _key("SELECT 1")
+    results = await asyncio.gather(
+        inflight.run(key, execute), inflight.run(key, execute), return_exceptions=True
+    )
+    assert all(isinstance(r, ValueError) for r in results)
+    assert inflight.executions == 1
+    assert len(inflight) == 0
+
+
+@pytest.mark.asyncio
+async def test_inflight_queries_waiter_cancelled() -> None:
+    inflight = InflightQueries()
+    release = asyncio.Event()
+
+    async def execute() -> QueryResults:
+        await release.wait()
+        return _results(1)
+
+    key = _key("SELECT 1")
+    first = asyncio.ensure_future(inflight.run(key, execute))
+    second = asyncio.ensure_future(inflight.run(key, execute))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+
+    release.set()
+    assert await second == _results(1)
+    assert first.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_coalesced(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    metadata = copy.deepcopy(datasette_metadata)
+    charts = metadata["plugins"]["datasette-dashboards"]["job-dashboard"]["charts"]
+    charts["offers-bar-copy"] = copy.deepcopy(charts["offers-bar"])
+    datasette = Datasette([str(datasette_db)], metadata=metadata)
+    inflight = get_inflight(datasette)
+
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json?_chart=offers-bar&_chart=offers-bar-copy"
+    )
+    assert response.status_code == 200
+    data = response.json()["charts"]
+    assert data["offers-bar"] == data["offers-bar-copy"]
+    assert (inflight.executions, inflight.coalesced) == (1, 1)
+
+
+def test_result_cache_stale_lookup(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+
+    cache = ResultCache()
+    key = _key("SELECT 1")
+    cache.set(key, _results(1), 10)
+    assert cache.lookup(key, max_stale=30) == (_results(1), False)
+
+    now += 20
+    assert cache.lookup(key, max_stale=30) == (_results(1), True)
+    assert cache.get(key) is None
+    assert (cache.hits, cache.stale_hits, cache.misses) == (1, 1, 1)
+
+
+@pytest.mark.asyncio
+async def test_execute_query_stale_while_revalidate(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    now = 1000.0
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+
+    datasette = Datasette(memory=True)
+    cache = get_cache(datasette)
+    query = QueryTemplate.parse("SELECT random() AS value").bind({})
+
+    async def value() -> t.Any:
+        results = await execute_query(
+            datasette, "_memory", query, cache_ttl=10, cache_max_stale=60
+        )
+        return results.rows[0][0]
+
+    first = await value()
+    assert await value() == first
+
+    now += 30
+    assert await value() == first
+    assert len(_refresh_tasks) == 1
+    await asyncio.gather(*_refresh_tasks)
+
+    refreshed = await value()
+    assert refreshed != first
+    assert (cache.hits, cache.stale_hits, cache.misses) == (2, 1, 1)
+
+    now += 100
+    assert await value() != refreshed
+    assert cache.misses == 2
+
+
+def test_disk_result_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    path = str(tmp_path / "cache.db")
+    cache = DiskResultCache(path)
+    key = _key("SELECT 1")
+    assert cache.get(key) is None
+
+    results = QueryResults(
+        columns=("a", "b"), rows=[(1, "x"), (2.5, None), (3, b"\x00")], truncated=True
+    )
+    cache.set(key, results, 10, version=(1, 2))
+    assert cache.get(key, (1, 2)) == results
+
+    # Shared with other processes and across restarts
+    other = DiskResultCache(path)
+    assert other.get(key, (1, 2)) == results
+    assert len(other) == 1
+
+    now += 20
+    assert other.lookup(key, (1, 2), max_stale=30) == (results, True)
+    assert other.get(key, (1, 2)) is None
+    assert len(cache) == 0
+
+    cache.set(key, results, 10, version=(1, 2))
+    assert cache.get(key, (1, 3)) is None
+    assert cache.stats() == {
+        "size": 0,
+        "bytes": 0,
+        "max_bytes": cache.max_bytes,
+        "hits": 1,
+        "stale_hits": 0,
+        "misses": 2,
+        "evictions": 0,
+        "invalidations": 1,
+        "errors": 0,
+    }
+
+
+def test_disk_result_cache_size_eviction(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    now = 1000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    cache = DiskResultCache(str(tmp_path / "cache.db"))
+    keys = [_key(f"SELECT {i}") for i in range(4)]
+    cache.set(keys[0], _results(0), 60)
+    cache.max_bytes = cache.stats()["bytes"] * 3
+
+    for i in (1, 2):
+        now += 1
+        cache.set(keys[i], _results(i), 60)
+    now += 1
+    assert cache.get(keys[0]) is not None
+
+    now += 1
+    cache.set(keys[3], _results(3), 60)
+    assert len(cache) == 3
+    assert cache.evictions == 1
+    assert cache.get(keys[1]) is None
+    assert all(cache.get(keys[i]) is not None for i in (0, 2, 3))
+
+
+def test_disk_result_cache_total_bytes(tmp_path: Path) -> None:
+    path = tmp_path / "cache.db"
+    cache = DiskResultCache(str(path))
+    assert not path.exists()
+
+    keys = [_key(f"SELECT {i}") for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.set(key, _results(i), 60, version=1)
+    cache.set(keys[0], _results(10), 60, version=1)
+    assert cache.get(keys[1], version=2) is None
+
+    db = sqlite_utils.Database(path)
+    total = db.execute("SELECT sum(size) FROM results").fetchone()[0]
+    assert cache.stats()["bytes"] == total
+    assert cache.stats()["size"] == 2
+
+    # Files of previous versions get their total computed once
+    db.execute("DROP TABLE totals")
+    db.conn.commit()
+    assert DiskResultCache(str(path)).stats()["bytes"] == total
+
+
+@pytest.mark.asyncio
+async def test_disk_result_cache_async(tmp_path: Path) -> None:
+    cache = DiskResultCache(str(tmp_path / "cache.db"))
+    key = _key("SELECT 1")
+    assert await cache.alookup(key) is None
+    await cache.aset(key, _results(1), 60)
+    assert await cache.alookup(key) == (_results(1), False)
+
+
+def test_disk_result_cache_write_locked(tmp_path: Path) -> None:
+    path = str(tmp_path / "cache.db")
+    cache = DiskResultCache(path)
+    key = _key("SELECT 1")
+    cache.set(key, _results(1), 60, version=1)
+
+    # Another worker writing to the cache does not turn hits into misses
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        assert cache.get(key, version=1) == _results(1)
+        assert cache.get(key, version=2) is None
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    assert (cache.hits, cache.misses, cache.errors) == (1, 1, 0)
+
+
+def test_disk_result_cache_errors(tmp_path: Path) -> None:
+    path = str(tmp_path / "cache.db")
+    cache = DiskResultCache(path)
+    key = _key("SELECT 1")
+    cache.set(key, _results(1), math.inf)
+    assert cache.get(key) == _results(1)
+
+    db = sqlite_utils.Database(path)
+    db.execute("UPDATE results SET payload = x'00'")
+    db.conn.commit()
+    assert cache.get(key) is None
+    assert cache.errors == 1
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_disk_cache(
+    tmp_path: Path, datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    metadata = copy.deepcopy(datasette_metadata)
+    dashboard = metadata["plugins"]["datasette-dashboards"]["job-dashboard"]
+    dashboard["settings"]["cache_ttl"] = 60
+    dashboard["settings"]["cache_path"] = str(tmp_path / "cache.db")
+    url = "/-/dashboards/job-dashboard/data.json?_chart=offers-bar"
+
+    datasette = Datasette([str(datasette_db)], metadata=metadata)
+    first = await datasette.client.get(url)
+    assert first.status_code == 200
+    assert len(get_cache(datasette)) == 0
+
+    cache = get_cache(datasette, str(tmp_path / "cache.db"))
+    assert isinstance(cache, DiskResultCache)
+    assert len(cache) == 1
+
+    worker = Datasette([str(datasette_db)], metadata=metadata)
+    second = await worker.client.get(url)
+    assert second.json() == first.json()
+    assert get_inflight(worker).executions == 0
+    assert cache.hits == 1
@@ -378,6 +378,65 @@ def test_scatter_with_color_and_size() -> None:
     assert encoding["size"] == {"field": "volume", "type": "quantitative"}
 
 
+# --- heatmap chart ---
+
+
+def test_heatmap_simple_fields() -> None:
+    chart: dict[str, t.Any] = {
+        "library": "heatmap",
+        "display": {"x": "price", "y": "rating"},
+    }
+    result = convert_chart_type(chart)
+    assert result["library"] == "vega-lite"
+    assert result["display"]["mark"] == {"type": "rect", "tooltip": True}
+    encoding = result["display"]["encoding"]
+    assert encoding["x"] == {
+        "field": "price",
+        "type": "quantitative",
+        "bin": {"binned": True},
+    }
+    assert encoding["x2"] == {"field": "price_end"}
+    assert encoding["y"] == {
+        "field": "rating",
+        "type": "quantitative",
+        "bin": {"binned": True},
+    }
+    assert encoding["y2"] == {"field": "rating_end"}
+    assert encoding["color"] == {
+        "field": "count",
+        "type": "quantitative",
+        "scale": {"scheme": "blues"},
+    }
+
+
+def test_heatmap_custom_color_scheme() -> None:
+    chart: dict[str, t.Any] = {
+        "library": "heatmap",
+        "display": {"x": "price", "y": "rating", "color_scheme": "viridis"},
+    }
+    result = convert_chart_type(chart)
+    color = result["display"]["encoding"]["color"]
+    assert color["scale"] == {"scheme": "viridis"}
+
+
+# --- histogram chart ---
+
+
+def test_histogram_simple_fields() -> None:
+    chart: dict[str, t.Any] = {
+        "library": "histogram",
+        "display": {"x": "salary"},
+    }
+    result = convert_chart_type(chart)
+    assert result["library"] == "vega-lite"
+    assert result["display"]["mark"] == {"type": "bar", "tooltip": True}
+    assert result["display"]["encoding"] == {
+        "x": {"field": "salary", "type": "quantitative", "bin": {"binned": True}},
+        "x2": {"field": "salary_end"},
+        "y": {"field": "count", "type": "quantitative"},
+    }
+
+
 # --- pie chart ---
 
 
@@ -649,6 +708,8 @@ def test_all_chart_types_present() -> None:
         "bar",
         "area",
         "scatter",
+        "heatmap",
+        "histogram",
         "pie",
         "choropleth",
         "wordcloud",
@@ -0,0 +1,206 @@
+import copy
+import email.utils
+import os
+import typing as t
+import pytest
+import sqlite_utils
+
+from pathlib import Path
+from datasette.app import Datasette
+from datasette.utils.asgi import Request
+
+from datasette_dashboards.conditional import (
+    cache_control,
+    caching_headers,
+    dashboard_last_modified,
+    not_modified,
+)
+from datasette_dashboards.registry import get_registry
+
+
+def _request(headers: dict[str, str] | None = None) -> Request:
+    request = Request.fake("/")
+    request.scope["headers"] = [
+        (key.encode("latin-1"), value.encode("latin-1"))
+        for key, value in (headers or {}).items()
+    ]
+    return request
+
+
+def test_cache_control() -> None:
+    assert cache_control(_request(), {}) == "no-cache"
+    assert cache_control(_request(), {"max_age": 60}) == "max-age=60"
+    assert (
+        cache_control(_request(), {"max_age": 60, "stale_while_revalidate": 300})
+        == "max-age=60, stale-while-revalidate=300"
+    )
+
+    request = _request()
+    request.scope["actor"] = {"id": "user"}
+    assert cache_control(request, {"max_age": 60}) == "private, max-age=60"
+
+
+def test_caching_headers() -> None:
+    headers = caching_headers(_request(), {"max_age": 60}, '"abc"', 1000.0)
+    assert headers == {
+        "Cache-Control": "max-age=60",
+        "Vary": "Cookie",
+        "ETag": '"abc"',
+        "Last-Modified": email.utils.formatdate(1000.0, usegmt=True),
+    }
+
+
+def test_dashboard_last_modified(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    # Every process serves the same Last-Modified, based on the databases only
+    workers = [
+        Datasette([str(datasette_db)], metadata=datasette_metadata) for _ in range(2)
+    ]
+    modified = [
+        dashboard_last_modified(
+            worker, get_registry(worker).dashboards["job-dashboard"], ["test"]
+        )
+        for worker in workers
+    ]
+    assert modified == [os.stat(datasette_db).st_mtime] * 2
+
+    dashboard = get_registry(workers[0]).dashboards["job-dashboard"]
+    assert dashboard_last_modified(workers[0], dashboard, []) is None
+
+
+def test_not_modified() -> None:
+    etag = '"abc"'
+    assert not not_modified(_request(), etag, 1000.0)
+    assert not_modified(_request({"if-none-match": etag}), etag, 1000.0)
+    assert not_modified(_request({"if-none-match": f"W/{etag}"}), etag, 1000.0)
+    assert not_modified(_request({"if-none-match": f'"x", {etag}'}), etag, 1000.0)
+    assert not_modified(_request({"if-none-match": "*"}), etag, 1000.0)
+    assert not not_modified(_request({"if-none-match": '"x"'}), etag, 1000.0)
+    assert not not_modified(_request({"if-none-match": etag}), None, 1000.0)
+
+    since = email.utils.formatdate(1000.5, usegmt=True)
+    assert not_modified(_request({"if-modified-since": since}), etag, 1000.5)
+    assert not not_modified(_request({"if-modified-since": since}), etag, 1001.0)
+    assert not not_modified(_request({"if-modified-since": since}), etag, None)
+    assert not not_modified(_request({"if-modified-since": "invalid"}), etag, 1.0)
+    assert not not_modified(
+        _request({"if-none-match": '"x"', "if-modified-since": since}), etag, 1000.0
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "path",
+    [
+        "/-/dashboards/job-dashboard?date_start=2021-01-01",
+        "/-/dashboards/job-dashboard/embed?date_start=2021-01-01",
+        "/-/dashboards/job-dashboard/offers-day?date_start=2021-01-01",
+        "/-/dashboards/job-dashboard/offers-day/embed?date_start=2021-01-01",
+        "/-/dashboards/job-dashboard/data.json?date_start=2021-01-01",
+    ],
+)
+async def test_dashboard_conditional_requests(datasette: Datasette, path: str) -> None:
+    response = await datasette.client.get(path)
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "no-cache"
+    etag = response.headers["etag"]
+    last_modified = response.headers["last-modified"]
+
+    response = await datasette.client.get(path, headers={"if-none-match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+
+    response = await datasette.client.get(
+        path, headers={"if-modified-since": last_modified}
+    )
+    assert response.status_code == 304
+
+    other = await datasette.client.get(path.replace("2021-01-01", "2022-01-01"))
+    assert other.headers["etag"] != etag
+
+
+@pytest.mark.asyncio
+async def test_dashboard_etag_changes(
+    tmp_path: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    db_path = tmp_path / "test.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("jobs").insert({"id": 1, "date": "2021-01-01", "source": "a", "job": "b"})
+    metadata = copy.deepcopy(datasette_metadata)
+    path = "/-/dashboards/job-dashboard?date_start=2021-01-01"
+
+    datasette = Datasette([str(db_path)], metadata=metadata)
+    etag = (await datasette.client.get(path)).headers["etag"]
+    assert (await datasette.client.get(path)).headers["etag"] == etag
+
+    db.table("jobs").insert({"id": 2, "date": "2021-01-02", "source": "a", "job": "c"})
+    response = await datasette.client.get(path, headers={"if-none-match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    etag = response.headers["etag"]
+
+    metadata["plugins"]["datasette-dashboards"]["job-dashboard"]["title"] = "Changed"
+    datasette = Datasette([str(db_path)], metadata=metadata)
+    response = await datasette.client.get(path, headers={"if-none-match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+@pytest.mark.asyncio
+async def test_dashboard_cache_control_settings(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    metadata = copy.deepcopy(datasette_metadata)
+    dashboard = metadata["plugins"]["datasette-dashboards"]["job-dashboard"]
+    dashboard["settings"]["max_age"] = 60
+    dashboard["settings"]["stale_while_revalidate"] = 600
+    datasette = Datasette([str(datasette_db)], metadata=metadata)
+
+    for path in [
+        "/-/dashboards/job-dashboard?date_start=2021-01-01",
+        "/-/dashboards/job-dashboard/data.json",
+    ]:
+        response = await datasette.client.get(path)
+        assert response.status_code == 200
+        assert (
+            response.headers["cache-control"]
+            == "max-age=60, stale-while-revalidate=600"
+        )
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_etag_memory_database() -> None:
+    datasette = Datasette(
+        memory=True,
+        metadata={
+            "plugins": {
+                "datasette-dashboards": {
+                    "memory": {
+                        "title": "Memory",
+                        "charts": {
+                            "one": {
+                                "db": "_memory",
+                                "query": "SELECT 1 as value",
+                                "library": "metric",
+                                "display": {"field": "value"},
+                            }
+                        },
+                    }
+                }
+            }
+        },
+    )
+    path = "/-/dashboards/memory/data.json"
+    response = await datasette.client.get(path)
+    assert response.status_code == 200
+    assert "last-modified" not in response.headers
+    etag = response.headers["etag"]
+
+    response = await datasette.client.get(path, headers={"if-none-match": etag})
+    assert response.status_code == 304
+
+    response = await datasette.client.get("/-/dashboards/memory")
+    assert response.status_code == 200
+    assert "etag" not in response.headers
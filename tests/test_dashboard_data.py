@@ -0,0 +1,547 @@
+import copy
+import typing as t
+import pytest
+import sqlite_utils
+
+from pathlib import Path
+from datasette.app import Datasette
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data(datasette: Datasette) -> None:
+    dashboard = datasette._metadata["plugins"]["datasette-dashboards"]["job-dashboard"]
+    response = await datasette.client.get("/-/dashboards/job-dashboard/data.json")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/json")
+
+    data = response.json()
+    assert data["ok"] is True
+    expected = {
+        chart_slug
+        for chart_slug, chart in dashboard["charts"].items()
+        if "db" in chart and "query" in chart
+    }
+    assert set(data["charts"].keys()) == expected
+
+    offers_bar = data["charts"]["offers-bar"]
+    assert offers_bar["ok"] is True
+    assert offers_bar["columns"] == ["source", "count"]
+    assert offers_bar["truncated"] is False
+    assert sum(row["count"] for row in offers_bar["rows"]) == 10
+
+    offers_count = data["charts"]["offers-count"]
+    assert offers_count["ok"] is False
+    assert "offers_view" in offers_count["error"]
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_parameters(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    metadata = copy.deepcopy(datasette_metadata)
+    metadata["plugins"]["datasette-dashboards"]["job-dashboard"]["charts"][
+        "offers-filtered"
+    ] = {
+        "db": "test",
+        "query": "SELECT count(*) as count FROM jobs WHERE TRUE [[ AND id <= :number_filter ]]",
+        "library": "metric",
+        "display": {"field": "count"},
+    }
+    datasette = Datasette([str(datasette_db)], metadata=metadata)
+
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json?_chart=offers-filtered"
+    )
+    assert response.status_code == 200
+    assert response.json()["charts"] == {
+        "offers-filtered": {
+            "ok": True,
+            "columns": ["count"],
+            "rows": [{"count": 10}],
+            "truncated": False,
+        }
+    }
+
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json?_chart=offers-filtered&number_filter=3"
+    )
+    assert response.status_code == 200
+    assert response.json()["charts"]["offers-filtered"]["rows"] == [{"count": 3}]
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_select_charts(datasette: Datasette) -> None:
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json?_chart=offers-bar&_chart=offers-pie"
+    )
+    assert response.status_code == 200
+    assert set(response.json()["charts"].keys()) == {"offers-bar", "offers-pie"}
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_unknown_chart(datasette: Datasette) -> None:
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json?_chart=unknown-chart"
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_unknown_dashboard(datasette: Datasette) -> None:
+    response = await datasette.client.get("/-/dashboards/unknown-dashboard/data.json")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "metadata,authenticated,expected_status",
+    [
+        ({"allow": False}, False, 403),
+        ({"allow_sql": False}, True, 403),
+        ({"allow": True}, False, 200),
+        ({"allow_sql": {"id": "user"}}, False, 403),
+        ({"allow_sql": {"id": "user"}}, True, 200),
+        ({"databases": {"test": {"allow": {"id": "user"}}}}, False, 403),
+        ({"databases": {"test": {"allow": {"id": "user"}}}}, True, 200),
+    ],
+)
+async def test_dashboard_data_permissions(
+    datasette_db: Path,
+    datasette_metadata: t.Dict[str, t.Any],
+    metadata: t.Dict[str, t.Any],
+    authenticated: bool,
+    expected_status: int,
+) -> None:
+    datasette = Datasette(
+        [str(datasette_db)], metadata={**datasette_metadata, **metadata}
+    )
+
+    cookies = {}
+    if authenticated:
+        cookies["ds_actor"] = datasette.sign({"a": {"id": "user"}}, "actor")
+
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json", cookies=cookies
+    )
+    assert response.status_code == expected_status
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_chart_order(datasette: Datasette) -> None:
+    url = "/-/dashboards/job-dashboard/data.json"
+    first = await datasette.client.get(f"{url}?_chart=offers-bar&_chart=offers-area")
+    second = await datasette.client.get(f"{url}?_chart=offers-area&_chart=offers-bar")
+    assert first.headers["etag"] == second.headers["etag"]
+    assert first.content == second.content
+    assert list(first.json()["charts"]) == ["offers-area", "offers-bar"]
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_etag(datasette: Datasette) -> None:
+    url = "/-/dashboards/job-dashboard/data.json?_chart=offers-bar"
+    response = await datasette.client.get(url)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert etag.startswith('"') and etag.endswith('"')
+
+    response = await datasette.client.get(url, headers={"if-none-match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+
+    response = await datasette.client.get(
+        url, headers={"if-none-match": f'"other", W/{etag}'}
+    )
+    assert response.status_code == 304
+
+    response = await datasette.client.get(url, headers={"if-none-match": '"other"'})
+    assert response.status_code == 200
+
+    other = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json?_chart=offers-source"
+    )
+    assert other.headers["etag"] != etag
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_etag_changes_with_data(tmp_path: Path) -> None:
+    db_path = tmp_path / "events.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("events").insert_all([{"id": i} for i in range(3)], pk="id")
+
+    metadata = {
+        "plugins": {
+            "datasette-dashboards": {
+                "events": {
+                    "title": "Events",
+                    "charts": {
+                        "events-count": {
+                            "db": "events",
+                            "query": "SELECT count(*) as count FROM events",
+                            "library": "metric",
+                            "display": {"field": "count"},
+                        }
+                    },
+                }
+            }
+        }
+    }
+    datasette = Datasette([str(db_path)], metadata=metadata)
+    url = "/-/dashboards/events/data.json"
+
+    response = await datasette.client.get(url)
+    etag = response.headers["etag"]
+
+    db.table("events").insert({"id": 3}, pk="id")
+
+    response = await datasette.client.get(url, headers={"if-none-match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json()["charts"]["events-count"]["rows"] == [{"count": 4}]
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_downsample(tmp_path: Path) -> None:
+    db_path = tmp_path / "metrics.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("metrics").insert_all(
+        [
+            {"id": i, "ts": i, "sensor": sensor, "value": (i * 7919) % 101}
+            for i in range(2000)
+            for sensor in ("a", "b")
+        ]
+    )
+
+    metadata = {
+        "plugins": {
+            "datasette-dashboards": {
+                "metrics": {
+                    "title": "Metrics",
+                    "charts": {
+                        "values": {
+                            "db": "metrics",
+                            "query": "SELECT ts, sensor, value FROM metrics ORDER BY ts",
+                            "library": "line",
+                            "display": {
+                                "x": {"field": "ts", "type": "quantitative"},
+                                "y": "value",
+                                "color": "sensor",
+                                "downsample": {"points": 200, "method": "m4"},
+                            },
+                        }
+                    },
+                }
+            }
+        }
+    }
+    datasette = Datasette([str(db_path)], metadata=metadata)
+    response = await datasette.client.get("/-/dashboards/metrics/data.json")
+    chart = response.json()["charts"]["values"]
+
+    assert chart["ok"] is True
+    assert chart["truncated"] is False
+    for sensor in ("a", "b"):
+        rows = [row for row in chart["rows"] if row["sensor"] == sensor]
+        assert 100 < len(rows) <= 200
+        assert rows[0]["ts"] == 0
+        assert rows[-1]["ts"] == 1999
+        assert {row["value"] for row in rows} >= {0, 100}
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_auto_aggregate(tmp_path: Path) -> None:
+    db_path = tmp_path / "sales.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("sales").insert_all(
+        [
+            {"id": i, "product": f"product-{i % 300}", "amount": i % 300}
+            for i in range(900)
+        ]
+    )
+
+    chart = {
+        "db": "sales",
+        "query": "SELECT product, sum(amount) AS amount FROM sales GROUP BY product",
+        "library": "bar",
+        "display": {"x": "product", "y": "amount"},
+    }
+    metadata = {
+        "plugins": {
+            "datasette-dashboards": {
+                "sales": {
+                    "title": "Sales",
+                    "settings": {"auto_aggregate": True},
+                    "charts": {
+                        "aggregated": chart,
+                        "truncated": dict(chart, auto_aggregate=False),
+                    },
+                }
+            }
+        }
+    }
+    datasette = Datasette(
+        [str(db_path)], metadata=metadata, settings={"max_returned_rows": 50}
+    )
+    response = await datasette.client.get("/-/dashboards/sales/data.json")
+    charts = response.json()["charts"]
+
+    truncated = charts["truncated"]
+    assert truncated["truncated"] is True
+    assert "aggregated" not in truncated
+    assert len(truncated["rows"]) == 50
+
+    aggregated = charts["aggregated"]
+    assert aggregated["ok"] is True
+    assert aggregated["truncated"] is False
+    assert aggregated["aggregated"] is True
+    assert len(aggregated["rows"]) == 50
+    assert aggregated["rows"][-1] == {"product": "Other", "amount": 250 * 251 / 2 * 3}
+    assert sum(row["amount"] for row in aggregated["rows"]) == sum(
+        i % 300 for i in range(900)
+    )
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_heatmap(tmp_path: Path) -> None:
+    db_path = tmp_path / "points.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("points").insert_all(
+        [{"x": i % 100, "y": (i * 13) % 100} for i in range(5000)]
+    )
+
+    metadata = {
+        "plugins": {
+            "datasette-dashboards": {
+                "points": {
+                    "title": "Points",
+                    "charts": {
+                        "density": {
+                            "db": "points",
+                            "query": "SELECT x, y FROM points",
+                            "library": "heatmap",
+                            "display": {"x": "x", "y": "y", "bins": 10},
+                        }
+                    },
+                }
+            }
+        }
+    }
+    datasette = Datasette([str(db_path)], metadata=metadata)
+    response = await datasette.client.get("/-/dashboards/points/data.json")
+    chart = response.json()["charts"]["density"]
+
+    assert chart["ok"] is True
+    assert chart["truncated"] is False
+    assert chart["columns"] == ["x", "x_end", "y", "y_end", "count"]
+    assert 0 < len(chart["rows"]) <= 100
+    assert sum(row["count"] for row in chart["rows"]) == 5000
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_histogram(tmp_path: Path) -> None:
+    db_path = tmp_path / "salaries.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("salaries").insert_all(
+        [{"id": i, "salary": 30000 + (i * 7919) % 50000} for i in range(3000)]
+    )
+
+    metadata = {
+        "plugins": {
+            "datasette-dashboards": {
+                "salaries": {
+                    "title": "Salaries",
+                    "filters": {"min_salary": {"name": "Minimum", "type": "number"}},
+                    "charts": {
+                        "distribution": {
+                            "db": "salaries",
+                            "query": "SELECT salary FROM salaries WHERE TRUE [[ AND salary >= :min_salary ]]",
+                            "library": "histogram",
+                            "display": {"x": "salary", "bins": "auto"},
+                        }
+                    },
+                }
+            }
+        }
+    }
+    datasette = Datasette([str(db_path)], metadata=metadata)
+    response = await datasette.client.get(
+        "/-/dashboards/salaries/data.json?min_salary=40000"
+    )
+    chart = response.json()["charts"]["distribution"]
+
+    assert chart["ok"] is True
+    assert chart["columns"] == ["salary", "salary_end", "count"]
+    assert 1 < len(chart["rows"]) <= 200
+    salaries = [30000 + (i * 7919) % 50000 for i in range(3000)]
+    assert chart["rows"][0]["salary"] == min(s for s in salaries if s >= 40000)
+    assert sum(row["count"] for row in chart["rows"]) == sum(
+        s >= 40000 for s in salaries
+    )
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_top_n(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    metadata = copy.deepcopy(datasette_metadata)
+    dashboard = metadata["plugins"]["datasette-dashboards"]["job-dashboard"]
+    dashboard["charts"]["offers-pie"] = {
+        "db": "test",
+        "query": "SELECT source, count(*) AS count FROM jobs GROUP BY source",
+        "library": "pie",
+        "display": {"label": "source", "value": "count", "top_n": 1},
+    }
+    datasette = Datasette([str(datasette_db)], metadata=metadata)
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json?charts=offers-pie"
+    )
+    chart = response.json()["charts"]["offers-pie"]
+
+    assert chart["ok"] is True
+    assert chart["columns"] == ["source", "count"]
+    assert len(chart["rows"]) == 2
+    assert chart["rows"][-1]["source"] == "Other"
+    assert sum(row["count"] for row in chart["rows"]) == 10
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_map_clusters(tmp_path: Path) -> None:
+    db_path = tmp_path / "places.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("places").insert_all(
+        [
+            {"name": f"paris-{i}", "lat": 48.85 + i / 1000, "lng": 2.35 + i / 1000}
+            for i in range(50)
+        ]
+        + [{"name": "madrid", "lat": 40.42, "lng": -3.7}]
+    )
+    metadata = {
+        "plugins": {
+            "datasette-dashboards": {
+                "places": {
+                    "title": "Places",
+                    "charts": {
+                        "map": {
+                            "db": "places",
+                            "query": "SELECT name, lat, lng FROM places",
+                            "library": "map",
+                            "display": {
+                                "latitude_column": "lat",
+                                "longitude_column": "lng",
+                                "cluster": True,
+                            },
+                        },
+                    },
+                },
+            },
+        },
+    }
+    datasette = Datasette([str(db_path)], metadata=metadata)
+
+    response = await datasette.client.get("/-/dashboards/places/data.json?_zoom=4")
+    chart = response.json()["charts"]["map"]
+    assert chart["ok"] is True
+    assert chart["zoom"] == 4
+    rows = {row["_count"]: row for row in chart["rows"]}
+    assert set(rows) == {50, 1}
+    assert rows[50]["_latitude"] == pytest.approx(48.85 + 0.0245)
+    assert rows[50]["_south"] == 48.85
+    assert rows[1]["name"] == "madrid"
+    assert rows[1]["lat"] == 40.42
+
+    response = await datasette.client.get("/-/dashboards/places/data.json?_zoom=18")
+    chart = response.json()["charts"]["map"]
+    assert chart["zoom"] == 18
+    assert chart["columns"] == ["name", "lat", "lng"]
+    assert len(chart["rows"]) == 51
+
+    response = await datasette.client.get("/-/dashboards/places/data.json")
+    assert response.json()["charts"]["map"]["zoom"] == 0
+
+    response = await datasette.client.get("/-/dashboards/places/data.json?_zoom=x")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("rtree_table", ["places_rtree", "missing_rtree"])
+async def test_dashboard_data_map_bbox(tmp_path: Path, rtree_table: str) -> None:
+    db_path = tmp_path / "places.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("places", pk="id").insert_all(
+        [
+            {"id": 1, "name": "paris", "lat": 48.8566, "lng": 2.3522},
+            {"id": 2, "name": "lyon", "lat": 45.764, "lng": 4.8357},
+            {"id": 3, "name": "tokyo", "lat": 35.6762, "lng": 139.6503},
+        ]
+    )
+    db.execute("CREATE VIRTUAL TABLE places_rtree USING rtree(id, x1, x2, y1, y2)")
+    db.execute("INSERT INTO places_rtree SELECT id, lng, lng, lat, lat FROM places")
+    db.conn.commit()
+    metadata = {
+        "plugins": {
+            "datasette-dashboards": {
+                "places": {
+                    "title": "Places",
+                    "charts": {
+                        "map": {
+                            "db": "places",
+                            "query": "SELECT id, name, lat, lng FROM places",
+                            "library": "map",
+                            "display": {
+                                "latitude_column": "lat",
+                                "longitude_column": "lng",
+                                "rtree_table": rtree_table,
+                            },
+                        },
+                    },
+                },
+            },
+        },
+    }
+    datasette = Datasette([str(db_path)], metadata=metadata)
+
+    response = await datasette.client.get(
+        "/-/dashboards/places/data.json?_zoom=10&_bbox=2.2,48.8,2.5,48.9"
+    )
+    chart = response.json()["charts"]["map"]
+    assert chart["ok"] is True
+    assert chart["zoom"] == 10
+    assert "clustered" not in chart
+    assert [row["name"] for row in chart["rows"]] == ["paris"]
+
+    response = await datasette.client.get(
+        "/-/dashboards/places/data.json?_zoom=2&_bbox=0,30,170,50"
+    )
+    chart = response.json()["charts"]["map"]
+    assert [row["name"] for row in chart["rows"]] == ["paris", "lyon", "tokyo"]
+
+    response = await datasette.client.get("/-/dashboards/places/data.json?_bbox=1,2,3")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_dashboard_data_columns_shape(datasette: Datasette) -> None:
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json?_chart=offers-bar"
+    )
+    objects = response.json()["charts"]["offers-bar"]
+    objects_etag = response.headers["etag"]
+
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json?_chart=offers-bar&_shape=columns"
+    )
+    assert response.status_code == 200
+    chart = response.json()["charts"]["offers-bar"]
+    assert "rows" not in chart
+    assert chart["columns"] == objects["columns"] == ["source", "count"]
+    assert chart["truncated"] is False
+    assert response.headers["etag"] != objects_etag
+    sources, counts = chart["values"]
+    assert [
+        {"source": source, "count": count} for source, count in zip(sources, counts)
+    ] == objects["rows"]
+
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard/data.json?_shape=arrays"
+    )
+    assert response.status_code == 400
@@ -258,7 +258,7 @@ async def test_dashboard_view_enable_autorefresh(
     )
     assert response.status_code == 200
 
-    assert "autorefresh(1)" in response.text
+    assert "autorefresh(1, {" in response.text
 
 
 @pytest.mark.asyncio
@@ -280,6 +280,8 @@ async def test_dashboard_view_enable_autorefresh(
         ({"allow": {"id": "user"}}, True, 200),
         ({"allow_sql": {"id": "user"}}, False, 403),
         ({"allow_sql": {"id": "user"}}, True, 200),
+        ({"databases": {"test": {"allow": {"id": "user"}}}}, False, 403),
+        ({"databases": {"test": {"allow": {"id": "user"}}}}, True, 200),
     ],
 )
 async def test_dashboard_view_permissions(
@@ -326,3 +328,86 @@ async def test_dashboard_view_misconfigured_chart_type(
     assert response.status_code == 404
     assert "bad-chart" in response.text
     assert "missing required field" in response.text
+
+
+@pytest.mark.asyncio
+async def test_dashboard_view_chart_data_urls(datasette: Datasette) -> None:
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard?date_start=2021-01-01&date_end=2021-12-31&text_filter=abc"
+    )
+    assert response.status_code == 200
+
+    base_url = "http://localhost/-/dashboards/job-dashboard/data.json"
+    assert (
+        f'fetchDashboardData("{base_url}?date_end=2021-12-31\\u0026date_start=2021-01-01\\u0026_chart=offers-day")'
+        in response.text
+    )
+    assert (
+        f'fetchDashboardData("{base_url}?_chart=offers-area\\u0026_chart=offers-bar'
+        in response.text
+    )
+    assert "text_filter=abc" not in response.text.split("<script")[-1]
+    assert "renderChart('analysis-note', " in response.text
+    assert "fetchDashboardData(null)" in response.text
+
+
+@pytest.mark.asyncio
+async def test_dashboard_view_inplace_filters(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    response = await Datasette(
+        [str(datasette_db)], metadata=datasette_metadata
+    ).client.get("/-/dashboards/job-dashboard", follow_redirects=True)
+    assert response.status_code == 200
+    assert "enableInplaceFilters(" not in response.text
+
+    metadata = copy.deepcopy(datasette_metadata)
+    dashboard = metadata["plugins"]["datasette-dashboards"]["job-dashboard"]
+    dashboard["settings"]["inplace_filters"] = True
+    dashboard["filters"]["select_filter_query"]["query"] = (
+        "SELECT DISTINCT source FROM jobs WHERE TRUE [[ AND date >= :date_start ]]"
+    )
+    datasette = Datasette([str(datasette_db)], metadata=metadata)
+
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard", follow_redirects=True
+    )
+    assert response.status_code == 200
+    assert (
+        'enableInplaceFilters({"charts": {"offers-area": [], "offers-bar": [], "offers-choropleth": [], "offers-count": [], "offers-day": ["date_end", "date_start"]'
+        in response.text
+    )
+    assert (
+        '"data_url": "http://localhost/-/dashboards/job-dashboard/data.json"'
+        in response.text
+    )
+    assert '"reload_filters": ["date_start"]' in response.text
+
+
+@pytest.mark.asyncio
+async def test_dashboard_view_lazy_render(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    metadata = copy.deepcopy(datasette_metadata)
+    dashboard = metadata["plugins"]["datasette-dashboards"]["job-dashboard"]
+    dashboard["settings"]["lazy_render"] = True
+    dashboard["settings"]["inplace_filters"] = True
+    datasette = Datasette([str(datasette_db)], metadata=metadata)
+
+    response = await datasette.client.get(
+        "/-/dashboards/job-dashboard?date_start=2021-01-01&date_end=2021-12-31"
+    )
+    assert response.status_code == 200
+
+    base_url = "http://localhost/-/dashboards/job-dashboard/data.json"
+    script = response.text.split('<script type="text/javascript">')[-1]
+    assert 'fetchDashboardData("' not in script
+    assert "renderChartLazily('offers-day', " in script
+    assert (
+        f'"{base_url}?date_end=2021-12-31\\u0026date_start=2021-01-01\\u0026_chart=offers-day")'
+        in script
+    )
+    assert f'"{base_url}?_chart=offers-count")' in script
+    assert f'"{base_url}?_chart=offers-source")' in script
+    assert "renderChart('analysis-note', " in script
+    assert '"lazy_render": true' in script
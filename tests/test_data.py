@@ -0,0 +1,100 @@
+import asyncio
+import copy
+import threading
+import typing as t
+import pytest
+
+from pathlib import Path
+from datasette.app import Datasette
+
+from datasette_dashboards.cache import QueryResults
+from datasette_dashboards.data import (
+    execute_query,
+    fill_dynamic_filters,
+    gather_by_database,
+    query_concurrency,
+)
+from datasette_dashboards.query import QueryTemplate
+from datasette_dashboards.registry import compile_dashboard, get_registry
+
+
+@pytest.mark.asyncio
+async def test_gather_by_database_preserves_order() -> None:
+    async def job(value: int) -> int:
+        await asyncio.sleep(0.001 * (5 - value))
+        return value
+
+    results = await gather_by_database(
+        [("db1", job(i)) if i % 2 else ("db2", job(i)) for i in range(5)], 2
+    )
+    assert results == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_gather_by_database_concurrency_cap() -> None:
+    running: dict[str, int] = {"db1": 0, "db2": 0}
+    peaks: dict[str, int] = {"db1": 0, "db2": 0}
+
+    async def job(db: str) -> None:
+        running[db] += 1
+        peaks[db] = max(peaks[db], running[db])
+        await asyncio.sleep(0.001)
+        running[db] -= 1
+
+    await gather_by_database(
+        [(db, job(db)) for db in ["db1", "db2"] for _ in range(6)], 2
+    )
+    assert peaks == {"db1": 2, "db2": 2}
+
+
+@pytest.mark.asyncio
+async def test_execute_query_transform_in_thread(datasette: Datasette) -> None:
+    threads = []
+
+    class Transform:
+        def key(self) -> tuple[t.Any, ...]:
+            return ("first",)
+
+        def apply(self, results: QueryResults) -> QueryResults:
+            threads.append(threading.get_ident())
+            return QueryResults(results.columns, results.rows[:1], False)
+
+    query = QueryTemplate.parse("SELECT id FROM jobs ORDER BY id").bind({})
+    results = await execute_query(datasette, "test", query, transform=Transform())
+    assert results.rows == [(1,)]
+    assert threads and threads[0] != threading.get_ident()
+
+
+def test_query_concurrency(datasette: Datasette) -> None:
+    dashboard = compile_dashboard("dashboard", {})
+    assert query_concurrency(datasette, dashboard) == datasette.setting(
+        "num_sql_threads"
+    )
+
+    dashboard = compile_dashboard("dashboard", {"settings": {"query_concurrency": 5}})
+    assert query_concurrency(datasette, dashboard) == 5
+
+    dashboard = compile_dashboard("dashboard", {"settings": {"query_concurrency": 0}})
+    assert query_concurrency(datasette, dashboard) == 1
+
+
+@pytest.mark.asyncio
+async def test_fill_dynamic_filters(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    metadata = copy.deepcopy(datasette_metadata)
+    filters = metadata["plugins"]["datasette-dashboards"]["job-dashboard"]["filters"]
+    filters["dependent_filter_query"] = {
+        "name": "Dependent Select Filter",
+        "type": "select",
+        "db": "test",
+        "query": "SELECT id FROM jobs WHERE TRUE [[ AND id <= :number_filter ]] ORDER BY id",
+    }
+    datasette = Datasette([str(datasette_db)], metadata=metadata)
+    dashboard = get_registry(datasette).dashboards["job-dashboard"]
+
+    result = await fill_dynamic_filters(datasette, dashboard, {"number_filter": "3"})
+    assert result["dependent_filter_query"]["options"] == [1, 2, 3]
+    assert len(result["select_filter_query"]["options"]) > 0
+    assert result["select_filter"] == filters["select_filter"]
+    assert "options" not in dashboard.filters["dependent_filter_query"]
@@ -0,0 +1,155 @@
+import math
+import typing as t
+import pytest
+
+from datasette_dashboards.cache import QueryResults
+from datasette_dashboards.downsample import (
+    Downsampling,
+    _to_number,
+    chart_downsampling,
+    downsample_series,
+    lttb,
+    m4,
+)
+
+
+def wave(n: int) -> tuple[list[float], list[float]]:
+    xs = [float(i) for i in range(n)]
+    ys = [math.sin(i / 10) * (1 + i % 7) for i in range(n)]
+    return xs, ys
+
+
+def test_lttb() -> None:
+    xs, ys = wave(1000)
+    kept = lttb(xs, ys, 100)
+    assert len(kept) == 100
+    assert kept[0] == 0
+    assert kept[-1] == 999
+    assert kept == sorted(set(kept))
+
+
+def test_lttb_keeps_spike() -> None:
+    xs = [float(i) for i in range(500)]
+    ys = [0.0] * 500
+    ys[250] = 100.0
+    assert 250 in lttb(xs, ys, 20)
+
+
+def test_lttb_small_series() -> None:
+    xs, ys = wave(10)
+    assert lttb(xs, ys, 100) == list(range(10))
+
+
+def test_m4_keeps_extremes() -> None:
+    xs, ys = wave(1000)
+    kept = m4(xs, ys, 100)
+    assert len(kept) <= 100
+    assert kept[0] == 0
+    assert kept[-1] == 999
+    assert ys.index(max(ys)) in kept
+    assert ys.index(min(ys)) in kept
+
+
+def test_downsample_series_sorts_dates() -> None:
+    xs = [f"2021-01-{day:02d}" for day in range(31, 0, -1)]
+    ys = list(range(31))
+    kept = downsample_series(xs, ys, 5)
+    assert len(kept) == 5
+    assert kept[0] == 30
+    assert kept[-1] == 0
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("2021-01-01T00:00:00Z", 1609459200.0),
+        ("2021-01-01T00:00:00.500Z", 1609459200.5),
+        ("2021-01-01T01:00:00+01:00", 1609459200.0),
+        ("2459215.5", 2459215.5),
+        ("1609459200", 1609459200.0),
+        ("Z", None),
+        ("", None),
+    ],
+)
+def test_to_number(value: str, expected: float | None) -> None:
+    assert _to_number(value) == expected
+
+
+def test_downsample_series_utc_dates() -> None:
+    xs = [f"2021-01-{day:02d}T00:00:00Z" for day in range(31, 0, -1)]
+    ys = list(range(31))
+    kept = downsample_series(xs, ys, 5)
+    assert len(kept) == 5
+    assert kept[0] == 30
+    assert kept[-1] == 0
+
+
+def test_downsample_series_skips_missing_values() -> None:
+    xs = list(range(10))
+    ys: list[t.Any] = [1, None, 3, None, 5, 6, 7, 8, 9, 10]
+    assert downsample_series(xs, ys, 100) == [0, 2, 4, 5, 6, 7, 8, 9]
+
+
+def test_downsampling_per_color() -> None:
+    rows = [
+        (i, source, i * (1 if source == "a" else -1))
+        for i in range(300)
+        for source in ("a", "b")
+    ]
+    results = QueryResults(columns=("x", "source", "y"), rows=rows, truncated=False)
+    downsampling = Downsampling(method="lttb", points=10, x="x", y="y", color="source")
+
+    downsampled = downsampling.apply(results)
+    assert downsampled.columns == results.columns
+    assert len(downsampled.rows) == 20
+    assert [row for row in downsampled.rows if row[1] == "a"][-1] == (299, "a", 299)
+    assert [row for row in downsampled.rows if row[1] == "b"][-1] == (299, "b", -299)
+    assert downsampled.rows == [row for row in rows if row in downsampled.rows]
+
+
+def test_downsampling_unknown_columns() -> None:
+    results = QueryResults(columns=("a", "b"), rows=[(1, 2)], truncated=False)
+    downsampling = Downsampling(method="m4", points=10, x="x", y="y")
+    assert downsampling.apply(results) is results
+
+
+def test_chart_downsampling() -> None:
+    chart: dict[str, t.Any] = {
+        "library": "line",
+        "display": {
+            "x": "day",
+            "y": {"field": "count", "type": "quantitative"},
+            "color": "source",
+            "downsample": 500,
+        },
+    }
+    assert chart_downsampling(chart) == Downsampling(
+        method="lttb", points=500, x="day", y="count", color="source"
+    )
+
+    chart["display"]["downsample"] = {"method": "m4"}
+    downsampling = chart_downsampling(chart)
+    assert downsampling is not None
+    assert downsampling.method == "m4"
+    assert downsampling.points == 1000
+
+    chart["library"] = "bar"
+    assert chart_downsampling(chart) is None
+
+    assert chart_downsampling({"library": "area", "display": {"x": "a"}}) is None
+
+
+@pytest.mark.parametrize(
+    "downsample,message",
+    [
+        ({"method": "average"}, "method must be one of"),
+        (2, "points must be at least"),
+    ],
+)
+def test_chart_downsampling_errors(downsample: t.Any, message: str) -> None:
+    chart = {
+        "library": "line",
+        "display": {"x": "day", "y": "count", "downsample": downsample},
+    }
+    with pytest.raises(ValueError, match=message):
+        chart_downsampling(chart)
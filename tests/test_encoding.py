@@ -0,0 +1,29 @@
+from datasette_dashboards.cache import QueryResults
+from datasette_dashboards.encoding import encode_column, encode_columns
+
+
+def test_encode_column() -> None:
+    sources = ["indeed", "linkedin", None, "indeed"] * 5
+    encoded = encode_column(sources)
+    assert encoded == {
+        "dictionary": ["indeed", "linkedin", None],
+        "indexes": [0, 1, 2, 0] * 5,
+    }
+
+    assert encode_column(sources[:4]) == sources[:4]
+    names = [f"name-{i}" for i in range(20)]
+    assert encode_column(names) == names
+    numbers = [1, 2] * 10
+    assert encode_column(numbers) == numbers
+
+
+def test_encode_columns() -> None:
+    rows = [(i, "even" if i % 2 == 0 else "odd") for i in range(20)]
+    results = QueryResults(columns=("n", "parity"), rows=rows, truncated=False)
+    assert encode_columns(results) == [
+        list(range(20)),
+        {"dictionary": ["even", "odd"], "indexes": [0, 1] * 10},
+    ]
+
+    empty = QueryResults(columns=("n", "parity"), rows=[], truncated=False)
+    assert encode_columns(empty) == [[], []]
@@ -0,0 +1,191 @@
+import typing as t
+import pytest
+
+from dataclasses import replace
+
+from datasette.utils import sqlite3
+
+from datasette_dashboards.maps import (
+    MapQuery,
+    Viewport,
+    chart_map_query,
+    cluster_sql,
+    mercator_y,
+    parse_viewport,
+    register_functions,
+    snap_bbox,
+    window_sql,
+)
+from datasette_dashboards.query import QueryTemplate
+
+
+@pytest.fixture
+def conn() -> t.Iterator[sqlite3.Connection]:
+    conn = sqlite3.connect(":memory:")
+    register_functions(conn)
+    conn.execute("CREATE TABLE places (name TEXT, latitude REAL, longitude REAL)")
+    conn.executemany(
+        "INSERT INTO places VALUES (?, ?, ?)",
+        [(f"paris-{i}", 48.8 + i / 1000, 2.3 + i / 1000) for i in range(100)]
+        + [("tokyo", 35.68, 139.69), ("nowhere", None, None)],
+    )
+    yield conn
+    conn.close()
+
+
+def test_mercator_y() -> None:
+    assert mercator_y(0) == pytest.approx(0.5)
+    assert mercator_y("0") == pytest.approx(0.5)
+    assert mercator_y(90) == pytest.approx(0)
+    assert mercator_y(-90) == pytest.approx(1)
+    assert mercator_y(45) == pytest.approx(0.3597, abs=1e-4)
+    assert mercator_y(None) is None
+    assert mercator_y("north") is None
+
+
+def test_cluster_sql(conn: sqlite3.Connection) -> None:
+    sql = "SELECT * FROM places;"
+    rows = conn.execute(cluster_sql(sql, "latitude", "longitude", 2, 80)).fetchall()
+    assert [row[3] for row in rows] == [100, 1]
+    assert rows[0][4] == pytest.approx(48.8 + 0.0495)
+    assert rows[0][6:] == pytest.approx((48.8, 2.3, 48.899, 2.399))
+    assert rows[1][:4] == ("tokyo", 35.68, 139.69, 1)
+
+    rows = conn.execute(cluster_sql(sql, "latitude", "longitude", 14, 80)).fetchall()
+    assert 2 < len(rows) < 101
+    assert sum(row[3] for row in rows) == 101
+    assert [row[3] for row in rows] == sorted((row[3] for row in rows), reverse=True)
+
+
+def test_window_sql(conn: sqlite3.Connection) -> None:
+    sql = "SELECT * FROM places"
+    paris = (2.0, 48.0, 3.0, 49.0)
+    rows = conn.execute(window_sql(sql, "latitude", "longitude", paris)).fetchall()
+    assert len(rows) == 100
+
+    pacific = (120.0, 0.0, 200.0, 50.0)
+    rows = conn.execute(window_sql(sql, "latitude", "longitude", pacific)).fetchall()
+    assert rows == [("tokyo", 35.68, 139.69)]
+
+    world = (-540.0, -90.0, 540.0, 90.0)
+    rows = conn.execute(window_sql(sql, "latitude", "longitude", world)).fetchall()
+    assert len(rows) == 101
+
+
+def test_window_sql_rtree(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE VIRTUAL TABLE places_rtree USING rtree(id, x1, x2, y1, y2)")
+    conn.execute(
+        "INSERT INTO places_rtree "
+        "SELECT rowid, longitude, longitude, latitude, latitude FROM places "
+        "WHERE latitude IS NOT NULL"
+    )
+    sql = "SELECT rowid AS id, * FROM places"
+    rtree = ("places_rtree", "id", ("id", "x1", "x2", "y1", "y2"))
+
+    paris = (2.0, 48.0, 3.0, 49.0)
+    rows = conn.execute(
+        window_sql(sql, "latitude", "longitude", paris, rtree)
+    ).fetchall()
+    assert len(rows) == 100
+
+    antimeridian = (130.0, 30.0, 190.0, 40.0)
+    rows = conn.execute(
+        window_sql(sql, "latitude", "longitude", antimeridian, rtree)
+    ).fetchall()
+    assert [row[1] for row in rows] == ["tokyo"]
+
+
+def test_snap_bbox() -> None:
+    assert snap_bbox((2.3, 48.8, 2.4, 48.9), 0) == (0.0, 0.0, 360.0, 90.0)
+    assert snap_bbox((2.3, 48.8, 2.4, 48.9), 4) == (0.0, 45.0, 22.5, 56.25)
+    assert snap_bbox((2.31, 48.81, 2.32, 48.82), 12) == snap_bbox(
+        (2.3101, 48.8101, 2.3201, 48.8201), 12
+    )
+
+
+def test_parse_viewport() -> None:
+    assert parse_viewport({}) == Viewport(zoom=0)
+    assert parse_viewport({"_zoom": "12"}) == Viewport(zoom=12)
+    assert parse_viewport({"_zoom": "7.6"}) == Viewport(zoom=7)
+    assert parse_viewport({"_zoom": "40"}) == Viewport(zoom=22)
+    with pytest.raises(ValueError, match="Invalid zoom level"):
+        parse_viewport({"_zoom": "far"})
+
+    viewport = parse_viewport({"_zoom": "4", "_bbox": "2.3,48.8,2.4,48.9"})
+    assert viewport == Viewport(zoom=4, bbox=(0.0, 45.0, 22.5, 56.25))
+    for bbox in ("1,2,3", "a,b,c,d", "0,10,1,5", "0,0,inf,1"):
+        with pytest.raises(ValueError, match="Invalid bounding box"):
+            parse_viewport({"_bbox": bbox})
+
+
+def test_map_query() -> None:
+    query = QueryTemplate.parse(
+        "SELECT * FROM places WHERE TRUE [[ AND name = :name ]]"
+    ).bind({"name": "tokyo"})
+    map_query = MapQuery(
+        latitude="lat", longitude="lng", cluster_radius=80, cluster_max_zoom=10
+    )
+
+    clustered = map_query.query(query, Viewport(zoom=10))
+    assert clustered.sql == cluster_sql(query.sql, "lat", "lng", 10, 80)
+    assert clustered.params == {"name": "tokyo"}
+    assert clustered.key() != map_query.query(query, Viewport(zoom=9)).key()
+
+    assert map_query.clusters(Viewport(zoom=10))
+    assert not map_query.clusters(Viewport(zoom=11))
+    assert map_query.query(query, Viewport(zoom=11)) is query
+
+    bbox = (2.0, 48.0, 3.0, 49.0)
+    windowed = map_query.query(query, Viewport(zoom=11, bbox=bbox))
+    assert windowed.sql == window_sql(query.sql, "lat", "lng", bbox)
+    assert windowed.params == {"name": "tokyo"}
+
+    rtree = ("id", "minx", "maxx", "miny", "maxy")
+    indexed = replace(map_query, rtree_table="places_rtree").query(
+        query, Viewport(zoom=11, bbox=bbox), rtree
+    )
+    assert indexed.sql == window_sql(
+        query.sql, "lat", "lng", bbox, ("places_rtree", "id", rtree)
+    )
+
+
+def test_chart_map_query() -> None:
+    chart: dict[str, t.Any] = {
+        "library": "map",
+        "display": {"latitude_column": "lat", "cluster": True},
+    }
+    assert chart_map_query(chart) == MapQuery(
+        latitude="lat", longitude="longitude", cluster_radius=80
+    )
+
+    chart["display"]["cluster"] = 40
+    assert chart_map_query(chart) == MapQuery(
+        latitude="lat", longitude="longitude", cluster_radius=40
+    )
+
+    chart["display"]["cluster"] = {"radius": 60, "max_zoom": 12}
+    assert chart_map_query(chart) == MapQuery(
+        latitude="lat", longitude="longitude", cluster_radius=60, cluster_max_zoom=12
+    )
+
+    chart["display"] = {"cluster": False, "rtree_table": "places_rtree"}
+    assert chart_map_query(chart) == MapQuery(
+        latitude="latitude", longitude="longitude", rtree_table="places_rtree"
+    )
+    assert chart_map_query({"library": "map", "display": None}) == MapQuery(
+        latitude="latitude", longitude="longitude"
+    )
+    assert chart_map_query({"library": "table", "display": {"cluster": True}}) is None
+
+
+@pytest.mark.parametrize(
+    "cluster,message",
+    [
+        (0, "radius must be at least 1"),
+        ({"max_zoom": 30}, "max_zoom must be between 0 and 22"),
+    ],
+)
+def test_chart_map_query_errors(cluster: t.Any, message: str) -> None:
+    chart = {"library": "map", "display": {"cluster": cluster}}
+    with pytest.raises(ValueError, match=message):
+        chart_map_query(chart)
@@ -0,0 +1,85 @@
+import re
+import pytest
+
+from datasette_dashboards.query import (
+    QueryTemplate,
+    replace_opts_in_query,
+    sql_opt_pattern,
+    sql_var_pattern,
+)
+
+
+def _legacy_replace_opts_in_query(query: str, options: dict[str, str]) -> str:
+    to_replace: list[dict[str, str]] = []
+    for opt_match in re.finditer(sql_opt_pattern, query):
+        opt_group = opt_match.group("opt")
+        var_match = re.search(sql_var_pattern, opt_group)
+        var_group = var_match.group("var") if var_match is not None else ""
+        opt_keep = var_group in options and options[var_group] != ""
+        to_replace.append(
+            {
+                "opt": opt_group,
+                "replacement": opt_group.strip("[[]]") if opt_keep else "",
+            }
+        )
+
+    result = query
+    for r in to_replace:
+        result = result.replace(r["opt"], r["replacement"])
+    return result
+
+
+QUERIES = [
+    "SELECT 1",
+    "SELECT * FROM t [[ WHERE col >= :my_filter ]]",
+    "SELECT * FROM t WHERE TRUE [[ AND a = :a ]] [[ AND b = :b ]] ORDER BY a",
+    "SELECT * FROM t WHERE TRUE [[ AND [date] >= date(:a) ]] [[ AND [date] <= date(:b) ]]",
+    "SELECT * FROM t WHERE TRUE [[ AND a = :a ]] OR TRUE [[ AND a = :a ]]",
+    "SELECT * FROM t WHERE TRUE [[ AND c = 1 ]]",
+    "SELECT * FROM t WHERE TRUE [[ AND a = :a AND b = :b ]]",
+    "SELECT * FROM t WHERE TRUE [[\n AND a = :a ]] [[ AND b = :b ]]",
+]
+
+OPTIONS: list[dict[str, str]] = [
+    {},
+    {"a": "1"},
+    {"a": ""},
+    {"b": "2", "my_filter": "3"},
+    {"a": "1", "b": "2", "my_filter": ""},
+]
+
+
+@pytest.mark.parametrize("query", QUERIES)
+@pytest.mark.parametrize("options", OPTIONS)
+def test_render_matches_legacy_replacement(query: str, options: dict[str, str]) -> None:
+    expected = _legacy_replace_opts_in_query(query, options)
+    assert QueryTemplate.parse(query).render(options) == expected
+    assert replace_opts_in_query(query, options) == expected
+
+
+def test_parse() -> None:
+    template = QueryTemplate.parse(
+        "SELECT * FROM t WHERE x = :x [[ AND a = :a ]] [[ AND b = 1 ]] LIMIT 5"
+    )
+    assert template.literals == ("SELECT * FROM t WHERE x = :x ", " ", " LIMIT 5")
+    assert template.optionals == ((" AND a = :a ", "a"), (" AND b = 1 ", ""))
+    assert template.variables == ("x", "a")
+
+
+def test_bind() -> None:
+    template = QueryTemplate.parse("SELECT * FROM t WHERE x = :x [[ AND a = :a ]]")
+    query = template.bind({"a": "1", "other": "2"})
+    assert query.active == (True,)
+    assert query.params == {"x": "", "a": "1"}
+    assert query.sql == "SELECT * FROM t WHERE x = :x  AND a = :a "
+
+    query = template.bind({"x": "1"})
+    assert query.active == (False,)
+    assert query.params == {"x": "1", "a": ""}
+    assert query.sql == "SELECT * FROM t WHERE x = :x "
+
+
+def test_bound_query_key() -> None:
+    template = QueryTemplate.parse("SELECT :b, :a [[ AND :c ]]")
+    key = template.bind({"a": "1", "b": "2"}).key()
+    assert key == (template.query, (False,), (("a", "1"), ("b", "2"), ("c", "")))
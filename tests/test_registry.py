@@ -0,0 +1,197 @@
+import copy
+import typing as t
+import pytest
+
+from pathlib import Path
+from datasette.app import Datasette
+
+from datasette_dashboards.registry import (
+    compile_registry,
+    config_hash,
+    get_registry,
+)
+
+
+def test_config_hash_is_stable(datasette_metadata: t.Dict[str, t.Any]) -> None:
+    config = datasette_metadata["plugins"]["datasette-dashboards"]
+    assert config_hash(config) == config_hash(copy.deepcopy(config))
+
+
+def test_config_hash_changes_with_config(
+    datasette_metadata: t.Dict[str, t.Any],
+) -> None:
+    config = copy.deepcopy(datasette_metadata["plugins"]["datasette-dashboards"])
+    original = config_hash(config)
+    config["job-dashboard"]["title"] = "Another title"
+    assert config_hash(config) != original
+
+
+def test_compile_registry(datasette_metadata: t.Dict[str, t.Any]) -> None:
+    config = datasette_metadata["plugins"]["datasette-dashboards"]
+    registry = compile_registry(config)
+    assert registry.config_hash == config_hash(config)
+
+    dashboard = registry.dashboards["job-dashboard"]
+    assert dashboard.databases == frozenset({"test"})
+    assert dashboard.default_filters == {
+        "date_start": "2021-01-01",
+        "date_end": "2021-12-31",
+    }
+    assert set(dashboard.filter_templates.keys()) == {"select_filter_query"}
+    assert set(dashboard.charts.keys()) == set(config["job-dashboard"]["charts"])
+
+    line = dashboard.charts["offers-line"]
+    assert line.error is None
+    assert line.spec["library"] == "vega-lite"
+    assert line.template is not None
+
+    note = dashboard.charts["analysis-note"]
+    assert note.template is None
+
+
+def test_compile_registry_chart_error(datasette_metadata: t.Dict[str, t.Any]) -> None:
+    config = copy.deepcopy(datasette_metadata["plugins"]["datasette-dashboards"])
+    config["job-dashboard"]["charts"]["bad-chart"] = {
+        "db": "test",
+        "query": "SELECT 1",
+        "library": "line",
+        "display": {"y": "count"},
+    }
+    registry = compile_registry(config)
+    chart = registry.dashboards["job-dashboard"].charts["bad-chart"]
+    assert chart.error is not None
+    assert "bad-chart" in chart.error
+    assert "missing required field" in chart.error
+
+
+def test_compile_registry_does_not_mutate_config(
+    datasette_metadata: t.Dict[str, t.Any],
+) -> None:
+    config = copy.deepcopy(datasette_metadata["plugins"]["datasette-dashboards"])
+    del config["job-dashboard"]["filters"]
+    original = copy.deepcopy(config)
+    compile_registry(config)
+    assert config == original
+
+
+@pytest.mark.asyncio
+async def test_get_registry_is_reused(datasette: Datasette) -> None:
+    assert get_registry(datasette) is get_registry(datasette)
+
+
+@pytest.mark.asyncio
+async def test_get_registry_recompiles_on_config_change(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    metadata = copy.deepcopy(datasette_metadata)
+    datasette = Datasette([str(datasette_db)], metadata=metadata)
+    registry = get_registry(datasette)
+
+    metadata["plugins"]["datasette-dashboards"]["job-dashboard"]["title"] = "Changed"
+    other = Datasette([str(datasette_db)], metadata=metadata)
+    other_registry = get_registry(other)
+
+    assert other_registry is not registry
+    assert other_registry.dashboards["job-dashboard"].config["title"] == "Changed"
+
+
+@pytest.mark.asyncio
+async def test_get_registry_follows_config_object(
+    datasette_db: Path, datasette_metadata: t.Dict[str, t.Any]
+) -> None:
+    datasette = Datasette(
+        [str(datasette_db)], metadata=copy.deepcopy(datasette_metadata)
+    )
+    registry = get_registry(datasette)
+
+    datasette._metadata_local = copy.deepcopy(datasette_metadata)
+    assert get_registry(datasette) is registry
+
+    metadata = copy.deepcopy(datasette_metadata)
+    metadata["plugins"]["datasette-dashboards"]["job-dashboard"]["title"] = "Changed"
+    datasette._metadata_local = metadata
+    changed = get_registry(datasette)
+    assert changed is not registry
+    assert changed.dashboards["job-dashboard"].config["title"] == "Changed"
+
+
+def test_compile_registry_chart_filters(
+    datasette_metadata: t.Dict[str, t.Any],
+) -> None:
+    config = copy.deepcopy(datasette_metadata["plugins"]["datasette-dashboards"])
+    config["job-dashboard"]["charts"]["offers-filtered"] = {
+        "db": "test",
+        "query": "SELECT * FROM jobs WHERE id > :number_filter [[ AND source = :select_filter ]] [[ AND job = :unknown_param ]]",
+        "library": "table",
+    }
+    charts = compile_registry(config).dashboards["job-dashboard"].charts
+
+    assert charts["offers-filtered"].filters == ("number_filter", "select_filter")
+    assert charts["offers-day"].filters == ("date_end", "date_start")
+    assert charts["offers-bar"].filters == ()
+    assert charts["analysis-note"].filters == ()
+
+
+def test_compile_registry_filter_dependencies(
+    datasette_metadata: t.Dict[str, t.Any],
+) -> None:
+    config = copy.deepcopy(datasette_metadata["plugins"]["datasette-dashboards"])
+    filters = config["job-dashboard"]["filters"]
+    assert (
+        compile_registry(config).dashboards["job-dashboard"].filter_dependencies
+        == frozenset()
+    )
+
+    filters["select_filter_query"]["query"] = (
+        "SELECT DISTINCT source FROM jobs WHERE TRUE [[ AND date >= :date_start ]] [[ AND job = :unknown ]]"
+    )
+    assert compile_registry(config).dashboards[
+        "job-dashboard"
+    ].filter_dependencies == frozenset({"date_start"})
+
+
+def test_compile_registry_cache_max_stale(
+    datasette_metadata: t.Dict[str, t.Any],
+) -> None:
+    config = copy.deepcopy(datasette_metadata["plugins"]["datasette-dashboards"])
+    dashboard = config["job-dashboard"]
+    dashboard["settings"]["cache_max_stale"] = 300
+    dashboard["charts"]["offers-bar"]["cache_max_stale"] = 60
+    compiled = compile_registry(config).dashboards["job-dashboard"]
+
+    assert compiled.cache_max_stale == 300
+    assert compiled.charts["offers-bar"].cache_max_stale == 60
+    assert compiled.charts["offers-day"].cache_max_stale == 300
+
+
+def test_compile_registry_downsample(
+    datasette_metadata: t.Dict[str, t.Any],
+) -> None:
+    config = copy.deepcopy(datasette_metadata["plugins"]["datasette-dashboards"])
+    charts = config["job-dashboard"]["charts"]
+    charts["offers-line"]["display"]["downsample"] = 100
+    charts["bad-downsample"] = copy.deepcopy(charts["offers-line"])
+    charts["bad-downsample"]["display"]["downsample"] = {"method": "unknown"}
+    compiled = compile_registry(config).dashboards["job-dashboard"].charts
+
+    line = compiled["offers-line"]
+    assert line.error is None
+    assert line.transform is not None
+    assert "downsample" not in line.spec["display"]
+    assert compiled["offers-bar"].transform is None
+    assert compiled["bad-downsample"].error is not None
+    assert "downsample method" in compiled["bad-downsample"].error
+
+
+def test_compile_registry_auto_aggregate(
+    datasette_metadata: t.Dict[str, t.Any],
+) -> None:
+    config = copy.deepcopy(datasette_metadata["plugins"]["datasette-dashboards"])
+    dashboard = config["job-dashboard"]
+    dashboard["settings"]["auto_aggregate"] = True
+    dashboard["charts"]["offers-bar"]["auto_aggregate"] = False
+    compiled = compile_registry(config).dashboards["job-dashboard"].charts
+
+    assert compiled["offers-line"].aggregation is not None
+    assert compiled["offers-bar"].aggregation is None
+    assert compiled["offers-day"].aggregation is None
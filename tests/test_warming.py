@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import typing as t
+import pytest
+import sqlite_utils
+
+from pathlib import Path
+from datasette.app import Datasette
+
+from datasette_dashboards.cache import get_cache, get_inflight
+from datasette_dashboards.registry import get_registry
+from datasette_dashboards.warming import (
+    FilterUsage,
+    get_filter_usage,
+    start_cache_warming,
+    warm_dashboard,
+    warm_query,
+)
+
+
+@pytest.fixture
+def events_db(tmp_path: Path) -> Path:
+    db_path = tmp_path / "events.db"
+    db = sqlite_utils.Database(db_path)
+    db.table("events").insert_all(
+        [{"id": i, "kind": "a" if i % 2 else "b"} for i in range(6)], pk="id"
+    )
+    return db_path
+
+
+def _metadata(settings: dict[str, t.Any]) -> dict[str, t.Any]:
+    return {
+        "plugins": {
+            "datasette-dashboards": {
+                "events": {
+                    "title": "Events",
+                    "settings": dict({"cache_ttl": 60}, **settings),
+                    "filters": {
+                        "kind": {
+                            "name": "Kind",
+                            "type": "select",
+                            "db": "events",
+                            "query": "SELECT DISTINCT kind FROM events ORDER BY kind",
+                            "default": "a",
+                        },
+                    },
+                    "charts": {
+                        "events-count": {
+                            "db": "events",
+                            "query": "SELECT count(*) as count FROM events WHERE TRUE [[ AND kind = :kind ]]",
+                            "library": "metric",
+                            "display": {"field": "count"},
+                        },
+                        "events-total": {
+                            "db": "events",
+                            "query": "SELECT count(*) as count FROM events",
+                            "library": "metric",
+                            "display": {"field": "count"},
+                        },
+                        "note": {"library": "markdown", "display": "# Events"},
+                    },
+                }
+            }
+        }
+    }
+
+
+def test_filter_usage() -> None:
+    usage = FilterUsage(max_size=4)
+    usage.record("dash", "chart", "c", ["a", "b"], {"a": "1", "b": "2", "c": "x"})
+    usage.record("dash", "chart", "c", ["a", "b"], {"a": "1", "b": "2", "c": "y"})
+    usage.record("dash", "chart", "c", ["a", "b"], {"a": "2"})
+    assert usage.most_common("dash", "chart", "c", 5) == [
+        {"a": "1", "b": "2"},
+        {"a": "2"},
+    ]
+    assert usage.most_common("dash", "chart", "c", 1) == [{"a": "1", "b": "2"}]
+    assert usage.most_common("dash", "filter", "c", 5) == []
+
+    for i in range(3):
+        usage.record("dash", "chart", "c", ["a"], {"a": str(10 + i)})
+    assert len(usage.most_common("dash", "chart", "c", 10)) == 2
+    assert usage.most_common("dash", "chart", "c", 1) == [{"a": "1", "b": "2"}]
+
+
+@pytest.mark.asyncio
+async def test_warm_dashboard_default_filters(events_db: Path) -> None:
+    datasette = Datasette([str(events_db)], metadata=_metadata({}))
+    dashboard = get_registry(datasette).dashboards["events"]
+    cache = get_cache(datasette)
+
+    assert await warm_dashboard(datasette, dashboard) == 3
+    assert len(cache) == 3
+
+    response = await datasette.client.get("/-/dashboards/events?kind=a")
+    assert response.status_code == 200
+    response = await datasette.client.get("/-/dashboards/events/data.json?kind=a")
+    assert response.json()["charts"]["events-count"]["rows"] == [{"count": 3}]
+    assert (cache.hits, cache.misses) == (3, 0)
+
+
+@pytest.mark.asyncio
+async def test_warm_dashboard_popular_filters(events_db: Path) -> None:
+    datasette = Datasette(
+        [str(events_db)],
+        metadata=_metadata({"warm_filters": "both", "warm_popular": 1}),
+    )
+    dashboard = get_registry(datasette).dashboards["events"]
+    inflight = get_inflight(datasette)
+
+    for kind in ("b", "b", "a"):
+        response = await datasette.client.get(
+            f"/-/dashboards/events/data.json?kind={kind}&_chart=events-count"
+        )
+        assert response.status_code == 200
+    response = await datasette.client.get("/-/dashboards/events?kind=b")
+    assert response.status_code == 200
+    usage = get_filter_usage(datasette)
+    assert usage.most_common("events", "chart", "events-count", 5) == [
+        {"kind": "b"},
+        {"kind": "a"},
+    ]
+    assert usage.most_common("events", "filter", "kind", 5) == [{}]
+
+    executions = inflight.executions
+    # Default and most popular filter values, without duplicates
+    assert await warm_dashboard(datasette, dashboard) == 4
+    assert inflight.executions == executions + 4
+
+
+@pytest.mark.asyncio
+async def test_warm_dashboard_uncached(events_db: Path) -> None:
+    datasette = Datasette([str(events_db)], metadata=_metadata({"cache_ttl": 0}))
+    dashboard = get_registry(datasette).dashboards["events"]
+    assert await warm_dashboard(datasette, dashboard) == 0
+
+
+@pytest.mark.asyncio
+async def test_cache_warming_startup(events_db: Path) -> None:
+    datasette = Datasette([str(events_db)], metadata=_metadata({"warm_interval": 3600}))
+    await datasette.invoke_startup()
+    tasks = start_cache_warming(datasette)
+    assert len(tasks) == 1
+
+    cache = get_cache(datasette)
+    for _ in range(100):
+        if len(cache) == 3:
+            break
+        await asyncio.sleep(0.01)
+    assert len(cache) == 3
+
+    for task in tasks:
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_cache_warming_invalid_filters(events_db: Path) -> None:
+    datasette = Datasette(
+        [str(events_db)],
+        metadata=_metadata({"warm_interval": 60, "warm_filters": "unknown"}),
+    )
+    with pytest.raises(ValueError, match="warm_filters"):
+        await datasette.invoke_startup()
+
+
+@pytest.mark.asyncio
+async def test_warm_dashboard_missing_database(events_db: Path) -> None:
+    metadata = _metadata({"warm_interval": 3600})
+    charts = metadata["plugins"]["datasette-dashboards"]["events"]["charts"]
+    charts["missing"] = {
+        "db": "missing",
+        "query": "SELECT 1 AS count",
+        "library": "metric",
+        "display": {"field": "count"},
+    }
+    datasette = Datasette([str(events_db)], metadata=metadata)
+    dashboard = get_registry(datasette).dashboards["events"]
+    assert await warm_dashboard(datasette, dashboard) == 3
+
+    await datasette.invoke_startup()
+    tasks = start_cache_warming(datasette)
+    cache = get_cache(datasette)
+    for _ in range(100):
+        if len(cache) == 3:
+            break
+        await asyncio.sleep(0.01)
+    assert len(cache) == 3
+    assert not any(task.done() for task in tasks)
+
+    for task in tasks:
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_warm_query_errors(caplog: pytest.LogCaptureFixture) -> None:
+    async def fail() -> None:
+        raise KeyError("missing")
+
+    with caplog.at_level(logging.ERROR, logger="datasette_dashboards.warming"):
+        await warm_query(fail())
+    assert "Failed to warm a dashboard query" in caplog.text